@@ -6,9 +6,18 @@
     :license: see LICENSE for details.
 """
 from trytond.pool import Pool
-from party import Address, PaymentProfile, Party
+from party import Address, PaymentProfile, Party, ContactMechanism
 from transaction import PaymentGatewayStripe, PaymentTransactionStripe, \
-    AddPaymentProfile
+    AddPaymentProfileView, TransactionUseCardView, AddPaymentProfile
+from dispute import StripeDispute
+from payout import StripePayout, StripeFee, StripeFeeDaily, \
+    PaymentTransactionFee
+from ledger import StripeRequest
+from job import StripeJob
+from settlement import StripeSettlementRun
+from customer_import import StripeCustomerImport
+from profiling import StripeProfile
+from route import StripeRoute
 
 
 def register():
@@ -17,7 +26,21 @@ def register():
         PaymentProfile,
         PaymentGatewayStripe,
         PaymentTransactionStripe,
+        AddPaymentProfileView,
+        TransactionUseCardView,
         Party,
+        ContactMechanism,
+        StripeDispute,
+        StripePayout,
+        StripeFee,
+        StripeFeeDaily,
+        PaymentTransactionFee,
+        StripeRequest,
+        StripeJob,
+        StripeSettlementRun,
+        StripeCustomerImport,
+        StripeProfile,
+        StripeRoute,
         module='payment_gateway_stripe', type_='model'
     )
     Pool.register(
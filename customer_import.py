@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    customer_import.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, ModelView, fields
+
+__all__ = ['StripeCustomerImport']
+
+
+class StripeCustomerImport(ModelSQL, ModelView):
+    """
+    Stripe Customer Import
+
+    Statistics of an import of the customers of a stripe account as
+    payment profiles.
+    """
+    __name__ = 'payment_gateway.stripe.customer_import'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    duration = fields.Float('Duration', readonly=True, help='In seconds')
+    customers = fields.Integer(
+        'Customers', readonly=True, help='Number of stripe customers read'
+    )
+    cards = fields.Integer(
+        'Cards', readonly=True, help='Number of payment profiles created'
+    )
+    complete = fields.Boolean(
+        'Complete', readonly=True,
+        help='All the customers were read, the next import starts over'
+    )
+    throughput = fields.Float(
+        'Throughput', readonly=True, digits=(16, 2),
+        help='Customers read per second'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeCustomerImport, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
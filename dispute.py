@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+    dispute.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+from datetime import datetime
+
+from trytond.pool import Pool
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.rpc import RPC
+from trytond.exceptions import UserError
+
+from .utils import (
+    from_stripe_amount, stripe_object_cache, stripe_http_client,
+    stripe_error_message
+)
+
+import stripe
+stripe.api_version = '2017-06-05'
+
+__all__ = ['StripeDispute']
+
+STATES = [
+    ('warning_needs_response', 'Warning - Needs Response'),
+    ('warning_under_review', 'Warning - Under Review'),
+    ('warning_closed', 'Warning - Closed'),
+    ('needs_response', 'Needs Response'),
+    ('under_review', 'Under Review'),
+    ('charge_refunded', 'Charge Refunded'),
+    ('won', 'Won'),
+    ('lost', 'Lost'),
+]
+
+
+class StripeDispute(ModelSQL, ModelView):
+    "Stripe Dispute"
+    __name__ = 'payment_gateway.stripe.dispute'
+    _rec_name = 'stripe_id'
+
+    stripe_id = fields.Char('Stripe ID', required=True, readonly=True)
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='RESTRICT', domain=[('provider', '=', 'stripe')]
+    )
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True, ondelete='RESTRICT'
+    )
+    charge = fields.Char('Charge', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+    reason = fields.Char('Reason', readonly=True)
+    status = fields.Selection(STATES, 'Status', readonly=True, select=True)
+    evidence_due_by = fields.DateTime(
+        'Evidence Due By', readonly=True, select=True
+    )
+    created = fields.DateTime('Created', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeDispute, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('stripe_id_uniq', Unique(table, table.gateway, table.stripe_id),
+                'A stripe dispute can only be recorded once per gateway.'),
+        ]
+        cls._order.insert(0, ('evidence_due_by', 'ASC'))
+        cls.__rpc__.update({
+            'process_stripe_webhook': RPC(readonly=False),
+        })
+        cls._error_messages.update({
+            'invalid_stripe_webhook': (
+                'The stripe event received for gateway "%(gateway)s" is not '
+                'signed with its webhook secret.'
+            ),
+        })
+
+    @classmethod
+    def _get_values_from_stripe(cls, dispute):
+        """
+        Return the values of the record for a stripe dispute object.
+
+        Downstream modules can add to this.
+        """
+        due_by = dispute.evidence_details and \
+            dispute.evidence_details.due_by
+        return {
+            'stripe_id': dispute.id,
+            'charge': dispute.charge,
+            'amount': from_stripe_amount(dispute.amount, dispute.currency),
+            'currency_code': dispute.currency.upper(),
+            'reason': dispute.reason,
+            'status': dispute.status,
+            'evidence_due_by': (
+                datetime.utcfromtimestamp(due_by) if due_by else None
+            ),
+            'created': datetime.utcfromtimestamp(dispute.created),
+        }
+
+    @classmethod
+    def save_from_stripe(cls, gateway, disputes):
+        """
+        Create or update the records for a list of stripe dispute objects,
+        with one search, one create and one write.
+
+        :param gateway: The gateway the disputes belong to
+        :param disputes: A list of stripe dispute objects
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        # The same dispute may be sent several times, the first one is the
+        # most recent
+        latest = {}
+        for dispute in disputes:
+            latest.setdefault(dispute.id, dispute)
+        if not latest:
+            return []
+
+        existing = dict(
+            (record.stripe_id, record) for record in cls.search([
+                ('gateway', '=', gateway.id),
+                ('stripe_id', 'in', latest.keys()),
+            ])
+        )
+        transaction_ids = PaymentTransaction.get_ids_by_provider_reference(
+            gateway, [dispute.charge for dispute in latest.itervalues()]
+        )
+
+        to_create, to_write = [], []
+        for dispute in latest.itervalues():
+            values = cls._get_values_from_stripe(dispute)
+            values['transaction'] = transaction_ids.get(dispute.charge)
+            if dispute.id in existing:
+                to_write.extend([[existing[dispute.id]], values])
+            else:
+                values['gateway'] = gateway.id
+                to_create.append(values)
+        if to_write:
+            cls.write(*to_write)
+        return existing.values() + cls.create(to_create)
+
+    @classmethod
+    def sync_stripe_disputes(cls, gateways=None, page_size=100):
+        """
+        Fetch the disputes created or updated since the last sync.
+
+        This method is meant to be called from the cron. The first sync of a
+        gateway lists all its disputes, the following ones only read the
+        dispute events after the cursor saved on the gateway.
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        if gateways is None:
+            gateways = Gateway.search([('provider', '=', 'stripe')])
+
+        for gateway in gateways:
+            # Events created while syncing are picked up next time
+            started = int(time.time())
+            with stripe_http_client.use(
+                    Gateway.get_stripe_http_client(gateway, 'batch')):
+                try:
+                    if gateway.stripe_dispute_cursor:
+                        disputes = (
+                            event.data.object for event in stripe.Event.list(
+                                api_key=gateway.stripe_api_key,
+                                type='charge.dispute.*',
+                                created={'gte': gateway.stripe_dispute_cursor},
+                                limit=page_size,
+                            ).auto_paging_iter()
+                        )
+                    else:
+                        disputes = stripe.Dispute.list(
+                            api_key=gateway.stripe_api_key, limit=page_size,
+                        ).auto_paging_iter()
+
+                    page, seen = [], set()
+                    for dispute in disputes:
+                        # Events come newest first, older states are skipped
+                        if dispute.id in seen:
+                            continue
+                        seen.add(dispute.id)
+                        page.append(dispute)
+                        if len(page) == page_size:
+                            cls.save_from_stripe(gateway, page)
+                            page = []
+                    cls.save_from_stripe(gateway, page)
+                except stripe.error.StripeError, exc:
+                    raise UserError(stripe_error_message(exc))
+
+            gateway.stripe_dispute_cursor = started
+            gateway.save()
+
+    @classmethod
+    def process_stripe_webhook(cls, gateway_id, payload, signature):
+        """
+        Handle an event received by a webhook: the dispute of a
+        `charge.dispute.*` event is saved and the card changed by a
+        `customer.source.*` event is dropped from the cache. The customers
+        are not cached.
+
+        The event is only trusted if signed with the webhook secret of the
+        gateway.
+
+        :param gateway_id: ID of the gateway the event was received for
+        :param payload: The raw JSON body of the event, as received
+        :param signature: The Stripe-Signature header of the request
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        gateway = Gateway(gateway_id)
+        if not gateway.stripe_webhook_secret:
+            cls.raise_user_error('invalid_stripe_webhook', {
+                'gateway': gateway.rec_name,
+            })
+        try:
+            event = stripe.Webhook.construct_event(
+                payload, signature, gateway.stripe_webhook_secret,
+                api_key=gateway.stripe_api_key
+            )
+        except (ValueError, stripe.error.SignatureVerificationError):
+            cls.raise_user_error('invalid_stripe_webhook', {
+                'gateway': gateway.rec_name,
+            })
+        stripe_object_cache.invalidate_from_event(gateway.id, event)
+        if not event.type.startswith('charge.dispute.'):
+            return
+        cls.save_from_stripe(gateway, [event.data.object])
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+    job.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import select
+import logging
+import argparse
+import traceback
+from datetime import datetime
+from multiprocessing import Process
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+__all__ = ['StripeJob']
+
+logger = logging.getLogger(__name__)
+
+# Channel the workers listen to on postgresql
+CHANNEL = 'payment_gateway_stripe_job'
+
+
+class StripeJob(ModelSQL, ModelView):
+    """
+    Stripe Job
+
+    An operation on a stripe transaction queued to be run by a worker
+    process instead of the request which asked for it.
+    """
+    __name__ = 'payment_gateway.stripe.job'
+    _rec_name = 'operation'
+
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', required=True,
+        readonly=True, select=True, ondelete='CASCADE'
+    )
+    operation = fields.Selection([
+        ('authorize', 'Authorize'),
+        ('capture', 'Capture'),
+        ('settle', 'Settle'),
+        ('cancel', 'Cancel'),
+        ('refund', 'Refund'),
+    ], 'Operation', required=True, readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    finished = fields.DateTime('Finished', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @classmethod
+    def enqueue(cls, transactions, operation):
+        """
+        Queue the operation for the given transactions and return the jobs.
+        Transactions which already have the operation queued are not queued
+        twice.
+        """
+        queued = set(job.transaction.id for job in cls.search([
+            ('transaction', 'in', [t.id for t in transactions]),
+            ('operation', '=', operation),
+            ('state', '=', 'queued'),
+        ]))
+        jobs = cls.create([{
+            'transaction': transaction.id,
+            'operation': operation,
+        } for transaction in transactions if transaction.id not in queued])
+        cls._notify(jobs)
+        return jobs
+
+    @classmethod
+    def _notify(cls, jobs):
+        """
+        Notify the listeners of the jobs once the transaction is committed.
+
+        The workers wake up on this instead of waiting for their next poll
+        and clients can listen to it to know when a job is finished.
+        """
+        if not jobs or backend.name() != 'postgresql':
+            return
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            'SELECT pg_notify(%s, %s)',
+            (CHANNEL, ','.join(str(job.id) for job in jobs))
+        )
+
+    @classmethod
+    def _claim(cls):
+        """
+        Lock and return the oldest queued job, or None.
+
+        On postgresql the jobs locked by other workers are skipped, so that
+        the workers do not wait for each other.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        query, params = tuple(table.select(
+            table.id,
+            where=table.state == 'queued',
+            order_by=[table.id.asc],
+            limit=1,
+        ))
+        if backend.name() == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+        return cls(row[0]) if row else None
+
+    def run(self):
+        """
+        Run the operation as the user who queued it
+        """
+        transaction = self.transaction
+        with Transaction().set_user(self.create_uid.id), \
+                Transaction().set_context(stripe_operation_class='batch'):
+            getattr(transaction, '%s_stripe' % self.operation)()
+        self.state = 'done'
+        self.finished = datetime.now()
+        self.save()
+        self._notify([self])
+
+    @classmethod
+    def run_next(cls, database):
+        """
+        Run the next queued job of the database in its own transaction and
+        return False if there was none.
+
+        The job stays locked while it runs, if the worker dies the job is
+        queued again and the stripe request is replayed with the same
+        idempotency key.
+        """
+        with Transaction().start(database, 0):
+            return cls._run_next()
+
+    @classmethod
+    def _run_next(cls):
+        """
+        Run the next queued job in the current transaction, which is rolled
+        back if the job fails
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        transaction = Transaction()
+        try:
+            job = cls._claim()
+        except DatabaseOperationalError:
+            # Another worker finished it in the meantime
+            transaction.rollback()
+            return True
+        if job is None:
+            return False
+        try:
+            job.run()
+        except Exception, exc:
+            transaction.rollback()
+            if isinstance(exc, UserError):
+                error = exc.message
+            else:
+                logger.error('Running stripe job %s', job.id, exc_info=True)
+                error = traceback.format_exc()
+            failed = cls.search([
+                ('id', '=', job.id),
+                ('state', '=', 'queued'),
+            ])
+            cls.write(failed, {
+                'state': 'done' if cls._recover(failed) else 'failed',
+                'finished': datetime.now(),
+                'error': error,
+            })
+            cls._notify(failed)
+        return True
+
+    @classmethod
+    def _recover(cls, jobs):
+        """
+        Replay the stripe requests recorded as done in the ledger since the
+        jobs were queued and return True if some were recovered.
+
+        The ledger commits the outcome of the requests on its own, so a job
+        which fails after stripe answered is rolled back while stripe and
+        the ledger say the operation is done. The replay gets the original
+        response back and updates the transaction from it.
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        records = []
+        for job in jobs:
+            records.extend(StripeRequest.search([
+                ('transaction', '=', job.transaction.id),
+                ('status', '=', 'done'),
+                ('write_date', '>=', job.create_date),
+            ]))
+        if not records:
+            return False
+        return any(
+            exc is None for _, _, exc in StripeRequest.replay(records)
+        )
+
+
+def _listen(database):
+    """
+    Return a connection listening to the job notifications, or None if the
+    database cannot notify.
+    """
+    if backend.name() != 'postgresql':
+        return None
+    Database = backend.get('Database')
+    connection = Database(database).connect().get_connection(autocommit=True)
+    connection.cursor().execute('LISTEN "%s"' % CHANNEL)
+    return connection
+
+
+def _wait(connection, timeout):
+    """
+    Wait for a job notification or for the timeout
+    """
+    if connection is None:
+        time.sleep(timeout)
+        return
+    select.select([connection], [], [], timeout)
+    connection.poll()
+    del connection.notifies[:]
+
+
+def work(database, poll_interval=5, config_file=None):
+    """
+    Run the queued stripe jobs of the database until killed.
+
+    :param database: Name of the database
+    :param poll_interval: Seconds to wait for new jobs when the queue is
+                          empty
+    :param config_file: Configuration file of trytond
+    """
+    from trytond.config import config
+    config.update_etc(config_file)
+
+    Pool.start()
+    pool = Pool(database)
+    with Transaction().start(database, 0, readonly=True):
+        pool.init()
+    StripeJob = pool.get('payment_gateway.stripe.job')
+
+    connection = _listen(database)
+    while True:
+        if not StripeJob.run_next(database):
+            _wait(connection, poll_interval)
+
+
+def run_workers(database, processes=2, poll_interval=5, config_file=None):
+    """
+    Start a pool of worker processes for the database and wait for them.
+    Without postgresql only one worker can run, the jobs are not locked.
+    """
+    from trytond.config import config
+    config.update_etc(config_file)
+
+    if backend.name() != 'postgresql' and processes > 1:
+        logger.warning('Only one stripe worker runs without postgresql')
+        processes = 1
+    workers = [
+        Process(target=work, args=(database, poll_interval, config_file))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the queued stripe operations of a database'
+    )
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument(
+        '-n', '--processes', type=int, default=2,
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '--poll-interval', type=int, default=5,
+        help='seconds between two checks of an empty queue'
+    )
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_workers(
+        options.database, options.processes, options.poll_interval,
+        options.config_file
+    )
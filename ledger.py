@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+    ledger.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .utils import stripe_map, stripe_http_client, stripe_gateway_health, \
+    stripe_coalescer, own_transaction
+from .profiling import profile_phase
+
+import stripe
+stripe.api_version = '2017-06-05'
+
+__all__ = ['StripeRequest']
+
+
+class StripeRequestLinks(object):
+    """
+    Link the requests committed on their own to their payment transactions
+    once these are committed too
+    """
+
+    def __init__(self):
+        self.links = []
+
+    def __eq__(self, other):
+        return isinstance(other, StripeRequestLinks)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        by_transaction = {}
+        for request_id, transaction_id in self.links:
+            by_transaction.setdefault(transaction_id, []).append(request_id)
+        to_write = []
+        for transaction_id, request_ids in by_transaction.iteritems():
+            to_write.extend([
+                StripeRequest.browse(request_ids),
+                {'transaction': transaction_id},
+            ])
+        with Transaction().new_transaction():
+            StripeRequest.write(*to_write)
+
+    def tpc_abort(self, transaction):
+        pass
+
+
+class StripeRequest(ModelSQL, ModelView):
+    """
+    Stripe Request
+
+    Every call which changes something on stripe is recorded here with its
+    idempotency key before it is sent, so that the calls whose outcome is
+    unknown (the connection failed) can be sent again with the same key.
+    """
+    __name__ = 'payment_gateway.stripe.request'
+    _rec_name = 'key'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='RESTRICT'
+    )
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    operation = fields.Selection([
+        ('charge', 'Charge'),
+        ('capture', 'Capture'),
+        ('refund', 'Refund'),
+        ('cancel', 'Cancel'),
+        ('customer', 'Create Customer'),
+        ('source', 'Create Source'),
+        ('card_update', 'Update Card'),
+        ('customer_update', 'Update Customer'),
+        ('source_delete', 'Delete Source'),
+    ], 'Operation', required=True, readonly=True)
+    key = fields.Char('Idempotency Key', required=True, readonly=True)
+    request_hash = fields.Char('Request Hash', readonly=True)
+    request = fields.Text(
+        'Request', readonly=True,
+        help='Parameters of the request, empty if they carried card data'
+    )
+    status = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'Status', required=True, readonly=True, select=True)
+    response_id = fields.Char('Response ID', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeRequest, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('key_uniq', Unique(table, table.gateway, table.key),
+                'The idempotency key must be unique per gateway.'),
+        ]
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_status():
+        return 'pending'
+
+    @staticmethod
+    def _dump_request(params):
+        """
+        Return the params as JSON, or None if they contain raw card data
+        which must never be stored
+        """
+        if isinstance(params.get('source'), dict):
+            return None
+        return json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def _hash_request(params):
+        params = dict(params)
+        if isinstance(params.get('source'), dict):
+            # Only the card fingerprint is known to stripe
+            params['source'] = 'card'
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def prepare(cls, requests, commit=False):
+        """
+        Record a list of requests and return the records in the same order.
+        Requests already recorded with the same key are set back to pending.
+
+        :param requests: A list of tuples (gateway, operation, key, params,
+                         transaction)
+        :param commit: True if the requests are about to be sent, they are
+                       committed before. The links to the payment
+                       transactions not committed yet are written once the
+                       calling transaction is committed.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        transaction_ids = set(r[4].id for r in requests if r[4])
+        own = commit and backend.name() == 'postgresql'
+        with own_transaction(commit):
+            committed = transaction_ids
+            if own:
+                committed = set()
+                for sub_ids in grouped_slice(list(transaction_ids)):
+                    committed.update(map(int, PaymentTransaction.search([
+                        ('id', 'in', list(sub_ids)),
+                    ])))
+
+            existing = {}
+            for sub_keys in grouped_slice(list(set(r[2] for r in requests))):
+                for record in cls.search([
+                        ('key', 'in', list(sub_keys)),
+                        ]):
+                    existing[(record.gateway.id, record.key)] = record
+
+            to_create = []
+            for gateway, operation, key, params, transaction in requests:
+                if (gateway.id, key) in existing:
+                    continue
+                to_create.append({
+                    'gateway': gateway.id,
+                    'transaction': (
+                        transaction.id if transaction and
+                        transaction.id in committed else None
+                    ),
+                    'operation': operation,
+                    'key': key,
+                    'request_hash': cls._hash_request(params),
+                    'request': cls._dump_request(params),
+                })
+            for record in cls.create(to_create):
+                existing[(record.gateway.id, record.key)] = record
+
+            records = [existing[(r[0].id, r[2])] for r in requests]
+            retried = [r for r in records if r.status != 'pending']
+            if retried:
+                cls.write(retried, {'status': 'pending'})
+
+        links = [
+            (record.id, r[4].id) for record, r in zip(records, requests)
+            if r[4] and r[4].id not in committed
+        ]
+        if links:
+            Transaction().join(StripeRequestLinks()).links.extend(links)
+        return cls.browse(map(int, records))
+
+    @classmethod
+    def send(cls, api_key, operation, key, params, client=None):
+        """
+        Send a request to stripe, with the given HTTP client if any. The
+        requests sent simultaneously with the same key by the process are
+        coalesced into one.
+
+        This only uses its arguments, so it can be called from other
+        threads.
+        """
+        def send():
+            with stripe_http_client.use(client):
+                return getattr(cls, '_send_%s' % operation)(
+                    api_key, key, dict(params)
+                )
+        return stripe_coalescer.call((api_key, key), send)
+
+    @classmethod
+    def _send_charge(cls, api_key, key, params):
+        return stripe.Charge.create(
+            api_key=api_key, idempotency_key=key, **params
+        )
+
+    @classmethod
+    def _send_capture(cls, api_key, key, params):
+        charge = stripe.Charge.construct_from(
+            {'id': params.pop('charge')}, api_key
+        )
+        return charge.capture(idempotency_key=key, **params)
+
+    @classmethod
+    def _send_cancel(cls, api_key, key, params):
+        charge = stripe.Charge.construct_from(
+            {'id': params.pop('charge')}, api_key
+        )
+        return charge.refund(idempotency_key=key, **params)
+
+    @classmethod
+    def _send_refund(cls, api_key, key, params):
+        return stripe.Refund.create(
+            api_key=api_key, idempotency_key=key, **params
+        )
+
+    @classmethod
+    def _send_customer(cls, api_key, key, params):
+        return stripe.Customer.create(
+            api_key=api_key, idempotency_key=key, **params
+        )
+
+    @classmethod
+    def _send_source(cls, api_key, key, params):
+        return stripe.Customer.create_source(
+            params.pop('customer'), api_key=api_key, idempotency_key=key,
+            **params
+        )
+
+    @classmethod
+    def _send_card_update(cls, api_key, key, params):
+        return stripe.Customer.modify_source(
+            params.pop('customer'), params.pop('card'), api_key=api_key,
+            idempotency_key=key, **params
+        )
+
+    @classmethod
+    def _send_customer_update(cls, api_key, key, params):
+        return stripe.Customer.modify(
+            params.pop('customer'), api_key=api_key, idempotency_key=key,
+            **params
+        )
+
+    @classmethod
+    def _send_source_delete(cls, api_key, key, params):
+        try:
+            return stripe.Customer.delete_source(
+                params['customer'], params['card'], api_key=api_key,
+                idempotency_key=key
+            )
+        except stripe.error.InvalidRequestError, exc:
+            if exc.http_status != 404:
+                raise
+            # Already deleted, by stripe or by a previous attempt
+            return stripe.Card.construct_from({
+                'id': params['card'], 'deleted': True,
+            }, api_key)
+
+    @classmethod
+    def record_results(cls, results, commit=False):
+        """
+        Save the outcome of sent requests with a single write.
+
+        Requests which could not reach stripe stay pending, they may or may
+        not have been received. The outcomes feed the health of the gateways
+        used to route the transactions.
+
+        :param results: A list of tuples (record, response, exception)
+        :param commit: True if the outcomes are committed on their own, the
+                       records must be committed
+        """
+        with own_transaction(commit):
+            to_write, failed = [], []
+            for record, response, exc in results:
+                stripe_gateway_health.record(record.gateway.id, exc)
+                if exc is None:
+                    to_write.extend([[record], {
+                        'status': 'done',
+                        'response_id': response.id,
+                    }])
+                elif not isinstance(exc, stripe.error.APIConnectionError):
+                    failed.append(record)
+            if failed:
+                to_write.extend([failed, {'status': 'failed'}])
+            if to_write:
+                cls.write(*to_write)
+
+    @classmethod
+    def call(cls, gateway, operation, key, params, transaction=None):
+        """
+        Record and send a request to stripe, and return the response.
+        Stripe errors are raised as is.
+
+        :param gateway: The stripe gateway
+        :param operation: One of the operations of the ledger
+        :param key: The idempotency key of the request
+        :param params: The parameters of the request
+        :param transaction: The payment transaction the request is made for
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        api_key = Gateway.get_stripe_config(gateway)['api_key']
+        client = Gateway.get_stripe_http_client(gateway)
+        with profile_phase('ledger'):
+            record, = cls.prepare([
+                (gateway, operation, key, params, transaction)
+            ], commit=True)
+        try:
+            with profile_phase('stripe'):
+                response = cls.send(api_key, operation, key, params, client)
+        except stripe.error.StripeError, exc:
+            with profile_phase('ledger'):
+                cls.record_results([(record, None, exc)], commit=True)
+            raise
+        with profile_phase('ledger'):
+            cls.record_results([(record, response, None)], commit=True)
+        return response
+
+    @classmethod
+    def replay_pending(cls, age=10, workers=8):
+        """
+        Send again the requests left pending for more than `age` minutes.
+
+        This method is meant to be called from the cron. The requests are
+        sent simultaneously with their original idempotency key, so stripe
+        returns the original response of the requests it already received.
+        """
+        records = cls.search([
+            ('status', '=', 'pending'),
+            ('request', '!=', None),
+            # Sent by their own cron once checked the card is still unused
+            ('operation', '!=', 'source_delete'),
+            ('create_date', '<', datetime.now() - timedelta(minutes=age)),
+        ])
+        cls.replay(records, workers)
+
+    @classmethod
+    def replay(cls, records, workers=8):
+        """
+        Send again the requests of the records with their original
+        idempotency key, update their payment transactions from the
+        responses and return the tuples (record, response, exception).
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+
+        # The threads only get plain data
+        requests = [(record, (
+            Gateway.get_stripe_config(record.gateway)['api_key'],
+            record.operation, record.key,
+            json.loads(record.request),
+            Gateway.get_stripe_http_client(record.gateway, 'batch'),
+        )) for record in records]
+
+        results = [
+            (record, response, exc) for (record, _), response, exc in
+            stripe_map(lambda r: cls.send(*r[1]), requests, workers)
+        ]
+        cls.record_results(results, commit=True)
+        PaymentTransaction.stripe_requests_recovered([
+            (record, response) for record, response, exc in results
+            if exc is None and record.transaction
+        ])
+        return results
@@ -5,16 +5,31 @@
     :copyright: (c) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import json
+import hashlib
+import logging
+import calendar
+import datetime
+from uuid import uuid4
+
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.model import fields
 from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 
+from .utils import stripe_map, stripe_object_cache, stripe_http_client, \
+    StripeGatewayHealth, stripe_error_message
+
 import stripe
 stripe.api_version = '2017-06-05'
 
+logger = logging.getLogger(__name__)
+
 __metaclass__ = PoolMeta
-__all__ = ['Address', 'PaymentProfile', 'Party']
+__all__ = ['Address', 'PaymentProfile', 'Party', 'ContactMechanism']
 
 
 class Address:
@@ -40,6 +55,10 @@ class PaymentProfile:
     stripe_customer_id = fields.Char(
         'Stripe Customer ID', readonly=True
     )
+    expiry_date = fields.Date(
+        'Expiry Date', readonly=True, select=True,
+        help='Last day the card can be charged'
+    )
 
     @classmethod
     def __setup__(cls):
@@ -53,40 +72,415 @@ class PaymentProfile:
             ),
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        expiry_date_exist = TableHandler(cls, module_name).column_exist(
+            'expiry_date'
+        )
+
+        super(PaymentProfile, cls).__register__(module_name)
+
+        # Migration: fill the expiry date of the existing profiles
+        if not expiry_date_exist:
+            cursor.execute(*table.select(
+                table.id, table.expiry_month, table.expiry_year
+            ))
+            ids_by_date = {}
+            for id_, month, year in cursor.fetchall():
+                ids_by_date.setdefault(
+                    cls._get_expiry_date(month, year), []
+                ).append(id_)
+            ids_by_date.pop(None, None)
+            for expiry_date, ids in ids_by_date.iteritems():
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*table.update(
+                        [table.expiry_date], [expiry_date],
+                        where=reduce_ids(table.id, sub_ids)
+                    ))
+
+    @staticmethod
+    def _get_expiry_date(month, year):
+        """
+        Return the last day of the expiry month, or None if the month or the
+        year is not valid
+        """
+        try:
+            month, year = int(month), int(year)
+            if year < 100:
+                year += 2000
+            return datetime.date(
+                year, month, calendar.monthrange(year, month)[1]
+            )
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            values['expiry_date'] = cls._get_expiry_date(
+                values.get('expiry_month'), values.get('expiry_year')
+            )
+        return super(PaymentProfile, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentProfile, cls).write(*args)
+
+        profiles, deactivated = [], []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'expiry_month' in values or 'expiry_year' in values:
+                profiles.extend(records)
+            if 'active' in values and not values['active']:
+                deactivated.extend(records)
+        cls._queue_stripe_source_deletion(deactivated)
+        if not profiles:
+            return
+
+        by_date = {}
+        for profile in cls.browse(profiles):
+            by_date.setdefault(cls._get_expiry_date(
+                profile.expiry_month, profile.expiry_year
+            ), []).append(profile)
+        to_write = []
+        for expiry_date, records in by_date.iteritems():
+            to_write.extend([records, {'expiry_date': expiry_date}])
+        super(PaymentProfile, cls).write(*to_write)
+
+    @classmethod
+    def delete(cls, profiles):
+        cls._queue_stripe_source_deletion(profiles)
+        super(PaymentProfile, cls).delete(profiles)
+
+    @classmethod
+    def _queue_stripe_source_deletion(cls, profiles):
+        """
+        Record in the ledger the deletion of the stripe cards of the
+        profiles, to be sent by the cron
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        requests = []
+        for profile in cls.browse(profiles):
+            if (profile.gateway.provider != 'stripe' or
+                    not profile.stripe_customer_id or
+                    not profile.provider_reference):
+                continue
+            requests.append((
+                profile.gateway, 'source_delete',
+                'source_delete_%s' % profile.provider_reference, {
+                    'customer': profile.stripe_customer_id,
+                    'card': profile.provider_reference,
+                }, None
+            ))
+        if requests:
+            StripeRequest.prepare(requests)
+
+    @classmethod
+    def delete_stripe_sources(cls, batch_size=100, workers=8):
+        """
+        Delete from stripe the cards of the profiles deactivated or deleted.
+
+        This method is meant to be called from the cron. The deletions are
+        sent simultaneously at the batch rate of the gateways and their
+        outcome is saved in the ledger. The cards used again by an active
+        profile meanwhile are kept.
+        """
+        pool = Pool()
+        StripeRequest = pool.get('payment_gateway.stripe.request')
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+
+        records = StripeRequest.search([
+            ('operation', '=', 'source_delete'),
+            ('status', '=', 'pending'),
+        ], order=[('id', 'ASC')])
+        deleted = failed = 0
+        with Transaction().set_context(stripe_operation_class='batch'):
+            for sub_records in grouped_slice(records, batch_size):
+                sub_records = list(sub_records)
+                params = [json.loads(r.request) for r in sub_records]
+                used = set(p.provider_reference for p in cls.search([
+                    ('provider_reference', 'in', [p['card'] for p in params]),
+                ]))
+                kept = [
+                    r for r, p in zip(sub_records, params) if p['card'] in used
+                ]
+                if kept:
+                    StripeRequest.delete(kept)
+
+                requests = [
+                    (r.gateway, r.operation, r.key, p, None)
+                    for r, p in zip(sub_records, params)
+                    if p['card'] not in used
+                ]
+                results = PaymentTransaction._send_stripe_requests(
+                    requests, workers
+                )
+                for (gateway, _, _, p, _), (_, _, exc) in zip(
+                        requests, results):
+                    if exc is None:
+                        deleted += 1
+                        stripe_object_cache.invalidate(gateway.id, p['card'])
+                    else:
+                        failed += 1
+                        logger.warning(
+                            'Could not delete stripe card %s of customer %s: '
+                            '%s', p['card'], p['customer'], exc
+                        )
+        logger.info(
+            'Deleted %s stripe cards, %s failed', deleted, failed
+        )
+
+    @classmethod
+    def cleanup_stripe_sources(cls, age=60, workers=8):
+        """
+        Queue the deletion of the cards of the stripe customers which are
+        used by no active profile.
+
+        This method is meant to be called from the cron. The cards of the
+        customers changed during the last `age` minutes are skipped, their
+        profile may not be committed yet.
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        StripeRequest = pool.get('payment_gateway.stripe.request')
+
+        with Transaction().set_context(active_test=False):
+            profiles = cls.search([
+                ('gateway.provider', '=', 'stripe'),
+                ('stripe_customer_id', '!=', None),
+            ])
+        customers = set(
+            (p.gateway, p.stripe_customer_id) for p in profiles
+        )
+        for record in StripeRequest.search([
+                ('operation', 'in', ['customer', 'source']),
+                ('create_date', '>',
+                    datetime.datetime.now() - datetime.timedelta(
+                        minutes=age)),
+                ]):
+            if record.operation == 'customer':
+                customer = record.response_id
+            else:
+                customer = json.loads(record.request or '{}').get('customer')
+            customers.discard((record.gateway, customer))
+
+        # The threads only get plain data, the records are not thread safe
+        calls = [((gateway, customer_id), (
+            Gateway.get_stripe_config(gateway)['api_key'], customer_id,
+            Gateway.get_stripe_http_client(gateway, 'batch'),
+        )) for gateway, customer_id in customers]
+
+        def list_cards(item):
+            api_key, customer_id, client = item[1]
+            with stripe_http_client.use(client):
+                return [
+                    card.id for card in stripe.Customer.list_sources(
+                        customer_id, object='card', limit=100,
+                        api_key=api_key
+                    ).auto_paging_iter()
+                ]
+
+        cards = {}
+        for (key, _), card_ids, exc in stripe_map(list_cards, calls, workers):
+            if exc is not None:
+                if not isinstance(exc, stripe.error.StripeError):
+                    raise exc
+                logger.warning(
+                    'Could not list the stripe cards of customer %s: %s',
+                    key[1], exc
+                )
+                continue
+            for card_id in card_ids:
+                cards[card_id] = key
+
+        used = set()
+        for sub_ids in grouped_slice(cards.keys()):
+            used.update(p.provider_reference for p in cls.search([
+                ('provider_reference', 'in', list(sub_ids)),
+            ]))
+        requests = [
+            (gateway, 'source_delete', 'source_delete_%s' % card_id, {
+                'customer': customer_id,
+                'card': card_id,
+            }, None)
+            for card_id, (gateway, customer_id) in cards.iteritems()
+            if card_id not in used
+        ]
+        if requests:
+            StripeRequest.prepare(requests)
+        logger.info(
+            'Found %s orphaned stripe cards on %s customers',
+            len(requests), len(customers)
+        )
+
+    @classmethod
+    def refresh_expiring_stripe_cards(
+            cls, months=1, batch_size=100, workers=8):
+        """
+        Pull the current data of the stripe cards expiring this month or in
+        the next `months` months and save the cards which changed. The cards
+        expired before this month are left alone, the banks did not renew
+        them.
+
+        This method is meant to be called from the cron. The banks send the
+        renewed cards to stripe, refreshing them ahead avoids failing the
+        charges made with the old expiry date. The cards cached by the
+        gateway are at most as old as its cache duration.
+        """
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        month = today.month + months
+        profiles = cls.search([
+            ('gateway.provider', '=', 'stripe'),
+            ('stripe_customer_id', '!=', None),
+            ('expiry_date', '>=', today.replace(day=1)),
+            ('expiry_date', '<=', cls._get_expiry_date(
+                (month - 1) % 12 + 1, today.year + (month - 1) // 12
+            )),
+        ], order=[('expiry_date', 'ASC'), ('id', 'ASC')])
+
+        updated = 0
+        with Transaction().set_context(stripe_operation_class='batch'):
+            for sub_profiles in grouped_slice(profiles, batch_size):
+                updated += cls._refresh_stripe_cards(
+                    list(sub_profiles), workers
+                )
+        logger.info(
+            'Refreshed %s expiring stripe cards, %s changed',
+            len(profiles), updated
+        )
+
+    @classmethod
+    def get_stripe_cards(cls, profiles, workers=8):
+        """
+        Return a list of (profile, card, exception) in the order of the
+        profiles. The cards are taken from the cache if the gateway has one,
+        the others are fetched from stripe simultaneously.
+
+        :param workers: The maximum number of simultaneous stripe calls
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        results, calls = {}, []
+        for profile in profiles:
+            card = stripe_object_cache.lookup(
+                profile.gateway, profile.provider_reference
+            )
+            if card is not None:
+                results[profile.id] = (profile, card, None)
+                continue
+            # The threads only get plain data, the records are not thread
+            # safe
+            calls.append((profile, (
+                Gateway.get_stripe_config(profile.gateway)['api_key'],
+                profile.stripe_customer_id, profile.provider_reference,
+                Gateway.get_stripe_http_client(profile.gateway),
+            )))
+
+        def retrieve_source(item):
+            api_key, customer_id, card_id, client = item[1]
+            with stripe_http_client.use(client):
+                return stripe.Customer.retrieve_source(
+                    customer_id, card_id, api_key=api_key
+                )
+
+        for (profile, _), card, exc in stripe_map(
+                retrieve_source, calls, workers):
+            if exc is None:
+                stripe_object_cache.store(
+                    profile.gateway, profile.provider_reference, card
+                )
+            elif not isinstance(exc, stripe.error.StripeError):
+                raise exc
+            results[profile.id] = (profile, card, exc)
+        return [results[profile.id] for profile in profiles]
+
+    def get_stripe_card(self):
+        """
+        Return the card of this payment profile on stripe, from the cache if
+        the gateway has one
+        """
+        assert self.gateway.provider == 'stripe'
+
+        (_, card, exc), = self.get_stripe_cards([self], workers=1)
+        if exc is not None:
+            raise exc
+        return card
+
+    @classmethod
+    def _refresh_stripe_cards(cls, profiles, workers=8):
+        """
+        Get the cards of the profiles and update the profiles which changed
+        with a single write. The profiles whose card was deleted on stripe
+        are deactivated.
+
+        Return the number of profiles updated.
+        """
+        to_update, missing = {}, []
+        for profile, card, exc in cls.get_stripe_cards(profiles, workers):
+            if exc is not None:
+                if exc.http_status == 404:
+                    missing.append(profile)
+                else:
+                    logger.warning(
+                        'Could not refresh the stripe card of profile %s: %s',
+                        profile.id, exc
+                    )
+                continue
+            values = (
+                ('expiry_month', unicode('%02d' % card.exp_month)),
+                ('expiry_year', unicode(card.exp_year)),
+                ('last_4_digits', card.last4),
+            )
+            if any(getattr(profile, name) != value for name, value in values):
+                to_update.setdefault(values, []).append(profile)
+
+        to_write = []
+        for values, records in to_update.iteritems():
+            to_write.extend([records, dict(values)])
+        if missing:
+            to_write.extend([missing, {'active': False}])
+        if to_write:
+            cls.write(*to_write)
+        return sum(len(records) for records in to_update.itervalues())
+
     def update_stripe(self):
         """
         Update this payment profile on the gateway (stripe)
         """
-        assert self.gateway.provider == 'stripe'
-        stripe.api_key = self.gateway.stripe_api_key
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
-        try:
-            card = stripe.Customer.retrieve(
-                self.stripe_customer_id
-            ).sources.retrieve(self.provider_reference)
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            raise UserError(exc.json_body['error']['message'])
+        assert self.gateway.provider == 'stripe'
 
         # Update all the information
-        card.name = self.name or self.party.name
+        card_data = {
+            'customer': self.stripe_customer_id,
+            'card': self.provider_reference,
+            'name': self.name or self.party.name,
+            'exp_month': self.expiry_month,
+            'exp_year': self.expiry_year,
+        }
         for key, value in self.address.get_address_for_stripe().iteritems():
             if value:
-                setattr(card, key, value)
-        card.exp_month = self.expiry_month
-        card.exp_year = self.expiry_year
+                card_data[key] = value
 
+        stripe_object_cache.invalidate(
+            self.gateway.id, self.provider_reference
+        )
         try:
-            card.save()
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            raise UserError(exc.json_body['error']['message'])
+            StripeRequest.call(
+                self.gateway, 'card_update', 'card_update_%s' % uuid4().hex,
+                card_data
+            )
+        except stripe.error.StripeError, exc:
+            raise UserError(stripe_error_message(exc))
 
     @classmethod
     def create_profile_using_stripe_token(
@@ -102,20 +496,11 @@ class PaymentProfile:
         party = Party(user_id)
         gateway = PaymentGateway(gateway_id)
         assert gateway.provider == 'stripe'
-        stripe.api_key = gateway.stripe_api_key
 
         try:
-            customer = stripe.Customer.create(
-                source=token,
-                description=party.name,
-            )
-            card = customer.sources.data[0]
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            raise UserError(exc.json_body['error']['message'])
+            customer_id, card = party._add_stripe_source(gateway, token)
+        except stripe.error.StripeError, exc:
+            raise UserError(stripe_error_message(exc))
         else:
             profile, = PaymentProfile.create([{
                 'name': card.name,
@@ -126,7 +511,7 @@ class PaymentProfile:
                 'expiry_month': unicode('%02d' % card.exp_month),
                 'expiry_year': unicode(card.exp_year),
                 'provider_reference': card.id,
-                'stripe_customer_id': customer.id,
+                'stripe_customer_id': customer_id,
             }])
 
             return profile.id
@@ -135,6 +520,100 @@ class PaymentProfile:
 class Party:
     __name__ = 'party.party'
 
+    stripe_changed = fields.DateTime(
+        'Changed for Stripe', readonly=True, select=True,
+        help='Time of the last change not pushed to the stripe customers yet'
+    )
+
+    # The fields sent to the stripe customers
+    _stripe_fields = ['name']
+
+    @classmethod
+    def write(cls, *args):
+        # Mark the parties in the same update as their changes
+        to_write = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & set(cls._stripe_fields):
+                values = dict(values, stripe_changed=datetime.datetime.now())
+            to_write.extend([records, values])
+        super(Party, cls).write(*to_write)
+
+    @classmethod
+    def _set_stripe_changed(cls, parties):
+        """
+        Mark the parties to be pushed to their stripe customers by the cron
+        """
+        if parties:
+            cls.write(list(set(parties)), {
+                'stripe_changed': datetime.datetime.now(),
+            })
+
+    @classmethod
+    def push_stripe_customers(cls, batch_size=100, workers=8):
+        """
+        Push the parties changed since the last run to their stripe
+        customers.
+
+        This method is meant to be called from the cron. The changes made to
+        a party meanwhile are pushed with a single update of each of its
+        customers, at the batch rate of the gateways. The parties whose
+        update failed because of stripe or of the network are pushed again
+        by the next run.
+        """
+        started = datetime.datetime.now()
+        parties = cls.search([('stripe_changed', '!=', None)])
+        with Transaction().set_context(stripe_operation_class='batch'):
+            for sub_parties in grouped_slice(parties, batch_size):
+                cls._push_stripe_customers(list(sub_parties), started, workers)
+
+    @classmethod
+    def _push_stripe_customers(cls, parties, started, workers):
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+
+        customers = {}
+        for profile in PaymentProfile.search([
+                ('party', 'in', [p.id for p in parties]),
+                ('gateway.provider', '=', 'stripe'),
+                ('stripe_customer_id', '!=', None),
+                ]):
+            customers[(profile.gateway, profile.stripe_customer_id)] = \
+                profile.party
+
+        requests = []
+        for (gateway, customer_id), party in customers.iteritems():
+            params = party._get_stripe_customer_data(gateway)
+            params['customer'] = customer_id
+            requests.append((
+                gateway, 'customer_update', 'customer_update_%s_%d_%s_%s' % (
+                    Transaction().database.name, gateway.id, customer_id,
+                    party.stripe_changed.strftime('%Y%m%d%H%M%S%f'),
+                ), params, None
+            ))
+        results = PaymentTransaction._send_stripe_requests(requests, workers)
+
+        retry = set()
+        for (gateway, _, _, params, _), (_, _, exc) in zip(requests, results):
+            party = customers[(gateway, params['customer'])]
+            if exc is not None and StripeGatewayHealth.is_gateway_error(exc):
+                retry.add(party)
+                continue
+            if exc is not None:
+                logger.warning(
+                    'Could not update stripe customer %s of party %s: %s',
+                    params['customer'], party.id, exc
+                )
+
+        # The parties changed again since the start are pushed next time
+        done = cls.search([
+            ('id', 'in', [p.id for p in parties if p not in retry]),
+            ('stripe_changed', '<=', started),
+        ])
+        if done:
+            cls.write(done, {'stripe_changed': None})
+
     def _get_stripe_customer_id(self, gateway):
         """
         Extracts and returns customer id from party's payment profile
@@ -151,3 +630,165 @@ class Party:
         if payment_profiles:
             return payment_profiles[0].stripe_customer_id
         return None
+
+    def _get_or_create_stripe_customer_id(self, gateway):
+        """
+        Return the id of the stripe customer of the party on the given
+        gateway, creating the customer if the party does not have one yet.
+
+        :param gateway: Payment gateway to which the customer is associated
+        """
+        customer_id = self._get_stripe_customer_id(gateway)
+        if customer_id:
+            return customer_id
+        return self._create_stripe_customer(gateway).id
+
+    def _add_stripe_source(self, gateway, source):
+        """
+        Add a card to the stripe customer of the party and return the tuple
+        (customer id, card).
+
+        :param gateway: Payment gateway to which the customer is associated
+        :param source: A token created with Stripe.js or the raw card data
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        customer_id = self._get_or_create_stripe_customer_id(gateway)
+        if isinstance(source, dict):
+            # Raw card data is not stored, so the request is never replayed
+            key = 'source_%s' % uuid4().hex
+        else:
+            key = 'source_%s' % source
+        card = StripeRequest.call(gateway, 'source', key, {
+            'customer': customer_id,
+            'source': source,
+        })
+        return customer_id, card
+
+    def _get_stripe_customer_data(self, gateway):
+        """
+        Return the data the stripe customer of the party is created with.
+
+        Downstream modules can add to this, but the data must not change
+        between two calls for the same party as it is part of the
+        idempotency key.
+        """
+        return {
+            'description': self.name,
+            'email': self.email,
+            'metadata': {
+                'party_id': self.id,
+            },
+        }
+
+    def _get_stripe_customer_idempotency_key(self, gateway, customer_data):
+        """
+        Return the idempotency key used to create the stripe customer of the
+        party.
+
+        The key is derived from the database, the gateway and the party, so
+        that simultaneous requests resolve to the same customer. A digest of
+        the data is included because stripe rejects a key reused with
+        different parameters.
+        """
+        digest = hashlib.sha1(
+            repr(sorted(customer_data.items()))
+        ).hexdigest()
+        return 'customer_%s_%d_%d_%s' % (
+            Transaction().database.name, gateway.id, self.id, digest[:16]
+        )
+
+    def _lock_stripe_customer(self, gateway):
+        """
+        Serialise the creation of the stripe customer of the party on the
+        gateway until the end of the transaction.
+
+        Without the lock, a second request would reach stripe while the
+        first one is in flight and stripe refuses concurrent requests with
+        the same idempotency key.
+        """
+        if backend.name() != 'postgresql':
+            return
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            'SELECT pg_advisory_xact_lock(%s, %s)', (gateway.id, self.id)
+        )
+
+    def _create_stripe_customer(self, gateway):
+        """
+        Create a stripe customer for the party on the given gateway.
+
+        Concurrent calls for the same party and gateway are coalesced into a
+        single customer on stripe.
+
+        :param gateway: Payment gateway to which the customer is associated
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        customer_data = self._get_stripe_customer_data(gateway)
+
+        self._lock_stripe_customer(gateway)
+        return StripeRequest.call(
+            gateway, 'customer', self._get_stripe_customer_idempotency_key(
+                gateway, customer_data
+            ), customer_data
+        )
+
+
+class ContactMechanism:
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def create(cls, vlist):
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        cls._set_stripe_changed(mechanisms)
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        Party = Pool().get('party.party')
+
+        # The fields the email of a party is computed from, the party and
+        # the type may change too
+        names = set(['party', 'type', 'value', 'active', 'sequence'])
+        party_ids = set()
+        actions = iter(args)
+        for mechanisms, values in zip(actions, actions):
+            if not set(values) & names:
+                continue
+            for mechanism in mechanisms:
+                if 'email' in (mechanism.type, values.get('type')):
+                    party_ids.add(mechanism.party.id)
+                    if values.get('party'):
+                        party_ids.add(values['party'])
+        emails = cls._get_stripe_emails(party_ids)
+        super(ContactMechanism, cls).write(*args)
+        new_emails = cls._get_stripe_emails(party_ids)
+        Party._set_stripe_changed(Party.browse([
+            i for i in party_ids if emails[i] != new_emails[i]
+        ]))
+
+    @staticmethod
+    def _get_stripe_emails(party_ids):
+        """
+        Return the emails sent to stripe by party id
+        """
+        Party = Pool().get('party.party')
+
+        return dict((p.id, p.email) for p in Party.browse(list(party_ids)))
+
+    @classmethod
+    def delete(cls, mechanisms):
+        cls._set_stripe_changed(mechanisms)
+        super(ContactMechanism, cls).delete(mechanisms)
+
+    @classmethod
+    def _set_stripe_changed(cls, mechanisms):
+        """
+        Mark the parties whose email changed to be pushed to stripe
+        """
+        Party = Pool().get('party.party')
+
+        Party._set_stripe_changed([
+            m.party for m in cls.browse(mechanisms) if m.type == 'email'
+        ])
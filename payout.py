@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+    payout.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+from decimal import Decimal
+from datetime import datetime
+
+from sql import Literal
+from sql.aggregate import Count, Min, Sum
+from sql.functions import CurrentTimestamp
+
+from trytond.pool import Pool, PoolMeta
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.exceptions import UserError
+
+from .utils import from_stripe_amount, stripe_http_client, \
+    stripe_error_message
+
+import stripe
+stripe.api_version = '2017-06-05'
+
+__all__ = [
+    'StripePayout', 'StripeFee', 'StripeFeeDaily', 'PaymentTransactionFee'
+]
+
+FINAL_STATES = ('paid', 'failed', 'canceled')
+
+
+class StripePayout(ModelSQL, ModelView):
+    "Stripe Payout"
+    __name__ = 'payment_gateway.stripe.payout'
+    _rec_name = 'stripe_id'
+
+    stripe_id = fields.Char('Stripe ID', required=True, readonly=True)
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='RESTRICT', domain=[('provider', '=', 'stripe')]
+    )
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    fee = fields.Numeric('Fee', digits=(16, 2), readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+    status = fields.Char('Status', readonly=True)
+    arrival_date = fields.Date('Arrival Date', readonly=True, select=True)
+    fees = fields.One2Many(
+        'payment_gateway.stripe.fee', 'payout', 'Fees', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripePayout, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('stripe_id_uniq', Unique(table, table.gateway, table.stripe_id),
+                'A stripe payout can only be imported once per gateway.'),
+        ]
+        cls._order.insert(0, ('arrival_date', 'DESC'))
+
+    @classmethod
+    def import_stripe_payouts(cls, gateways=None, page_size=100):
+        """
+        Import the payouts paid since the last import with their balance
+        transactions.
+
+        This method is meant to be called from the cron. Payouts still on
+        their way are left for the next import.
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        if gateways is None:
+            gateways = Gateway.search([('provider', '=', 'stripe')])
+
+        for gateway in gateways:
+            cursor = int(time.time())
+            params = {
+                'api_key': gateway.stripe_api_key,
+                'limit': page_size,
+            }
+            if gateway.stripe_payout_cursor:
+                params['created'] = {'gte': gateway.stripe_payout_cursor}
+            with stripe_http_client.use(
+                    Gateway.get_stripe_http_client(gateway, 'batch')):
+                try:
+                    payouts = []
+                    for payout in stripe.Payout.list(
+                            **params).auto_paging_iter():
+                        if payout.status not in FINAL_STATES:
+                            cursor = min(cursor, payout.created)
+                            continue
+                        payouts.append(payout)
+                        if len(payouts) == page_size:
+                            cls._import_stripe_payouts(
+                                gateway, payouts, page_size
+                            )
+                            payouts = []
+                    cls._import_stripe_payouts(gateway, payouts, page_size)
+                except stripe.error.StripeError, exc:
+                    raise UserError(stripe_error_message(exc))
+
+            gateway.stripe_payout_cursor = cursor
+            gateway.save()
+
+    @classmethod
+    def _import_stripe_payouts(cls, gateway, payouts, page_size):
+        """
+        Import a page of payouts and their balance transactions.
+
+        The payouts already imported are found with a single search. The
+        balance transactions are streamed from stripe and written
+        `page_size` at a time whatever payout they belong to, so that their
+        sources are resolved to transactions once per page. Only the
+        running fee total of each payout is kept in memory.
+        """
+        Fee = Pool().get('payment_gateway.stripe.fee')
+
+        imported = set(p.stripe_id for p in cls.search([
+                    ('gateway', '=', gateway.id),
+                    ('stripe_id', 'in', [p.id for p in payouts]),
+                    ]))
+        payouts = [p for p in payouts if p.id not in imported]
+        if not payouts:
+            return
+
+        records = cls.create([{
+            'stripe_id': payout.id,
+            'gateway': gateway.id,
+            'amount': from_stripe_amount(payout.amount, payout.currency),
+            'currency_code': payout.currency.upper(),
+            'status': payout.status,
+            'arrival_date': datetime.utcfromtimestamp(
+                payout.arrival_date).date(),
+        } for payout in payouts])
+
+        fees = dict((record.id, Decimal(0)) for record in records)
+        page = []
+        for record, payout in zip(records, payouts):
+            for balance_transaction in stripe.BalanceTransaction.list(
+                    api_key=gateway.stripe_api_key, payout=payout.id,
+                    limit=page_size).auto_paging_iter():
+                fees[record.id] += from_stripe_amount(
+                    balance_transaction.fee, balance_transaction.currency
+                )
+                page.append((record, balance_transaction))
+                if len(page) == page_size:
+                    Fee.create_from_stripe(gateway, page)
+                    page = []
+        Fee.create_from_stripe(gateway, page)
+
+        to_write = []
+        for record in records:
+            to_write.extend([[record], {'fee': fees[record.id]}])
+        cls.write(*to_write)
+
+
+class StripeFee(ModelSQL, ModelView):
+    "Stripe Fee"
+    __name__ = 'payment_gateway.stripe.fee'
+    _rec_name = 'stripe_id'
+
+    stripe_id = fields.Char('Stripe ID', required=True, readonly=True)
+    payout = fields.Many2One(
+        'payment_gateway.stripe.payout', 'Payout', required=True,
+        readonly=True, select=True, ondelete='CASCADE'
+    )
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='RESTRICT'
+    )
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True, ondelete='RESTRICT'
+    )
+    source = fields.Char('Source', readonly=True)
+    type = fields.Char('Type', readonly=True)
+    date = fields.Date('Date', readonly=True, select=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    fee = fields.Numeric('Fee', digits=(16, 2), readonly=True)
+    net = fields.Numeric('Net', digits=(16, 2), readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeFee, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('stripe_id_uniq', Unique(table, table.gateway, table.stripe_id),
+                'A stripe balance transaction can only be imported once '
+                'per gateway.'),
+        ]
+
+    @classmethod
+    def create_from_stripe(cls, gateway, balance_transactions):
+        """
+        Create the lines of a page of stripe balance transactions, linked to
+        the transactions through their provider reference with a single
+        lookup.
+
+        :param gateway: The gateway the balance transactions belong to
+        :param balance_transactions: A list of tuples (payout, balance
+                                     transaction)
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        if not balance_transactions:
+            return []
+
+        transaction_ids = PaymentTransaction.get_ids_by_provider_reference(
+            gateway, [b.source for _, b in balance_transactions if b.source]
+        )
+        return cls.create([{
+            'stripe_id': b.id,
+            'payout': payout.id,
+            'gateway': gateway.id,
+            'transaction': transaction_ids.get(b.source),
+            'source': b.source,
+            'type': b.type,
+            'date': datetime.utcfromtimestamp(b.created).date(),
+            'amount': from_stripe_amount(b.amount, b.currency),
+            'fee': from_stripe_amount(b.fee, b.currency),
+            'net': from_stripe_amount(b.net, b.currency),
+            'currency_code': b.currency.upper(),
+        } for payout, b in balance_transactions])
+
+
+class StripeFeeDaily(ModelSQL, ModelView):
+    "Stripe Fees per Day"
+    __name__ = 'payment_gateway.stripe.fee.daily'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', readonly=True
+    )
+    date = fields.Date('Date', readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+    count = fields.Integer('Count', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    fee = fields.Numeric('Fee', digits=(16, 2), readonly=True)
+    net = fields.Numeric('Net', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeFeeDaily, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def table_query(cls):
+        Fee = Pool().get('payment_gateway.stripe.fee')
+        fee = Fee.__table__()
+
+        return fee.select(
+            Min(fee.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            fee.gateway, fee.date, fee.currency_code,
+            Count(fee.id).as_('count'),
+            Sum(fee.amount).as_('amount'),
+            Sum(fee.fee).as_('fee'),
+            Sum(fee.net).as_('net'),
+            group_by=[fee.gateway, fee.date, fee.currency_code],
+        )
+
+
+class PaymentTransactionFee:
+    __metaclass__ = PoolMeta
+    __name__ = 'payment_gateway.transaction'
+
+    stripe_fee = fields.Function(
+        fields.Numeric('Stripe Fee', digits=(16, 2)), 'get_stripe_fee'
+    )
+
+    @classmethod
+    def get_stripe_fee(cls, transactions, name):
+        """
+        Return the sum of the stripe fees of each transaction with one query
+        per slice of transactions
+        """
+        Fee = Pool().get('payment_gateway.stripe.fee')
+        fee = Fee.__table__()
+        cursor = Transaction().connection.cursor()
+
+        rv = dict((t.id, None) for t in transactions)
+        for sub_ids in grouped_slice([t.id for t in transactions]):
+            cursor.execute(*fee.select(
+                fee.transaction, Sum(fee.fee),
+                where=reduce_ids(fee.transaction, sub_ids),
+                group_by=[fee.transaction],
+            ))
+            for transaction_id, total in cursor.fetchall():
+                # SQLite returns the sum as a float
+                if not isinstance(total, Decimal):
+                    total = Decimal(str(total))
+                rv[transaction_id] = total
+        return rv
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+    profiling.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+from datetime import datetime
+from functools import wraps
+from collections import Counter
+from contextlib import contextmanager
+from thread import get_ident
+from threading import Thread, Event, local
+
+from trytond.pool import Pool
+from trytond.model import ModelSQL, ModelView, fields
+
+__all__ = [
+    'StripeProfile', 'StripeProfiler', 'profile_phase', 'stripe_profiled',
+]
+
+# Seconds between two samples of the profiled thread
+SAMPLE_INTERVAL = 0.005
+# Distinct stacks kept in a profile, the most frequent first
+MAX_STACKS = 200
+# The network phases recognised in the sampled stacks, the innermost frame
+# wins. Python 2 resolves the host name in C, so it counts as connect.
+NETWORK_PHASES = {
+    'create_connection': 'connect',
+    'do_handshake': 'tls',
+    'begin': 'server',
+}
+
+_local = local()
+
+
+class StripeProfiler(object):
+    """
+    A sampling profiler of the current thread.
+
+    Another thread records the stack of the profiled thread every
+    `interval` seconds while the phases (charge data, stripe request,
+    posting, ...) are timed by the profiled code with `profile_phase`.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.network = Counter()
+        self.phases = Counter()
+        self.started = None
+        self.duration = None
+        self._thread_id = None
+        self._stop = Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self._thread_id = get_ident()
+        self.started = time.time()
+        self._sampler = Thread(target=self._run)
+        self._sampler.daemon = True
+        self._sampler.start()
+        _local.profiler = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.profiler = None
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.time() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._thread_id)
+        stack, network = [], None
+        while frame is not None:
+            code = frame.f_code
+            if network is None:
+                network = NETWORK_PHASES.get(code.co_name)
+            stack.append('%s:%s' % (
+                os.path.splitext(os.path.basename(code.co_filename))[0],
+                code.co_name
+            ))
+            frame = frame.f_back
+        # The sampler itself is never on the stack of the profiled thread
+        self.stacks[';'.join(reversed(stack))] += 1
+        if network:
+            self.network[network] += 1
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - start
+
+    def get_phases(self):
+        """
+        Return the seconds spent by phase. The network phases are estimated
+        from the samples and are part of the stripe phase.
+        """
+        phases = dict(self.phases)
+        phases['total'] = self.duration
+        phases['other'] = max(self.duration - sum(self.phases.values()), 0)
+        for name, count in self.network.iteritems():
+            phases['stripe.%s' % name] = count * self.interval
+        return dict((k, round(v, 4)) for k, v in phases.iteritems())
+
+    def get_collapsed_stacks(self):
+        """
+        Return the stacks in the collapsed format of the flame graph tools,
+        one "frame;frame;frame count" per line
+        """
+        return '\n'.join(
+            '%s %s' % (stack, count)
+            for stack, count in self.stacks.most_common(MAX_STACKS)
+        )
+
+
+@contextmanager
+def profile_phase(name):
+    """
+    Time a phase of the operation profiled in the current thread, if any
+    """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
+
+
+def stripe_profiled(func):
+    """
+    Decorate an <operation>_stripe method of the transactions to profile it
+    when its gateway sets a threshold, and save the profile of the
+    operations slower than it.
+    """
+    operation = func.__name__[:-len('_stripe')]
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+
+        threshold = Gateway.get_stripe_config(self.gateway)[
+            'profile_threshold']
+        if not threshold or getattr(_local, 'profiler', None):
+            return func(self, *args, **kwargs)
+
+        started = datetime.utcnow()
+        with StripeProfiler() as profiler:
+            result = func(self, *args, **kwargs)
+        if profiler.duration >= threshold:
+            Profile = pool.get('payment_gateway.stripe.profile')
+            Profile.create_from_profiler(self, operation, profiler, started)
+        return result
+    return wrapper
+
+
+class StripeProfile(ModelSQL, ModelView):
+    """
+    Stripe Profile
+
+    The profile of a stripe operation slower than the threshold of its
+    gateway: the time spent in each phase and the sampled stacks.
+    """
+    __name__ = 'payment_gateway.stripe.profile'
+
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', required=True,
+        readonly=True, select=True, ondelete='CASCADE'
+    )
+    log = fields.Many2One(
+        'payment_gateway.transaction.log', 'Log', readonly=True,
+        ondelete='SET NULL',
+        help='The log of the transaction written by the operation'
+    )
+    operation = fields.Char('Operation', readonly=True)
+    duration = fields.Float('Duration', readonly=True, help='In seconds')
+    samples = fields.Integer('Samples', readonly=True)
+    phases = fields.Text(
+        'Phases', readonly=True, help='Seconds spent by phase, as JSON'
+    )
+    stacks = fields.Text(
+        'Stacks', readonly=True,
+        help='The sampled stacks, in the collapsed format of flame graphs'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeProfile, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def create_from_profiler(cls, transaction, operation, profiler, started):
+        """
+        Save the profile of an operation of the transaction
+
+        :param started: The UTC time the operation started, its log is the
+                        last one written since
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        logs = TransactionLog.search([
+            ('transaction', '=', transaction.id),
+            ('timestamp', '>=', started),
+        ], order=[('id', 'DESC')], limit=1)
+        return cls.create([{
+            'transaction': transaction.id,
+            'log': logs[0].id if logs else None,
+            'operation': operation,
+            'duration': profiler.duration,
+            'samples': sum(profiler.stacks.values()),
+            'phases': json.dumps(profiler.get_phases(), sort_keys=True),
+            'stacks': profiler.get_collapsed_stacks(),
+        }])[0]
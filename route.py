@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    route.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import random
+from itertools import groupby
+
+from sql import Null
+
+from trytond.model import ModelSQL, ModelView, MatchMixin, fields
+
+from .utils import stripe_gateway_health
+
+__all__ = ['StripeRoute']
+
+
+class StripeRoute(ModelSQL, ModelView, MatchMixin):
+    """
+    Stripe Route
+
+    A rule sending the new transactions of a currency or of a country to a
+    stripe gateway. The first routes matching a transaction share it by
+    weight, the next ones take over when their gateways fail too often.
+    """
+    __name__ = 'payment_gateway.stripe.route'
+
+    sequence = fields.Integer('Sequence')
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True,
+        domain=[('provider', '=', 'stripe')], ondelete='CASCADE'
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', ondelete='CASCADE',
+        help='Leave empty for all the currencies'
+    )
+    country = fields.Many2One(
+        'country.country', 'Country', ondelete='CASCADE',
+        help='Country of the address sent to stripe, leave empty for all '
+        'the countries'
+    )
+    weight = fields.Integer(
+        'Weight', required=True, domain=[('weight', '>=', 0)],
+        help='Share of the transactions among the routes of same sequence'
+    )
+    max_error_rate = fields.Float(
+        'Maximum Error Rate', required=True, digits=(16, 2),
+        help='Rate of the requests failing because of stripe or of the '
+        'network over the last minutes above which the gateway is skipped'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeRoute, cls).__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
+
+    @staticmethod
+    def order_sequence(tables):
+        table, _ = tables[None]
+        return [table.sequence == Null, table.sequence]
+
+    @staticmethod
+    def default_weight():
+        return 1
+
+    @staticmethod
+    def default_max_error_rate():
+        return 0.5
+
+    @classmethod
+    def get_gateway(cls, pattern, routes=None):
+        """
+        Return the gateway of the routes matching the pattern, or None if
+        no route matches.
+
+        The routes are tried by sequence: a gateway is picked at random by
+        weight among the healthy ones of the first sequence having one. If
+        none is healthy, the first routes are used anyway.
+
+        :param pattern: A dictionary with the currency and the country ids
+        :param routes: The routes to match, ordered, by default all of them
+        """
+        if routes is None:
+            routes = cls.search([])
+        routes = [r for r in routes if r.match(pattern)]
+        groups = [list(g) for _, g in groupby(routes, lambda r: r.sequence)]
+        for group in groups:
+            healthy = [
+                r for r in group if stripe_gateway_health.is_healthy(
+                    r.gateway.id, r.max_error_rate
+                )
+            ]
+            if healthy:
+                return cls._pick(healthy).gateway
+        if groups:
+            return cls._pick(groups[0]).gateway
+
+    @staticmethod
+    def _pick(routes):
+        """
+        Return one of the routes at random by weight
+        """
+        point = random.uniform(0, sum(r.weight for r in routes))
+        for route in routes:
+            point -= route.weight
+            if point <= 0:
+                break
+        return route
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+    settlement.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, ModelView, fields
+
+__all__ = ['StripeSettlementRun']
+
+
+class StripeSettlementRun(ModelSQL, ModelView):
+    """
+    Stripe Settlement Run
+
+    Statistics of a run of the automatic settlement of the stripe
+    authorizations.
+    """
+    __name__ = 'payment_gateway.stripe.settlement.run'
+
+    duration = fields.Float('Duration', readonly=True, help='In seconds')
+    selected = fields.Integer(
+        'Selected', readonly=True,
+        help='Number of authorizations old enough to be settled'
+    )
+    settled = fields.Integer('Settled', readonly=True)
+    skipped = fields.Integer(
+        'Skipped', readonly=True, help='Already captured on stripe'
+    )
+    failed = fields.Integer('Failed', readonly=True)
+    remaining = fields.Integer(
+        'Remaining', readonly=True,
+        help='Left to the next run once the time budget was spent'
+    )
+    throughput = fields.Float(
+        'Throughput', readonly=True, digits=(16, 2),
+        help='Transactions processed per second'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeSettlementRun, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
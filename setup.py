@@ -20,7 +20,7 @@ major_version = int(major_version)
 minor_version = int(minor_version)
 
 requires = [
-    'stripe<2.0,>=1.0'
+    'stripe<2.0,>=1.70'
 ]
 
 MODULE2PREFIX = {
@@ -79,7 +79,9 @@ setup(
     entry_points="""
     [trytond.modules]
     %s = trytond.modules.%s
-    """ % (MODULE, MODULE),
+    [console_scripts]
+    trytond-stripe-worker = trytond.modules.%s.job:main
+    """ % (MODULE, MODULE, MODULE),
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
 )
@@ -6,13 +6,30 @@
     :license: see LICENSE for more details.
 """
 import os
+import glob
+import json
 import time
+import fcntl
+import shutil
+import hashlib
 import datetime
+import tempfile
+import threading
+from itertools import count
+from urlparse import parse_qs
 from collections import namedtuple
+from contextlib import contextmanager
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from sql import Flavor
+from trytond import backend
 from trytond.config import config
 from trytond.pool import Pool
 from dateutil.relativedelta import relativedelta
 import pytest
+import stripe
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 def pytest_addoption(parser):
@@ -29,54 +46,363 @@ def pytest_addoption(parser):
         "--reset-db", action="store_true", default=False,
         help="Clear local database and initialise"
         )
+    parser.addoption(
+        "--db-cache", action="store", default=None,
+        help="Directory of the template databases with the module installed "
+        "and the dataset, shared by the workers of pytest-xdist"
+        )
+    parser.addoption(
+        "--load", action="store_true", default=False,
+        help="Run the load test of the checkouts, on postgres only"
+        )
+    parser.addoption(
+        "--load-clients", action="store", default="1,2,4,8,16,32",
+        help="Comma separated numbers of concurrent clients to simulate"
+        )
+    parser.addoption(
+        "--load-duration", action="store", type=float, default=30,
+        help="Seconds each number of clients is simulated for"
+        )
+    parser.addoption(
+        "--load-latency", action="store", default="lognormal:250:0.5",
+        help="Latency of the fake stripe in milliseconds: const:<ms>, "
+        "uniform:<min>:<max> or lognormal:<median>:<sigma>"
+        )
+    parser.addoption(
+        "--load-mix", action="store",
+        default="capture=6,authorize_settle=3,refund=1",
+        help="Relative weights of the simulated checkouts"
+        )
 
 
 @pytest.fixture(scope='session', autouse=True)
 def install_module(request):
     """Install tryton module in specified database.
-     """
-    reuse_db = request.config.getoption("--reuse-db")
 
-    if request.config.getoption("--db") == 'sqlite':
-        os.environ['TRYTOND_DATABASE_URI'] = "sqlite://"
-        if reuse_db:
-            # A hack to check if the database exists and if it
-            # does, load that and run tests.
-            Database = backend.get('Database')
+    Each pytest-xdist worker gets its own database. With a cache directory,
+    which the workers of a run always share, the database with the module
+    installed and the dataset is created once as a template and copied for
+    each worker and each run until the sources change.
+    """
+    db_type = request.config.getoption("--db")
+    reuse_db = request.config.getoption("--reuse-db")
+    cache_dir = None if reuse_db else get_cache_dir(request.config)
+    set_database_name(db_type, reuse_db, cache_dir)
+    db_name = os.environ['DB_NAME']
+    request.config.stripe_dataset_ids = None
 
+    if reuse_db:
+        Database = backend.get('Database')
+        if db_type == 'sqlite':
             # cursor.test forgets to set flavor!
             # no time to report a bug!
             Flavor.set(Database.flavor)
-            os.environ['DB_NAME'] = 'fulfilio'
+        database = Database().connect()
+        if db_name in database.list():
+            if request.config.getoption("--reset-db"):
+                connection = database.get_connection(autocommit=True)
+                database.drop(connection, db_name)
+                database.put_connection(connection)
+            else:
+                # tryton test forgets to init the pool
+                # for existing database
+                Pool(db_name).init()
+
+    if not cache_dir:
+        from trytond.tests import test_tryton
+        test_tryton.install_module('payment_gateway_stripe')
+        return
+
+    template = TemplateDatabase(cache_dir, db_type)
+    with template.lock():
+        if template.exists():
+            template.restore(db_name)
+            Pool(db_name).init()
+            from trytond.tests import test_tryton
+            test_tryton.install_module('payment_gateway_stripe')
+            request.config.stripe_dataset_ids = template.load_dataset_ids()
+            load_preferences()
+        else:
+            template.drop_database(db_name)
+            from trytond.tests import test_tryton
+            test_tryton.install_module('payment_gateway_stripe')
+            request.config.stripe_dataset_ids = create_dataset()
+            template.save(db_name, request.config.stripe_dataset_ids)
+
+
+def set_database_name(db_type, reuse_db, cache_dir):
+    """
+    Set the database of the worker in the environment read by trytond
+    """
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    suffix = '_' + worker if worker else ''
+
+    if db_type == 'sqlite':
+        os.environ['TRYTOND_DATABASE_URI'] = "sqlite://"
+        if reuse_db:
+            os.environ['DB_NAME'] = 'fulfilio' + suffix
+        elif cache_dir:
+            # Only a file can be copied from the template
+            os.environ['DB_NAME'] = 'test' + suffix
         else:
             os.environ['DB_NAME'] = ':memory:'
 
-    elif request.config.getoption("--db") == 'postgres':
+    elif db_type == 'postgres':
         os.environ['TRYTOND_DATABASE_URI'] = "postgresql://"
         if reuse_db:
-            os.environ['DB_NAME'] = 'test_fulfilio'
+            os.environ['DB_NAME'] = 'test_fulfilio' + suffix
         else:
-            os.environ['DB_NAME'] = 'test_' + str(int(time.time()))
+            os.environ['DB_NAME'] = 'test_%s%s' % (int(time.time()), suffix)
 
-    if reuse_db:
+    config.set('database', 'uri', os.environ['TRYTOND_DATABASE_URI'])
+
+
+def get_cache_dir(config):
+    """
+    Return the directory of the template databases, if any
+    """
+    cache_dir = config.getoption("--db-cache")
+    if not cache_dir and hasattr(config, 'workerinput'):
+        # The workers of a pytest-xdist run share the template of the run
+        cache_dir = os.path.join(
+            tempfile.gettempdir(),
+            'payment_gateway_stripe_%s' % config.workerinput['testrunuid']
+        )
+    if cache_dir and not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created meanwhile by another worker
+            if not os.path.isdir(cache_dir):
+                raise
+    return cache_dir
+
+
+class TemplateDatabase(object):
+    """
+    A database with the module installed and the dataset, named after the
+    sources of the module so a change of the module or of the dataset
+    builds a new one
+    """
+
+    def __init__(self, cache_dir, db_type):
+        self.cache_dir = cache_dir
+        self.db_type = db_type
+        digest = hashlib.sha1(db_type)
+        for pattern in [
+                '*.py', '*.xml', '*.cfg', 'view/*.xml', 'tests/conftest.py']:
+            for path in sorted(glob.glob(os.path.join(MODULE_DIR, pattern))):
+                with open(path, 'rb') as source:
+                    digest.update(source.read())
+        self.key = digest.hexdigest()[:16]
+        self.path = os.path.join(
+            cache_dir, 'payment_gateway_stripe_' + self.key
+        )
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the template while it is built or copied, the other workers
+        wait for it
+        """
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @property
+    def name(self):
+        return 'test_template_' + self.key
+
+    @staticmethod
+    def sqlite_path(db_name):
+        return os.path.join(
+            config.get('database', 'path'), db_name + '.sqlite'
+        )
+
+    def _execute(self, query):
         Database = backend.get('Database')
         database = Database().connect()
-        cursor = database.cursor()
-        databases = database.list(cursor)
-        cursor.close()
-        if os.environ['DB_NAME'] in databases:
-            if request.config.getoption("--reset-db"):
-                    cursor = database.cursor()
-                    databases = database.drop(cursor, os.environ['DB_NAME'])
-                    cursor.close()
-            else:
-                # tryton test forgets to init the pool
-                # for existing database
-                Pool(os.environ['DB_NAME']).init()
+        connection = database.get_connection(autocommit=True)
+        try:
+            connection.cursor().execute(query)
+        finally:
+            database.put_connection(connection)
+        # The list of the databases is cached
+        Database._list_cache = None
+
+    def exists(self):
+        if not os.path.isfile(self.path + '.json'):
+            return False
+        if self.db_type == 'sqlite':
+            return os.path.isfile(self.path + '.sqlite')
+        return self.name in backend.get('Database')().connect().list()
+
+    def drop_database(self, db_name):
+        """
+        Drop a database left by a previous run
+        """
+        if self.db_type == 'sqlite':
+            if os.path.isfile(self.sqlite_path(db_name)):
+                os.remove(self.sqlite_path(db_name))
+        elif db_name in backend.get('Database')().connect().list():
+            self._execute('DROP DATABASE "%s"' % db_name)
+
+    def save(self, db_name, dataset_ids):
+        """
+        Copy the database to the template
+        """
+        # No other session may use a template of postgres
+        backend.get('Database')(db_name).close()
+        if self.db_type == 'sqlite':
+            shutil.copyfile(self.sqlite_path(db_name), self.path + '.sqlite')
+        else:
+            self.drop_database(self.name)
+            self._execute(
+                'CREATE DATABASE "%s" TEMPLATE "%s"' % (self.name, db_name)
+            )
+        with open(self.path + '.json', 'w') as ids_file:
+            json.dump(dataset_ids, ids_file)
+
+    def restore(self, db_name):
+        """
+        Copy the template to the database
+        """
+        if self.db_type == 'sqlite':
+            shutil.copyfile(self.path + '.sqlite', self.sqlite_path(db_name))
+        else:
+            self.drop_database(db_name)
+            self._execute(
+                'CREATE DATABASE "%s" TEMPLATE "%s"' % (db_name, self.name)
+            )
 
-    config.set('database', 'uri', os.environ['TRYTOND_DATABASE_URI'])
-    from trytond.tests import test_tryton
-    test_tryton.install_module('payment_gateway_stripe')
+    def load_dataset_ids(self):
+        with open(self.path + '.json') as ids_file:
+            return json.load(ids_file)
+
+
+class FakeStripeServer(ThreadingMixIn, HTTPServer):
+    """
+    Answer the charges, captures, cancellations and refunds like stripe,
+    after a random latency
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=lambda: 0):
+        # Each worker listens on its own port, picked by the system
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeStripeHandler)
+        self.latency = latency
+        self.ids = count(1)
+        # The requests received and the responses by idempotency key
+        self.requests = []
+        self.responses = {}
+
+    @property
+    def api_base(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # Keep the connections open as stripe does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        params = dict(
+            (k, v[0]) for k, v in parse_qs(self.rfile.read(
+                int(self.headers.get('Content-Length') or 0)
+            )).iteritems()
+        )
+        path = self.path.split('?')[0]
+        parts = path.strip('/').split('/')
+        self.server.requests.append((self.command, path))
+        key = self.headers.get('Idempotency-Key')
+        if key in self.server.responses:
+            # Stripe answers a key with the same answer
+            self.send_body(self.server.responses[key])
+            return
+        time.sleep(self.server.latency())
+        number = next(self.server.ids)
+
+        if parts[1:] == ['customers']:
+            body = {
+                'id': 'cus_fake_%s' % number, 'object': 'customer',
+                'email': params.get('email'),
+                'description': params.get('description'),
+            }
+        elif parts[1] == 'customers' and parts[3:] == ['sources']:
+            # A token or the raw card data
+            body = {
+                'id': 'card_fake_%s' % number, 'object': 'card',
+                'customer': parts[2], 'brand': 'Visa',
+                'last4': params.get('source[number]', '4242')[-4:],
+                'exp_month': int(params.get('source[exp_month]', 12)),
+                'exp_year': int(params.get('source[exp_year]', 2030)),
+                'name': params.get('source[name]'),
+            }
+        elif parts[1:] == ['charges']:
+            body = {
+                'id': 'ch_load_%s' % number, 'object': 'charge',
+                'status': 'succeeded', 'amount': int(params['amount']),
+                'currency': params['currency'],
+                'captured': params.get('capture') == 'true',
+            }
+        elif parts[1] == 'charges' and parts[3:] in (['capture'], ['refund']):
+            body = {
+                'id': parts[2], 'object': 'charge', 'status': 'succeeded',
+                'captured': parts[3] == 'capture',
+                'refunded': parts[3] == 'refund',
+            }
+        elif parts[1:] == ['refunds']:
+            body = {
+                'id': 're_load_%s' % number, 'object': 'refund',
+                'status': 'succeeded', 'charge': params['charge'],
+                'amount': int(params['amount']),
+            }
+        else:
+            self.send_error(404)
+            return
+
+        if key:
+            self.server.responses[key] = body
+        self.send_body(body)
+
+    def send_body(self, body):
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.yield_fixture(scope='session')
+def fake_stripe_server():
+    """Run a fake stripe for the session of the worker
+    """
+    server = FakeStripeServer()
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.yield_fixture()
+def fake_stripe(fake_stripe_server):
+    """Send the stripe requests of the test to the fake stripe
+    """
+    api_base, stripe.api_base = stripe.api_base, fake_stripe_server.api_base
+    latency = fake_stripe_server.latency
+    del fake_stripe_server.requests[:]
+    yield fake_stripe_server
+    stripe.api_base = api_base
+    fake_stripe_server.latency = latency
 
 
 @pytest.yield_fixture()
@@ -108,6 +434,89 @@ def transaction(request):
 def dataset(request):
     """Create minimal data needed for testing
     """
+    from trytond.tests.test_tryton import POOL
+
+    ids = request.config.stripe_dataset_ids
+    if ids is None:
+        # Not taken from a template
+        ids = create_dataset()
+
+    def get():
+        return namedtuple('Dataset', ids.keys())(**dict(
+            (key, POOL.get(model)(id_))
+            for key, (model, id_) in ids.iteritems()
+        ))
+
+    return get
+
+
+@pytest.fixture()
+def stripe_profile(dataset):
+    """Return a function creating a stripe card profile of the customer,
+    the values given replace the default ones
+    """
+    from trytond.tests.test_tryton import POOL
+
+    def create(**values):
+        PaymentProfile = POOL.get('party.payment_profile')
+        data = dataset()
+        profile, = PaymentProfile.create([dict({
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'provider_reference': 'card_1',
+            'stripe_customer_id': 'cus_1',
+            'last_4_digits': '4242',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        }, **values)])
+        return profile
+
+    return create
+
+
+@pytest.fixture()
+def stripe_send(monkeypatch):
+    """Return a function replacing the requests the ledger sends to stripe.
+
+    The replacement is called with the api key, the operation, the
+    idempotency key and the parameters of the request. It returns the
+    response or raises a stripe error, the dictionaries are returned as
+    charges.
+    """
+    from trytond.tests.test_tryton import POOL
+
+    def stub(func):
+        StripeRequest = POOL.get('payment_gateway.stripe.request')
+
+        def send(cls, api_key, operation, key, params, client=None):
+            response = func(api_key, operation, key, params)
+            if not isinstance(response, stripe.StripeObject):
+                response = stripe.Charge.construct_from(response, api_key)
+            return response
+        monkeypatch.setattr(StripeRequest, 'send', classmethod(send))
+
+    return stub
+
+
+def load_preferences():
+    """
+    Set the company of the user in the context of the tests
+    """
+    from trytond.transaction import Transaction
+    from trytond.tests.test_tryton import USER, CONTEXT, DB_NAME, POOL
+
+    User = POOL.get('res.user')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        CONTEXT.update(User.get_preferences(context_only=True))
+
+
+def create_dataset():
+    """
+    Create the dataset and return the model and the id of its records by
+    name
+    """
     from trytond.transaction import Transaction
     from trytond.tests.test_tryton import USER, CONTEXT, DB_NAME, POOL
 
@@ -270,22 +679,13 @@ def dataset(request):
         )
         stripe_gateway.save()
 
-        result = {
-            'customer': customer,
-            'company': company,
-            'stripe_gateway': stripe_gateway,
-        }
+        result = dict(
+            (key, (record.__name__, record.id)) for key, record in {
+                'customer': customer,
+                'company': company,
+                'stripe_gateway': stripe_gateway,
+            }.iteritems()
+        )
 
         transaction.commit()
-
-    def get():
-        from trytond.model import Model
-
-        for key, value in result.iteritems():
-            if isinstance(value, Model):
-                result[key] = value.__class__(value.id)
-        return namedtuple('Dataset', result.keys())(**result)
-
-    return get
-
-
+    return result
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_load.py
+
+    Simulate concurrent checkouts against a fake stripe to find how many
+    operations per second a trytond node sustains with this module:
+
+        py.test tests/test_load.py --db=postgres --load
+
+    :copyright: (C) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import random
+import threading
+from decimal import Decimal
+
+import pytest
+# Importing transaction directly causes cyclic dependency in 3.6
+from trytond.tools.singleton import Singleton  # noqa
+from trytond import backend
+from trytond.transaction import Transaction
+
+
+def parse_latency(spec):
+    """
+    Return a function returning the latency of a fake stripe request in
+    seconds, from a specification in milliseconds like lognormal:250:0.5
+    """
+    kind, args = spec.split(':', 1)
+    args = [float(a) for a in args.split(':')]
+    if kind == 'const':
+        return lambda: args[0] / 1000
+    elif kind == 'uniform':
+        return lambda: random.uniform(*args) / 1000
+    elif kind == 'lognormal':
+        median, sigma = args
+        return lambda: median * random.lognormvariate(0, sigma) / 1000
+    raise ValueError('Unknown latency distribution: %s' % kind)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * pct / 100.), len(values) - 1)]
+
+
+class LockMonitor(object):
+    """
+    Sample the number of sessions waiting for a lock on postgres, and count
+    the deadlocks detected meanwhile
+    """
+
+    def __init__(self, database_name, interval=0.1):
+        self.database_name = database_name
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+
+    def _execute(self, cursor, query, *args):
+        cursor.execute(query, args)
+        return cursor.fetchone()[0]
+
+    def _deadlocks(self, cursor):
+        return self._execute(
+            cursor, 'SELECT deadlocks FROM pg_stat_database '
+            'WHERE datname = %s', self.database_name
+        )
+
+    def _run(self, cursor):
+        while not self._stop.wait(self.interval):
+            self.samples.append(self._execute(
+                cursor, 'SELECT COUNT(*) FROM pg_locks WHERE NOT granted'
+            ))
+
+    def __enter__(self):
+        Database = backend.get('Database')
+        self._database = Database(self.database_name).connect()
+        self._connection = self._database.get_connection(autocommit=True)
+        self._cursor = self._connection.cursor()
+        self.deadlocks = self._deadlocks(self._cursor)
+        self._thread = threading.Thread(target=self._run, args=(
+            self._connection.cursor(),
+        ))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        # The statistics collector lags a little
+        time.sleep(0.5)
+        self.deadlocks = self._deadlocks(self._cursor) - self.deadlocks
+        self._database.put_connection(self._connection, close=True)
+
+    def stats(self):
+        samples = self.samples or [0]
+        return {
+            'lock_waiters_avg': float(sum(samples)) / len(samples),
+            'lock_waiters_max': max(samples),
+            # Seconds spent waiting for locks by all sessions together
+            'lock_wait': sum(samples) * self.interval,
+            'deadlocks': self.deadlocks,
+        }
+
+
+@pytest.mark.skipif(
+    "not config.getoption('--load') or config.getoption('--db') != 'postgres'"
+)
+class TestLoad:
+
+    def setup_checkouts(self, dataset):
+        from trytond.tests.test_tryton import USER, CONTEXT, DB_NAME, POOL
+
+        PaymentProfile = POOL.get('party.payment_profile')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            data = dataset()
+            payment_profile, = PaymentProfile.create([{
+                'party': data.customer.id,
+                'address': data.customer.addresses[0].id,
+                'gateway': data.stripe_gateway.id,
+                'provider_reference': 'card_load',
+                'stripe_customer_id': 'cus_load',
+                'last_4_digits': '4242',
+                'expiry_month': '01',
+                'expiry_year': '2030',
+            }])
+            return {
+                'party': data.customer.id,
+                'credit_account': data.customer.account_receivable.id,
+                'address': data.customer.addresses[0].id,
+                'payment_profile': payment_profile.id,
+                'gateway': data.stripe_gateway.id,
+                'amount': Decimal('10.10'),
+            }
+
+    def teardown_checkouts(self, values):
+        """
+        Delete the payment profile committed by setup_checkouts from the
+        session database, with the checkouts which restrict its deletion and
+        the card deletion it queues in the ledger
+        """
+        from trytond.tests.test_tryton import USER, CONTEXT, DB_NAME, POOL
+
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentProfile = POOL.get('party.payment_profile')
+        StripeRequest = POOL.get('payment_gateway.stripe.request')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            PaymentTransaction.delete(PaymentTransaction.search([
+                ('payment_profile', '=', values['payment_profile']),
+            ]))
+            PaymentProfile.delete([
+                PaymentProfile(values['payment_profile'])
+            ])
+            StripeRequest.delete(StripeRequest.search([
+                ('key', '=', 'source_delete_card_load'),
+            ]))
+
+    def request(self, name, func, latencies, errors):
+        """
+        Run the function in its own transaction like a request to trytond
+        does, and record its latency
+        """
+        from trytond.tests.test_tryton import USER, CONTEXT, DB_NAME
+
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        start = time.time()
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                result = func()
+        except DatabaseOperationalError:
+            errors.append(name)
+            return None
+        latencies.append((name, time.time() - start))
+        return result
+
+    def checkout_capture(self, values, latencies, errors):
+        from trytond.tests.test_tryton import POOL
+
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        def capture():
+            transaction, = PaymentTransaction.create([values])
+            transaction.capture_stripe()
+            return transaction.id
+        return self.request('capture', capture, latencies, errors)
+
+    def checkout_authorize_settle(self, values, latencies, errors):
+        from trytond.tests.test_tryton import POOL
+
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        def authorize():
+            transaction, = PaymentTransaction.create([values])
+            transaction.authorize_stripe()
+            return transaction.id
+
+        def settle():
+            PaymentTransaction(transaction_id).settle_stripe()
+
+        transaction_id = self.request(
+            'authorize', authorize, latencies, errors
+        )
+        if transaction_id is not None:
+            self.request('settle', settle, latencies, errors)
+
+    def checkout_refund(self, values, latencies, errors):
+        from trytond.tests.test_tryton import POOL
+
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        def refund():
+            PaymentTransaction(transaction_id).create_refund().refund_stripe()
+
+        transaction_id = self.checkout_capture(values, latencies, errors)
+        if transaction_id is not None:
+            self.request('refund', refund, latencies, errors)
+
+    def run_clients(self, clients, duration, mix, values):
+        """
+        Run the clients for the duration and return their statistics
+        """
+        from trytond.tests.test_tryton import DB_NAME
+
+        latencies, errors = [], []
+        checkouts = [getattr(self, 'checkout_%s' % name) for name, _ in mix]
+        weights = [weight for _, weight in mix]
+
+        def client(deadline):
+            rng = random.Random()
+            while time.time() < deadline:
+                pick = rng.uniform(0, sum(weights))
+                for checkout, weight in zip(checkouts, weights):
+                    pick -= weight
+                    if pick <= 0:
+                        break
+                checkout(values, latencies, errors)
+
+        with LockMonitor(DB_NAME) as monitor:
+            start = time.time()
+            threads = [
+                threading.Thread(target=client, args=(start + duration,))
+                for _ in xrange(clients)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+
+        durations = [latency for _, latency in latencies]
+        by_operation = {}
+        for name, latency in latencies:
+            by_operation.setdefault(name, []).append(latency)
+        stats = {
+            'clients': clients,
+            'requests': len(durations),
+            'throughput': len(durations) / elapsed,
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+            'errors': len(errors),
+            'by_operation': dict(
+                (name, percentile(operation_durations, 95))
+                for name, operation_durations in by_operation.iteritems()
+            ),
+        }
+        stats.update(monitor.stats())
+        return stats
+
+    def test_checkout_load(self, request, dataset, fake_stripe):
+        """
+        Report the throughput and latency curve of the checkouts for an
+        increasing number of concurrent clients
+        """
+        getoption = request.config.getoption
+        reporter = request.config.pluginmanager.getplugin('terminalreporter')
+
+        mix = [
+            (name, float(weight)) for name, weight in (
+                item.split('=') for item in getoption('--load-mix').split(',')
+            )
+        ]
+        fake_stripe.latency = parse_latency(getoption('--load-latency'))
+
+        values = self.setup_checkouts(dataset)
+        try:
+            curve = [
+                self.run_clients(
+                    int(clients), getoption('--load-duration'), mix, values
+                ) for clients in getoption('--load-clients').split(',')
+            ]
+        finally:
+            self.teardown_checkouts(values)
+
+        reporter.write_line('')
+        reporter.write_line(
+            '%7s %9s %9s %8s %8s %8s %7s %11s %9s %9s' % (
+                'clients', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                'errors', 'lock waits', 'lock s', 'deadlocks'
+            )
+        )
+        for stats in curve:
+            reporter.write_line(
+                '%(clients)7d %(requests)9d %(throughput)9.1f %(p50)8.0f '
+                '%(p95)8.0f %(p99)8.0f %(errors)7d %(lock_waiters_avg)5.1f/'
+                '%(lock_waiters_max)-5d %(lock_wait)9.1f %(deadlocks)9d' %
+                dict(stats, **dict(
+                    (k, stats[k] * 1000) for k in ('p50', 'p95', 'p99')
+                ))
+            )
+            reporter.write_line('%7s p95 ms by operation: %s' % ('', ', '.join(
+                '%s %.0f' % (name, latency * 1000)
+                for name, latency in sorted(stats['by_operation'].items())
+            )))
+
+        # The sustained throughput is the best one before the latency
+        # doubles compared to a single client
+        baseline = curve[0]['p95']
+        sustained = max(
+            [s for s in curve if s['p95'] <= 2 * baseline] or curve[:1],
+            key=lambda s: s['throughput']
+        )
+        reporter.write_line(
+            'Sustained: %.1f req/s with %d clients' % (
+                sustained['throughput'], sustained['clients']
+            )
+        )
+        assert all(s['requests'] for s in curve)
@@ -5,13 +5,19 @@
     :copyright: (C) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import json
+import time
+import datetime
+import threading
 from decimal import Decimal
+from urllib import urlencode
 
 import stripe
 import pytest
 # Importing transaction directly causes cyclic dependency in 3.6
 from trytond.tools.singleton import Singleton  # noqa
 from trytond.transaction import Transaction
+from trytond.pyson import PYSONDecoder
 from trytond.exceptions import UserError
 from trytond.config import config
 
@@ -444,3 +450,1779 @@ class TestPaymentGateway:
         assert card.address_zip == payment_profile.address.zip
         assert card.address_state == payment_profile.address.subdivision.name
         assert card.address_country == payment_profile.address.country.name
+
+    def test_transaction_capture_using_token(
+            self, dataset, transaction, fake_stripe):
+        """
+        Capture a transaction and add a payment profile using a token
+        created on the client instead of the raw card data
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        UseCardView = self.POOL.get('payment_gateway.transaction.use_card.view')
+        ProfileWizard = self.POOL.get(
+            'party.party.payment_profile.add', type="wizard"
+        )
+        data = dataset()
+
+        transaction1, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        }])
+        transaction1.capture_stripe(card_info=UseCardView(
+            stripe_token='tok_visa',
+        ))
+        assert transaction1.state == 'posted'
+
+        profile_wizard = ProfileWizard(ProfileWizard.create()[0])
+        profile_wizard.card_info.owner = data.customer.name
+        profile_wizard.card_info.stripe_token = 'tok_visa'
+        profile_wizard.card_info.gateway = data.stripe_gateway
+        profile_wizard.card_info.provider = data.stripe_gateway.provider
+        profile_wizard.card_info.address = data.customer.addresses[0]
+        profile_wizard.card_info.party = data.customer
+
+        with Transaction().set_context(return_profile=True):
+            payment_profile = profile_wizard.transition_add()
+
+        assert payment_profile.last_4_digits == '4242'
+        assert payment_profile.expiry_month == '12'
+        assert payment_profile.expiry_year == '2030'
+        assert payment_profile.name == data.customer.name
+        assert payment_profile.stripe_customer_id is not None
+        assert getattr(profile_wizard.card_info, 'number', None) is None
+
+    def test_stripe_charge_data_using_token(self, dataset, transaction):
+        """
+        Charge data for a token must not carry any card data and must be
+        smaller than the raw card request
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        UseCardView = self.POOL.get('payment_gateway.transaction.use_card.view')
+        data = dataset()
+
+        transaction1, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        }])
+
+        token_data = transaction1.get_stripe_charge_data(
+            card_info=UseCardView(stripe_token='tok_visa')
+        )
+        card_data = transaction1.get_stripe_charge_data(
+            card_info=UseCardView(
+                number=DUMMY_CARD['number'],
+                expiry_month=DUMMY_CARD['exp_month'],
+                expiry_year=DUMMY_CARD['exp_year'],
+                csc=DUMMY_CARD['csc'],
+                owner=data.customer.name,
+            )
+        )
+
+        assert token_data['source'] == 'tok_visa'
+        assert DUMMY_CARD['number'] not in urlencode(token_data)
+        assert len(urlencode(token_data)) < len(urlencode(card_data))
+
+        # The token can be entered and replaces the raw card fields
+        card_fields = UseCardView.fields_get()
+        assert not card_fields['stripe_token'].get('readonly')
+        assert 'stripe_token' in UseCardView.fields_view_get()['fields']
+        for name in ('number', 'expiry_month', 'expiry_year', 'csc'):
+            states = PYSONDecoder({
+                'card_present': False, 'stripe_token': 'tok_visa',
+            }).decode(card_fields[name]['states'])
+            assert not states['required']
+            assert states['invisible']
+
+            states = PYSONDecoder({
+                'card_present': False, 'stripe_token': None,
+            }).decode(card_fields[name]['states'])
+            assert states['required']
+            assert not states.get('invisible')
+
+    def test_stripe_customer_idempotency_key(self, dataset, transaction):
+        """
+        Simultaneous customer creations for a party on a gateway must share
+        the idempotency key, other parties must not
+        """
+        Party = self.POOL.get('party.party')
+        data = dataset()
+
+        other_party, = Party.create([{
+            'name': 'Jane Doe',
+        }])
+
+        def get_key(party):
+            return party._get_stripe_customer_idempotency_key(
+                data.stripe_gateway,
+                party._get_stripe_customer_data(data.stripe_gateway)
+            )
+
+        assert get_key(data.customer) == get_key(data.customer)
+        assert get_key(data.customer) != get_key(other_party)
+
+    def test_stripe_customer_coalescing(
+            self, dataset, transaction, fake_stripe):
+        """
+        Creating the customer simultaneously for the same party and gateway
+        reaches stripe once and returns the same stripe customer
+        """
+        StripeRequest = self.POOL.get('payment_gateway.stripe.request')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        customer_data = data.customer._get_stripe_customer_data(gateway)
+        key = data.customer._get_stripe_customer_idempotency_key(
+            gateway, customer_data
+        )
+        # The requests are still in flight when the others are sent
+        fake_stripe.latency = lambda: 0.2
+
+        # The threads have no transaction, they only send the request
+        api_key = gateway.stripe_api_key
+        customers, errors = [], []
+
+        def create():
+            try:
+                customers.append(StripeRequest.send(
+                    api_key, 'customer', key, customer_data
+                ))
+            except Exception, exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert len(customers) == 4
+        assert len(set(customer.id for customer in customers)) == 1
+        assert fake_stripe.requests == [('POST', '/v1/customers')]
+
+        # Created again later, stripe answers with the same customer
+        customer = data.customer._create_stripe_customer(gateway)
+        assert customer.id == customers[0].id
+
+    def test_match_stripe_customers_for_import(self, dataset, transaction):
+        """
+        Stripe customers are matched to parties by the party id in their
+        metadata or by email
+        """
+        Party = self.POOL.get('party.party')
+        data = dataset()
+
+        other_party, = Party.create([{
+            'name': 'Jane Doe',
+            'contact_mechanisms': [('create', [{
+                'type': 'email',
+                'value': 'Jane@example.com',
+            }])],
+        }])
+        customers = [
+            stripe.Customer.construct_from({
+                'id': 'cus_metadata', 'email': None,
+                'metadata': {'party_id': str(data.customer.id)},
+            }, 'sk_test'),
+            stripe.Customer.construct_from({
+                'id': 'cus_email', 'email': 'jane@example.com',
+                'metadata': {},
+            }, 'sk_test'),
+            stripe.Customer.construct_from({
+                'id': 'cus_unknown', 'email': 'nobody@example.com',
+                'metadata': {},
+            }, 'sk_test'),
+        ]
+
+        gateway = data.stripe_gateway
+        matches = gateway._match_stripe_customers(
+            customers, gateway._get_party_by_email()
+        )
+
+        assert [(c.id, p.id) for c, p in matches] == [
+            ('cus_metadata', data.customer.id),
+            ('cus_email', other_party.id),
+        ]
+
+    def test_import_stripe_customers(self, dataset, transaction, monkeypatch):
+        """
+        Import the stripe customers page by page, keeping the profiles and
+        the cursor of the pages imported before an error
+        """
+        CustomerImport = self.POOL.get(
+            'payment_gateway.stripe.customer_import'
+        )
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        def customer(number):
+            return {
+                'id': 'cus_%d' % number, 'object': 'customer', 'email': None,
+                'metadata': {'party_id': str(data.customer.id)},
+                'sources': {'object': 'list', 'has_more': False, 'data': [{
+                    'id': 'card_%d' % number, 'object': 'card',
+                    'name': data.customer.name, 'last4': '4242',
+                    'exp_month': 1, 'exp_year': 2030,
+                }]},
+            }
+
+        pages = {
+            None: ([customer(1), customer(2)], True),
+            'cus_2': ([customer(3)], False),
+        }
+        calls = []
+
+        def list_(**params):
+            calls.append(params.get('starting_after'))
+            if len(calls) == 2:
+                raise stripe.error.APIConnectionError('timeout')
+            customers, has_more = pages[params.get('starting_after')]
+            return stripe.ListObject.construct_from({
+                'object': 'list', 'data': customers, 'has_more': has_more,
+            }, params['api_key'])
+        monkeypatch.setattr(stripe.Customer, 'list', staticmethod(list_))
+
+        def imported():
+            return sorted(p.provider_reference for p in PaymentProfile.search(
+                [('gateway', '=', gateway.id)]
+            ))
+
+        with pytest.raises(UserError):
+            gateway._import_stripe_customers(page_size=2)
+        assert imported() == ['card_1', 'card_2']
+        assert gateway.stripe_import_cursor == 'cus_2'
+
+        assert gateway._import_stripe_customers(page_size=2) == (1, 1)
+        assert calls == [None, 'cus_2', 'cus_2']
+        assert imported() == ['card_1', 'card_2', 'card_3']
+        assert gateway.stripe_import_cursor is None
+
+        run, = CustomerImport.search([('gateway', '=', gateway.id)])
+        assert (run.customers, run.cards, run.complete) == (1, 1, True)
+        assert run.throughput > 0
+
+    def test_refund_stripe_batch(self, dataset, transaction, fake_stripe):
+        """
+        Refund several transactions at once with partial amounts
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        payment_profile = self.create_payment_profile(
+            data.customer, data.stripe_gateway
+        )
+        charges = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': Decimal('10.10'),
+            'credit_account': data.customer.account_receivable.id,
+        } for _ in range(3)])
+        PaymentTransaction.capture(charges)
+
+        refunds = [charge.create_refund() for charge in charges]
+        for amount in (Decimal('0'), Decimal('-1'), Decimal('10.11')):
+            with pytest.raises(UserError):
+                PaymentTransaction.refund_stripe_batch(refunds, amounts={
+                    refunds[0].id: amount,
+                })
+        PaymentTransaction.refund_stripe_batch(refunds, amounts={
+            refunds[0].id: Decimal('5'),
+        })
+
+        assert [r.state for r in refunds] == ['posted'] * 3
+        assert refunds[0].amount == Decimal('5')
+        # The invalid amounts are not sent
+        assert fake_stripe.requests.count(('POST', '/v1/refunds')) == 3
+        assert all(r.provider_reference.startswith('re_') for r in refunds)
+
+    def test_stripe_map(self):
+        """
+        Results are returned in order and errors are returned with the item
+        """
+        from trytond.modules.payment_gateway_stripe.utils import stripe_map
+
+        def func(item):
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+
+        results = stripe_map(func, range(5), workers=3)
+
+        assert [(i, r) for i, r, _ in results] == [
+            (0, 0), (1, 10), (2, None), (3, 30), (4, 40)
+        ]
+        assert isinstance(results[2][2], ValueError)
+
+    def test_stripe_charge_data_batch_queries(
+            self, dataset, transaction, monkeypatch):
+        """
+        The number of reads to build the charge data of a batch, charged
+        on the payment profiles or on cards entered by hand, must not
+        depend on the size of the batch
+        """
+        Party = self.POOL.get('party.party')
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        UseCardView = self.POOL.get('payment_gateway.transaction.use_card.view')
+        data = dataset()
+        address = data.customer.addresses[0]
+
+        def create_transactions(count):
+            parties = Party.create([{
+                'name': 'Party %d' % i,
+                'addresses': [('create', [{
+                    'street': address.street,
+                    'city': address.city,
+                    'zip': address.zip,
+                    'country': address.country.id,
+                    'subdivision': address.subdivision.id,
+                }])],
+            } for i in range(count)])
+            profiles = PaymentProfile.create([{
+                'party': party.id,
+                'address': party.addresses[0].id,
+                'gateway': data.stripe_gateway.id,
+                'provider_reference': 'card_%d' % party.id,
+                'stripe_customer_id': 'cus_%d' % party.id,
+                'last_4_digits': '4242',
+                'expiry_month': '01',
+                'expiry_year': '2030',
+            } for party in parties])
+            return PaymentTransaction.create([{
+                'party': profile.party.id,
+                'credit_account': data.customer.account_receivable.id,
+                'address': profile.address.id,
+                'payment_profile': profile.id,
+                'gateway': data.stripe_gateway.id,
+                'amount': 100,
+            } for profile in profiles])
+
+        reads = []
+
+        def count_reads(model_name):
+            Model = self.POOL.get(model_name)
+            read = Model.read
+
+            def counted_read(cls, ids, fields_names=None):
+                reads.append(model_name)
+                return read(ids, fields_names=fields_names)
+            monkeypatch.setattr(Model, 'read', classmethod(counted_read))
+
+        for model_name in [
+                'payment_gateway.transaction', 'currency.currency',
+                'party.address', 'party.party', 'party.payment_profile',
+                'country.country', 'country.subdivision']:
+            count_reads(model_name)
+
+        def count_batch_reads(transactions, card_infos=None):
+            # Start from an empty cache, as a new request would
+            Transaction().cache.clear()
+            del reads[:]
+            charge_data = PaymentTransaction.get_stripe_charge_data_batch(
+                transactions, card_infos
+            )
+            assert len(charge_data) == len(transactions)
+            return len(reads)
+
+        small_batch = create_transactions(2)
+        large_batch = create_transactions(10)
+        assert count_batch_reads(small_batch) == \
+            count_batch_reads(large_batch)
+        # One read per related model used, whatever the size of the batch
+        assert sorted(reads) == [
+            'currency.currency', 'party.party', 'party.payment_profile',
+            'payment_gateway.transaction',
+        ]
+
+        # The cards entered by hand send the addresses
+        def card_infos(transactions):
+            return dict((t.id, UseCardView(
+                number=DUMMY_CARD['number'],
+                expiry_month=DUMMY_CARD['exp_month'],
+                expiry_year=DUMMY_CARD['exp_year'],
+                csc=DUMMY_CARD['csc'],
+                owner=None,
+            )) for t in transactions)
+        assert count_batch_reads(small_batch, card_infos(small_batch)) == \
+            count_batch_reads(large_batch, card_infos(large_batch))
+        assert sorted(reads) == [
+            'country.country', 'country.subdivision', 'currency.currency',
+            'party.address', 'party.party', 'payment_gateway.transaction',
+        ]
+
+    def test_stripe_charge_templates(self, dataset, transaction, monkeypatch):
+        """
+        Render the templates of the gateway in the charge data, without
+        reading the parties once per charge
+        """
+        Party = self.POOL.get('party.party')
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        with pytest.raises(UserError):
+            PaymentGateway.write([data.stripe_gateway], {
+                'stripe_metadata_template': 'no key',
+            })
+        for template in [
+                'Order {origin', 'Order {origin.refrence}', '{party.cod}',
+                '{amount:d}', '{party.addresses}']:
+            with pytest.raises(UserError):
+                PaymentGateway.write([data.stripe_gateway], {
+                    'stripe_description_template': template,
+                })
+        PaymentGateway.write([data.stripe_gateway], {
+            'stripe_description_template': '{description} for {party}',
+            'stripe_statement_descriptor_template': "Fulfil's {party.code}",
+            'stripe_metadata_template': 'party: {party.code}\n'
+            'order: {origin.description}\n\namount: {amount:.2f}',
+        })
+
+        parties = Party.create([{
+            'name': 'Party %d' % i,
+            'code': 'P%d' % i,
+            'addresses': [('create', [{'street': 'Main Street'}])],
+        } for i in range(3)])
+        profiles = PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'provider_reference': 'card_%d' % party.id,
+            'stripe_customer_id': 'cus_%d' % party.id,
+            'last_4_digits': '4242',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        } for party in parties])
+        transactions = PaymentTransaction.create([{
+            'party': profile.party.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': profile.address.id,
+            'payment_profile': profile.id,
+            'gateway': data.stripe_gateway.id,
+            'description': 'Order %d' % i,
+            'amount': 100,
+        } for i, profile in enumerate(profiles)])
+
+        reads = []
+        read = Party.read
+
+        def counted_read(cls, ids, fields_names=None):
+            reads.append(ids)
+            return read(ids, fields_names=fields_names)
+        monkeypatch.setattr(Party, 'read', classmethod(counted_read))
+
+        Transaction().cache.clear()
+        charge_data = PaymentTransaction.get_stripe_charge_data_batch(
+            transactions
+        )
+        # The parties are read together
+        assert reads and all(len(ids) == len(parties) for ids in reads)
+        assert charge_data[transactions[0].id]['description'] == \
+            'Order 0 for Party 0'
+        assert charge_data[transactions[1].id]['statement_descriptor'] == \
+            'Fulfils P1'
+        assert charge_data[transactions[2].id]['metadata'] == {
+            'party': 'P2',
+            'amount': '100.00',
+        }
+
+    def test_get_ids_by_provider_reference(self, dataset, transaction):
+        """
+        Resolve stripe ids to transactions of the gateway
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        } for _ in range(3)])
+        for transaction_, reference in zip(
+                transactions, ['ch_1', 're_1', None]):
+            transaction_.provider_reference = reference
+            transaction_.save()
+
+        assert PaymentTransaction.get_ids_by_provider_reference(
+            data.stripe_gateway, ['ch_1', 're_1', 'ch_unknown']
+        ) == {
+            'ch_1': transactions[0].id,
+            're_1': transactions[1].id,
+        }
+
+    def test_stripe_request_ledger(self, dataset, transaction):
+        """
+        Record stripe requests and their outcome
+        """
+        StripeRequest = self.POOL.get('payment_gateway.stripe.request')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        card, token, timeout = StripeRequest.prepare([
+            (gateway, 'source', 'source_1', {
+                'customer': 'cus_1',
+                'source': {'object': 'card', 'number': '4242424242424242'},
+            }, None),
+            (gateway, 'source', 'source_tok_1', {
+                'customer': 'cus_1',
+                'source': 'tok_1',
+            }, None),
+            (gateway, 'refund', 'refund_1', {
+                'charge': 'ch_1',
+                'amount': 100,
+            }, None),
+        ])
+        # Raw card data is never stored
+        assert card.request is None
+        assert '4242' not in card.request_hash
+        assert token.request
+        assert all(r.status == 'pending' for r in (card, token, timeout))
+
+        StripeRequest.record_results([
+            (card, stripe.Card.construct_from({'id': 'card_1'}, 'key'), None),
+            (token, None, stripe.error.CardError('declined', None, None)),
+            (timeout, None, stripe.error.APIConnectionError('timeout')),
+        ])
+        assert (card.status, card.response_id) == ('done', 'card_1')
+        assert token.status == 'failed'
+        # The outcome is unknown, so it can be replayed
+        assert timeout.status == 'pending'
+
+        # Sending again a request with the same key reuses the entry
+        again, = StripeRequest.prepare([
+            (gateway, 'source', 'source_tok_1', {
+                'customer': 'cus_1',
+                'source': 'tok_1',
+            }, None),
+        ])
+        assert again == token
+        assert again.status == 'pending'
+
+    def test_stripe_queue_mode(self, dataset, transaction):
+        """
+        Queue the stripe operations of gateways in queue mode
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeJob = self.POOL.get('payment_gateway.stripe.job')
+        data = dataset()
+
+        data.stripe_gateway.stripe_queue = True
+        data.stripe_gateway.save()
+
+        transaction1, transaction2 = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        } for _ in range(2)])
+        transaction2.state = 'authorized'
+        transaction2.save()
+
+        PaymentTransaction.authorize([transaction1])
+        PaymentTransaction.settle([transaction2])
+        # Queuing twice does not run the operation twice
+        PaymentTransaction.settle([transaction2])
+
+        assert transaction1.state == 'in-progress'
+        assert transaction2.state == 'authorized'
+        assert [
+            (job.transaction, job.operation, job.state)
+            for job in StripeJob.search([], order=[('id', 'ASC')])
+        ] == [
+            (transaction1, 'authorize', 'queued'),
+            (transaction2, 'settle', 'queued'),
+        ]
+
+        job = StripeJob._claim()
+        assert job.transaction == transaction1
+
+    def test_run_stripe_jobs(
+            self, dataset, transaction, stripe_profile, stripe_send):
+        """
+        Run the queued stripe jobs like a worker
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeJob = self.POOL.get('payment_gateway.stripe.job')
+        data = dataset()
+
+        data.stripe_gateway.stripe_queue = True
+        data.stripe_gateway.save()
+
+        payment_profile = stripe_profile()
+        payment_transaction, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        }])
+
+        def send(api_key, operation, key, params):
+            assert (operation, params['capture']) == ('charge', False)
+            return {
+                'id': 'ch_job', 'status': 'succeeded', 'captured': False,
+            }
+        stripe_send(send)
+
+        PaymentTransaction.authorize([payment_transaction])
+        job, = StripeJob.search([])
+        assert job.state == 'queued'
+
+        assert StripeJob._run_next() is True
+        job = StripeJob(job.id)
+        assert job.state == 'done'
+        assert job.finished is not None
+        payment_transaction = PaymentTransaction(payment_transaction.id)
+        assert payment_transaction.state == 'authorized'
+        assert payment_transaction.provider_reference == 'ch_job'
+
+        # The queue is empty
+        assert StripeJob._run_next() is False
+
+    def test_recover_stripe_job(
+            self, dataset, transaction, monkeypatch, stripe_profile,
+            stripe_send):
+        """
+        Recover from the ledger a job which failed after stripe answered
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeJob = self.POOL.get('payment_gateway.stripe.job')
+        data = dataset()
+
+        data.stripe_gateway.stripe_queue = True
+        data.stripe_gateway.save()
+
+        payment_profile = stripe_profile()
+        payment_transaction, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+        }])
+
+        keys = []
+
+        def send(api_key, operation, key, params):
+            keys.append(key)
+            return {
+                'id': 'ch_job', 'status': 'succeeded', 'captured': False,
+            }
+        stripe_send(send)
+
+        PaymentTransaction.authorize([payment_transaction])
+        job, = StripeJob.search([])
+
+        def save(self):
+            raise Exception('Lost')
+        monkeypatch.setattr(PaymentTransaction, 'save', save)
+        # The ledger commits on its own on postgresql, keep it here too
+        monkeypatch.setattr(transaction, 'rollback', lambda: None)
+
+        assert StripeJob._run_next() is True
+        job = StripeJob(job.id)
+        assert job.state == 'done'
+        assert 'Lost' in job.error
+        assert len(keys) == 2 and keys[0] == keys[1]
+        payment_transaction = PaymentTransaction(payment_transaction.id)
+        assert payment_transaction.state == 'authorized'
+        assert payment_transaction.provider_reference == 'ch_job'
+
+    def test_settle_stripe_authorizations(
+            self, dataset, transaction, stripe_send):
+        """
+        Settle the old stripe authorizations from the cron
+        """
+        Date = self.POOL.get('ir.date')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        SettlementRun = self.POOL.get('payment_gateway.stripe.settlement.run')
+        data = dataset()
+
+        data.stripe_gateway.stripe_settle_after = 6
+        data.stripe_gateway.save()
+
+        today = Date.today()
+        settled, captured, recent = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': 100,
+            'state': 'authorized',
+            'provider_reference': reference,
+            'date': date,
+        } for reference, date in [
+            ('ch_1', today - datetime.timedelta(days=7)),
+            ('ch_2', today - datetime.timedelta(days=6)),
+            ('ch_3', today),
+        ]])
+
+        def send(api_key, operation, key, params):
+            assert operation == 'capture'
+            if params['charge'] == 'ch_2':
+                raise stripe.error.InvalidRequestError(
+                    'Charge ch_2 has already been captured.', None,
+                    code='charge_already_captured',
+                    json_body={'error': {'code': 'charge_already_captured'}}
+                )
+            return {
+                'id': params['charge'],
+                'status': 'succeeded',
+                'captured': True,
+            }
+        stripe_send(send)
+
+        PaymentTransaction.settle_stripe_authorizations()
+
+        assert settled.state in ('completed', 'posted')
+        assert captured.state in ('completed', 'posted')
+        assert recent.state == 'authorized'
+
+        run, = SettlementRun.search([])
+        assert (run.selected, run.settled, run.skipped, run.failed) == \
+            (2, 1, 1, 0)
+        assert run.remaining == 0
+
+    def test_stripe_routes(
+            self, dataset, transaction, monkeypatch, stripe_send):
+        """
+        Route the new transactions to the gateways by country, failing over
+        when a gateway errors too often, and send the batches by gateway
+        """
+        from trytond.modules.payment_gateway_stripe.utils import \
+            stripe_gateway_health
+
+        Gateway = self.POOL.get('payment_gateway.gateway')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeRoute = self.POOL.get('payment_gateway.stripe.route')
+        data = dataset()
+        address = data.customer.addresses[0]
+
+        gateway_us = data.stripe_gateway
+        gateway_eu, = Gateway.create([{
+            'name': 'Stripe Europe',
+            'journal': gateway_us.journal.id,
+            'provider': 'stripe',
+            'method': 'credit_card',
+            'stripe_api_key': 'sk_test_eu',
+            'test': True,
+        }])
+        StripeRoute.create([{
+            'sequence': 10,
+            'country': address.country.id,
+            'gateway': gateway_us.id,
+        }, {
+            'sequence': 20,
+            'gateway': gateway_eu.id,
+        }])
+
+        def create(**values):
+            transaction_, = PaymentTransaction.create([dict({
+                'party': data.customer.id,
+                'credit_account': data.customer.account_receivable.id,
+                'address': address.id,
+                'amount': 100,
+            }, **values)])
+            return transaction_
+
+        stripe_gateway_health.clear()
+        assert create().gateway == gateway_us
+        assert create(gateway=gateway_eu.id).gateway == gateway_eu
+        assert create(logs=[('create', [{'log': 'Created'}])]).gateway == \
+            gateway_us
+
+        # The routes are read once for all the transactions created
+        searches = []
+        search = StripeRoute.search
+
+        def counted_search(cls, *args, **kwargs):
+            searches.append(args)
+            return search(*args, **kwargs)
+        monkeypatch.setattr(StripeRoute, 'search', classmethod(counted_search))
+        PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': address.id,
+            'amount': 100,
+        } for _ in range(3)])
+        assert len(searches) == 1
+        monkeypatch.undo()
+
+        with pytest.raises(UserError):
+            StripeRoute.create([{
+                'gateway': gateway_eu.id,
+                'weight': -1,
+            }])
+
+        # Too many connection errors
+        for _ in range(stripe_gateway_health.min_requests):
+            stripe_gateway_health.record(
+                gateway_us.id, stripe.error.APIConnectionError('timeout')
+            )
+        assert create().gateway == gateway_eu
+        stripe_gateway_health.clear()
+
+        sent = []
+
+        def send(api_key, operation, key, params):
+            sent.append((api_key, params['charge']))
+            succeeded = params['charge'] != 'ch_4'
+            return {
+                'id': params['charge'],
+                'status': 'succeeded' if succeeded else 'failed',
+                'captured': succeeded,
+            }
+        stripe_send(send)
+
+        transactions = [create(
+            gateway=gateway.id, state='authorized', provider_reference=charge
+        ) for gateway, charge in [
+            (gateway_us, 'ch_1'), (gateway_eu, 'ch_2'), (gateway_us, 'ch_3'),
+            (gateway_us, 'ch_4'),
+        ]]
+        assert PaymentTransaction.settle_stripe_batch(transactions) == {
+            'settled': 3, 'skipped': 0, 'failed': 1,
+        }
+        assert sorted(sent) == [
+            (gateway_us.stripe_api_key, 'ch_1'),
+            (gateway_us.stripe_api_key, 'ch_3'),
+            (gateway_us.stripe_api_key, 'ch_4'),
+            ('sk_test_eu', 'ch_2'),
+        ]
+        assert [t.state for t in transactions] == [
+            'posted', 'posted', 'posted', 'failed',
+        ]
+
+    def test_process_stripe_batch(
+            self, dataset, transaction, stripe_profile, stripe_send):
+        """
+        Capture transactions in chunks, sqlite runs them in the current
+        process
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        payment_profile = stripe_profile()
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': amount,
+        } for amount in [10, 20, 30]])
+
+        def send(api_key, operation, key, params):
+            assert operation == 'charge'
+            assert params['capture'] and params['customer'] == 'cus_1'
+            return {
+                'id': 'ch_%s' % key,
+                'status': 'failed' if params['amount'] == 2000 else
+                'succeeded',
+            }
+        stripe_send(send)
+
+        stats = PaymentTransaction.process_stripe_batch(
+            'capture_stripe_batch', transactions, processes=4, chunk_size=2,
+            workers=2
+        )
+        assert stats == {'captured': 2, 'failed': 1}
+        assert [PaymentTransaction(t.id).state for t in transactions] == [
+            'posted', 'failed', 'posted'
+        ]
+        assert all(
+            t.provider_reference == 'ch_capture_%s' % t.uuid
+            for t in PaymentTransaction.browse(transactions)
+        )
+
+    def test_process_stripe_batch_forked(
+            self, request, dataset, transaction, monkeypatch, stripe_send):
+        """
+        Capture transactions in forked processes, each chunk committed on
+        its own, and keep the results of the chunks which did not fail
+        """
+        if request.config.getoption('--db') != 'postgres':
+            pytest.skip('Only postgresql runs the chunks in processes')
+
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        payment_profile, = PaymentProfile.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'provider_reference': 'card_forked',
+            'stripe_customer_id': 'cus_forked',
+            'last_4_digits': '4242',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        }])
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': amount,
+        } for amount in [10, 20, 30]])
+        # The processes only see what is committed
+        transaction.commit()
+
+        def send(api_key, operation, key, params):
+            return {
+                'id': 'ch_%s' % key,
+                'status': 'failed' if params['amount'] == 2000 else
+                'succeeded',
+            }
+        stripe_send(send)
+
+        capture_stripe_batch = PaymentTransaction.capture_stripe_batch
+
+        def capture(cls, records, **kwargs):
+            if transactions[2] in records:
+                raise ValueError('Broken chunk')
+            return capture_stripe_batch(records, **kwargs)
+        monkeypatch.setattr(
+            PaymentTransaction, 'capture_stripe_batch', classmethod(capture)
+        )
+
+        stats = PaymentTransaction.process_stripe_batch(
+            'capture_stripe_batch', transactions, processes=2, chunk_size=1,
+            workers=2
+        )
+        assert stats == {'captured': 1, 'failed': 1, 'errors': 1}
+        assert [
+            t['state'] for t in PaymentTransaction.read(
+                map(int, transactions), ['state']
+            )
+        ] == ['posted', 'failed', 'draft']
+
+    def test_stripe_error_outcomes(
+            self, dataset, transaction, stripe_profile, stripe_send):
+        """
+        Classify the stripe errors and save the outcome on the failed
+        transactions
+        """
+        from trytond.modules.payment_gateway_stripe.utils import \
+            classify_stripe_error, stripe_error_message
+
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        def card_error(code, decline_code=None):
+            return stripe.error.CardError(
+                'Your card was declined.', None, code, http_status=402,
+                json_body={'error': {
+                    'type': 'card_error', 'code': code,
+                    'decline_code': decline_code,
+                    'message': 'Your card was declined.',
+                }}
+            )
+
+        assert classify_stripe_error(
+            card_error('card_declined', 'insufficient_funds')
+        ) == ('soft_decline', 'insufficient_funds')
+        assert classify_stripe_error(
+            card_error('card_declined', 'stolen_card')
+        ) == ('hard_decline', 'stolen_card')
+        assert classify_stripe_error(card_error('expired_card')) == \
+            ('hard_decline', 'expired_card')
+        assert classify_stripe_error(
+            stripe.error.APIConnectionError('timeout')
+        ) == ('retryable', None)
+        assert classify_stripe_error(
+            stripe.error.InvalidRequestError('down', None, http_status=503)
+        ) == ('retryable', None)
+        assert classify_stripe_error(
+            stripe.error.AuthenticationError('bad key')
+        ) == ('configuration', None)
+        # The connection errors have no body
+        assert stripe_error_message(
+            stripe.error.APIConnectionError('timeout')
+        ) == 'timeout'
+
+        payment_profile = stripe_profile()
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': amount,
+        } for amount in [10, 20, 30]])
+
+        errors = {
+            1000: card_error('card_declined', 'insufficient_funds'),
+            2000: card_error('card_declined', 'insufficient_funds'),
+            3000: stripe.error.APIError('Oops', http_status=500),
+        }
+
+        def send(api_key, operation, key, params):
+            raise errors[params['amount']]
+        stripe_send(send)
+
+        PaymentTransaction.capture_stripe_batch(transactions)
+        assert [
+            (t.state, t.stripe_error_outcome, t.stripe_decline_code)
+            for t in PaymentTransaction.browse(transactions)
+        ] == [
+            ('failed', 'soft_decline', 'insufficient_funds'),
+            ('failed', 'soft_decline', 'insufficient_funds'),
+            ('failed', 'retryable', None),
+        ]
+        assert PaymentTransaction.search([
+            ('state', '=', 'failed'),
+            ('stripe_error_outcome', '=', 'retryable'),
+        ]) == [transactions[2]]
+
+        copy, = PaymentTransaction.copy([transactions[0]])
+        assert copy.stripe_error_outcome is None
+        assert copy.stripe_decline_code is None
+
+    def test_retry_stripe_transactions(
+            self, dataset, transaction, stripe_profile, stripe_send):
+        """
+        Retry the soft declined charges on the schedule of the gateway
+        """
+        PaymentGateway = self.POOL.get('payment_gateway.gateway')
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeRequest = self.POOL.get('payment_gateway.stripe.request')
+        data = dataset()
+
+        with pytest.raises(UserError):
+            PaymentGateway.write([data.stripe_gateway], {
+                'stripe_retry_schedule': '24, soon',
+            })
+        PaymentGateway.write([data.stripe_gateway], {
+            'stripe_retry_schedule': '1, 24',
+        })
+
+        payment_profile = stripe_profile()
+        transactions = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'payment_profile': payment_profile.id,
+            'gateway': data.stripe_gateway.id,
+            'amount': amount,
+        } for amount in [10, 20, 30, 40, 50]])
+
+        keys = []
+        declines = {
+            # Soft declined once, hard declined and always soft declined
+            1000: ['insufficient_funds'],
+            2000: ['stolen_card'],
+            3000: ['insufficient_funds'] * 3,
+            # Failed at stripe once, and lost on the way back
+            4000: [stripe.error.APIError('Server error', http_status=500)],
+            5000: [stripe.error.APIConnectionError('Timed out')],
+        }
+
+        def send(api_key, operation, key, params):
+            keys.append(key)
+            if declines[params['amount']]:
+                code = declines[params['amount']].pop()
+                if isinstance(code, Exception):
+                    raise code
+                raise stripe.error.CardError(
+                    'Your card was declined.', None, 'card_declined',
+                    http_status=402, json_body={'error': {
+                        'code': 'card_declined', 'decline_code': code,
+                    }}
+                )
+            return {
+                'id': 'ch_%s' % key, 'status': 'succeeded',
+                'captured': params['capture'],
+            }
+        stripe_send(send)
+
+        def make_due():
+            PaymentTransaction.write(
+                PaymentTransaction.search([
+                    ('stripe_retry_date', '!=', None),
+                ]), {'stripe_retry_date': datetime.datetime(2000, 1, 1)}
+            )
+
+        PaymentTransaction.capture_stripe_batch(transactions)
+        soft, hard, always, error, lost = PaymentTransaction.browse(
+            transactions
+        )
+        assert soft.stripe_retry_date > datetime.datetime.now()
+        assert hard.stripe_error_outcome == 'hard_decline'
+        assert hard.stripe_retry_date is None
+
+        # Not due yet
+        del keys[:]
+        PaymentTransaction.retry_stripe_transactions()
+        assert keys == []
+
+        make_due()
+        stats = PaymentTransaction.retry_stripe_transactions(workers=1)
+        assert stats == {'captured': 2, 'authorized': 0, 'failed': 1}
+        # Only the declined charges are sent with a new key, the charge
+        # lost on the way back is left to the replay of the ledger
+        assert sorted(keys) == sorted([
+            'capture_%s_retry1' % soft.uuid,
+            'capture_%s_retry1' % always.uuid,
+            'capture_%s' % error.uuid,
+        ])
+        soft, hard, always, error, lost = PaymentTransaction.browse(
+            transactions
+        )
+        assert error.state == 'posted'
+        assert (lost.state, lost.stripe_error_outcome) == \
+            ('failed', 'retryable')
+
+        # Stripe made the lost charge
+        del keys[:]
+        StripeRequest.replay_pending(age=-1, workers=1)
+        assert keys == ['capture_%s' % lost.uuid]
+        lost = PaymentTransaction(lost.id)
+        assert lost.state == 'posted'
+        assert (
+            lost.stripe_error_outcome, lost.stripe_retry_date
+        ) == (None, None)
+        assert soft.state == 'posted'
+        assert soft.stripe_error_outcome is None
+        assert (always.state, always.stripe_retry_count) == ('failed', 1)
+        assert always.stripe_retry_date is not None
+
+        # The schedule has two retries
+        make_due()
+        PaymentTransaction.retry_stripe_transactions()
+        always = PaymentTransaction(always.id)
+        assert (always.state, always.stripe_retry_count) == ('failed', 2)
+        assert always.stripe_retry_date is None
+
+    def test_push_stripe_customers(
+            self, dataset, transaction, monkeypatch, stripe_profile,
+            stripe_send):
+        """
+        Push the changes of the parties to their stripe customers, once per
+        run whatever the number of changes
+        """
+        Party = self.POOL.get('party.party')
+        ContactMechanism = self.POOL.get('party.contact_mechanism')
+        data = dataset()
+        party = data.customer
+
+        stripe_profile()
+        Party.write([party], {'stripe_changed': None})
+
+        sent = []
+        errors = []
+
+        def send(api_key, operation, key, params):
+            assert operation == 'customer_update'
+            if errors:
+                raise errors.pop()
+            sent.append(params)
+            return stripe.Customer.construct_from(
+                {'id': params['customer']}, api_key
+            )
+        stripe_send(send)
+
+        # Other fields are not sent
+        Party.write([party], {'code': 'C-1'})
+        assert Party(party.id).stripe_changed is None
+
+        Party.write([party], {'name': 'Jane Doe'})
+        assert Party(party.id).stripe_changed is not None
+
+        # Marked by the same write
+        writes = []
+        write = Party.write
+
+        def counted_write(cls, *args):
+            writes.append(args)
+            return write(*args)
+        monkeypatch.setattr(Party, 'write', classmethod(counted_write))
+        Party.write([party], {'name': 'Jane Roe'})
+        assert len(writes) == 1
+
+        email, = ContactMechanism.create([{
+            'party': party.id,
+            'type': 'email',
+            'value': 'jane@example.com',
+        }])
+
+        errors.append(stripe.error.APIConnectionError('timeout'))
+        Party.push_stripe_customers()
+        assert sent == []
+        assert Party(party.id).stripe_changed is not None
+
+        Party.push_stripe_customers()
+        assert sent == [{
+            'customer': 'cus_1',
+            'description': 'Jane Roe',
+            'email': 'jane@example.com',
+            'metadata': {'party_id': party.id},
+        }]
+        assert Party(party.id).stripe_changed is None
+
+        Party.push_stripe_customers()
+        assert len(sent) == 1
+
+        # Only the changes of the email mark the party
+        del writes[:]
+        ContactMechanism.write([email], {'comment': 'Work'})
+        assert writes == []
+        assert Party(party.id).stripe_changed is None
+
+        ContactMechanism.write([email], {'value': 'jane@example.org'})
+        assert len(writes) == 1
+        assert Party(party.id).stripe_changed is not None
+
+    def test_delete_stripe_sources(self, dataset, transaction, monkeypatch):
+        """
+        Delete the stripe cards of the removed profiles, and of no profile
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        StripeRequest = self.POOL.get('payment_gateway.stripe.request')
+        data = dataset()
+        party = data.customer
+
+        profile1, profile2, profile3 = PaymentProfile.create([{
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'provider_reference': 'card_%d' % i,
+            'stripe_customer_id': 'cus_1',
+            'last_4_digits': '4242',
+            'expiry_month': '01',
+            'expiry_year': '2030',
+        } for i in range(1, 4)])
+
+        deleted = []
+
+        def delete_source(cls, customer_id, card_id, **params):
+            deleted.append((customer_id, card_id))
+            if card_id == 'card_2':
+                raise stripe.error.InvalidRequestError(
+                    'No such source', 'id', http_status=404
+                )
+            return stripe.Card.construct_from({'id': card_id}, 'key')
+
+        def list_sources(cls, customer_id, **params):
+            return stripe.ListObject.construct_from({
+                'object': 'list', 'has_more': False, 'data': [
+                    {'id': 'card_3', 'object': 'card'},
+                    {'id': 'card_4', 'object': 'card'},
+                ],
+            }, 'key')
+        monkeypatch.setattr(
+            stripe.Customer, 'delete_source', classmethod(delete_source)
+        )
+        monkeypatch.setattr(
+            stripe.Customer, 'list_sources', classmethod(list_sources)
+        )
+
+        PaymentProfile.write([profile1], {'active': False})
+        PaymentProfile.delete([profile2])
+        requests = StripeRequest.search([
+            ('operation', '=', 'source_delete'),
+        ])
+        assert sorted(r.key for r in requests) == [
+            'source_delete_card_1', 'source_delete_card_2',
+        ]
+        assert set(r.status for r in requests) == set(['pending'])
+
+        # Used again before the cron runs
+        PaymentProfile.write([profile1], {'active': True})
+        PaymentProfile.delete_stripe_sources()
+        assert deleted == [('cus_1', 'card_2')]
+        request, = StripeRequest.search([
+            ('operation', '=', 'source_delete'),
+        ])
+        assert request.status == 'done'
+
+        # card_3 is used by a profile and card_4 by none
+        del deleted[:]
+        PaymentProfile.cleanup_stripe_sources(age=0)
+        PaymentProfile.delete_stripe_sources()
+        assert deleted == [('cus_1', 'card_4')]
+
+    def test_refresh_expiring_stripe_cards(
+            self, dataset, transaction, monkeypatch):
+        """
+        Refresh the stripe cards about to expire
+        """
+        Date = self.POOL.get('ir.date')
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        data = dataset()
+
+        today = Date.today()
+        next_month = today + datetime.timedelta(days=20)
+        renewed, deleted, unchanged, later, expired = PaymentProfile.create([{
+            'party': data.customer.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'provider_reference': reference,
+            'stripe_customer_id': 'cus_1',
+            'last_4_digits': '4242',
+            'expiry_month': '%02d' % expiry.month,
+            'expiry_year': unicode(expiry.year),
+        } for reference, expiry in [
+            ('card_1', next_month),
+            ('card_2', next_month),
+            ('card_3', next_month),
+            ('card_4', today + datetime.timedelta(days=400)),
+            ('card_5', today.replace(day=1) - datetime.timedelta(days=1)),
+        ]])
+        assert renewed.expiry_date.month == next_month.month
+        assert renewed.expiry_date > next_month - datetime.timedelta(days=31)
+
+        retrieved = []
+
+        def retrieve_source(customer, card, api_key=None):
+            retrieved.append(card)
+            if card == 'card_2':
+                raise stripe.error.InvalidRequestError(
+                    'No such source', 'id', http_status=404
+                )
+            return stripe.Card.construct_from({
+                'id': card,
+                'exp_month': next_month.month,
+                'exp_year': next_month.year + (card == 'card_1'),
+                'last4': '4242',
+            }, api_key)
+        monkeypatch.setattr(
+            stripe.Customer, 'retrieve_source', staticmethod(retrieve_source)
+        )
+
+        PaymentProfile.refresh_expiring_stripe_cards()
+
+        assert sorted(retrieved) == ['card_1', 'card_2', 'card_3']
+        assert renewed.expiry_year == unicode(next_month.year + 1)
+        assert renewed.expiry_date.year == next_month.year + 1
+        assert not deleted.active
+        assert unchanged.active
+        assert unchanged.expiry_year == unicode(next_month.year)
+
+    def test_stripe_object_cache(
+            self, dataset, transaction, monkeypatch, stripe_profile):
+        """
+        Cache the stripe cards when the gateway asks for it
+        """
+        PaymentProfile = self.POOL.get('party.payment_profile')
+        StripeDispute = self.POOL.get('payment_gateway.stripe.dispute')
+        Gateway = self.POOL.get('payment_gateway.gateway')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        profile = stripe_profile(stripe_customer_id='cus_cache')
+
+        retrieved = []
+
+        def retrieve_source(customer, card, api_key=None):
+            retrieved.append(card)
+            return stripe.Card.construct_from({
+                'id': card, 'customer': customer, 'exp_month': 1,
+                'exp_year': 2030, 'last4': '4242',
+            }, api_key)
+        monkeypatch.setattr(
+            stripe.Customer, 'retrieve_source', staticmethod(retrieve_source)
+        )
+
+        # Nothing is cached by default
+        profile.get_stripe_card()
+        profile.get_stripe_card()
+        assert len(retrieved) == 2
+
+        gateway.stripe_cache_ttl = 60
+        gateway.save()
+        stats = Gateway.get_stripe_cache_stats()
+
+        profile.get_stripe_card()
+        profile.get_stripe_card()
+        assert len(retrieved) == 3
+        assert Gateway.get_stripe_cache_stats() == {
+            'hits': stats['hits'] + 1,
+            'misses': stats['misses'] + 1,
+        }
+
+        # The refresh of the expiring cards uses the cache too
+        PaymentProfile._refresh_stripe_cards([profile])
+        assert len(retrieved) == 3
+
+        # A webhook update drops the card, once signed
+        gateway.stripe_webhook_secret = 'whsec_test'
+        gateway.save()
+        payload = json.dumps({
+            'id': 'evt_1',
+            'object': 'event',
+            'type': 'customer.source.updated',
+            'data': {'object': {
+                'id': 'card_1', 'object': 'card', 'customer': 'cus_cache',
+            }},
+        })
+        timestamp = int(time.time())
+        signature = 't=%d,v1=%s' % (
+            timestamp, stripe.WebhookSignature._compute_signature(
+                '%d.%s' % (timestamp, payload), 'whsec_test'
+            )
+        )
+        with pytest.raises(UserError):
+            StripeDispute.process_stripe_webhook(
+                gateway.id, payload, 't=%d,v1=forged' % timestamp
+            )
+        profile.get_stripe_card()
+        assert len(retrieved) == 3
+
+        StripeDispute.process_stripe_webhook(gateway.id, payload, signature)
+        profile.get_stripe_card()
+        assert len(retrieved) == 4
+
+    def test_stripe_http_client(self, dataset, transaction):
+        """
+        The interactive and batch requests of a gateway use their own
+        timeouts and bounded connection pool
+        """
+        Gateway = self.POOL.get('payment_gateway.gateway')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        interactive = Gateway.get_stripe_http_client(gateway)
+        assert interactive._timeout == (5, 30)
+        assert Gateway.get_stripe_http_client(gateway) is interactive
+
+        with Transaction().set_context(stripe_operation_class='batch'):
+            batch = Gateway.get_stripe_http_client(gateway)
+        assert batch._timeout == (10, 60)
+        assert batch is not interactive
+
+        gateway.stripe_read_timeout = 8
+        gateway.stripe_max_connections = 2
+        gateway.save()
+        client = Gateway.get_stripe_http_client(gateway)
+        assert client._timeout == (5, 8)
+        adapter = client._session.get_adapter('https://api.stripe.com')
+        assert adapter._pool_maxsize == 2
+        assert adapter._pool_block
+
+    def test_stripe_profile(
+            self, dataset, transaction, stripe_profile, stripe_send):
+        """
+        Save the profile of the operations slower than the threshold of
+        their gateway
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        StripeProfile = self.POOL.get('payment_gateway.stripe.profile')
+        data = dataset()
+
+        payment_profile = stripe_profile()
+
+        def send(api_key, operation, key, params):
+            time.sleep(0.1)
+            return {
+                'id': 'ch_%s' % key,
+                'status': 'succeeded',
+            }
+        stripe_send(send)
+
+        def authorize():
+            transaction_, = PaymentTransaction.create([{
+                'party': data.customer.id,
+                'credit_account': data.customer.account_receivable.id,
+                'address': data.customer.addresses[0].id,
+                'payment_profile': payment_profile.id,
+                'gateway': data.stripe_gateway.id,
+                'amount': 100,
+            }])
+            transaction_.authorize_stripe()
+            assert transaction_.state == 'authorized'
+            return transaction_
+
+        # Nothing is profiled by default
+        authorize()
+        assert StripeProfile.search([]) == []
+
+        data.stripe_gateway.stripe_profile_threshold = 10
+        data.stripe_gateway.save()
+        authorize()
+        assert StripeProfile.search([]) == []
+
+        data.stripe_gateway.stripe_profile_threshold = 0.05
+        data.stripe_gateway.save()
+        transaction_ = authorize()
+        profile, = StripeProfile.search([])
+        assert profile.transaction == transaction_
+        assert profile.operation == 'authorize'
+        assert profile.log == transaction_.logs[-1]
+        assert profile.duration >= 0.1
+        phases = json.loads(profile.phases)
+        assert phases['stripe'] >= 0.1
+        assert phases['total'] == round(profile.duration, 4)
+        assert 'charge_data' in phases
+        assert profile.samples > 0
+        assert 'test_payment_gateway:send' in profile.stacks
+
+    def test_queries_per_capture(
+            self, dataset, transaction, monkeypatch, stripe_profile,
+            stripe_send):
+        """
+        Count the queries of a capture, the gateway must only be read once
+        its configuration is cached
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        data = dataset()
+
+        payment_profile = stripe_profile()
+
+        gateway_queries = []
+
+        def send(api_key, operation, key, params):
+            assert api_key == data.stripe_gateway.stripe_api_key
+            # The queries made to prepare the charge
+            gateway_queries.extend(
+                q for q in Transaction().connection.queries
+                if '"payment_gateway_gateway"' in q
+            )
+            return {
+                'id': 'ch_%s' % key,
+                'status': 'succeeded',
+            }
+        stripe_send(send)
+
+        class CountingCursor(object):
+            def __init__(self, cursor, queries):
+                self._cursor = cursor
+                self._queries = queries
+
+            def execute(self, query, *args):
+                self._queries.append(query)
+                return self._cursor.execute(query, *args)
+
+            def __getattr__(self, name):
+                return getattr(self._cursor, name)
+
+        class CountingConnection(object):
+            def __init__(self, connection):
+                self._connection = connection
+                self.queries = []
+
+            def cursor(self, *args):
+                return CountingCursor(
+                    self._connection.cursor(*args), self.queries
+                )
+
+            def __getattr__(self, name):
+                return getattr(self._connection, name)
+
+        def capture():
+            transaction_, = PaymentTransaction.create([{
+                'party': data.customer.id,
+                'credit_account': data.customer.account_receivable.id,
+                'address': data.customer.addresses[0].id,
+                'payment_profile': payment_profile.id,
+                'gateway': data.stripe_gateway.id,
+                'amount': 100,
+            }])
+            # Start from an empty cache, as a new request would
+            Transaction().cache.clear()
+            transaction_ = PaymentTransaction(transaction_.id)
+
+            connection = CountingConnection(Transaction().connection)
+            with monkeypatch.context() as patch:
+                patch.setattr(Transaction(), 'connection', connection)
+                transaction_.capture_stripe()
+            assert PaymentTransaction(transaction_.id).state in (
+                'completed', 'posted'
+            )
+            return connection.queries
+
+        capture()
+        del gateway_queries[:]
+        # The number of queries does not grow from a capture to the next and
+        # the gateway is only read once per capture, for its write date
+        assert len(capture()) == len(capture())
+        assert len(gateway_queries) == 2
+
+    def test_stripe_config_write_date(self, dataset, transaction):
+        """
+        The cached configuration of a gateway is not used once the gateway
+        was changed, even without clearing the cache as another process
+        would
+        """
+        Gateway = self.POOL.get('payment_gateway.gateway')
+        data = dataset()
+        gateway = data.stripe_gateway
+
+        assert Gateway.get_stripe_config(gateway)['settle_after'] is None
+
+        table = Gateway.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+            [table.stripe_settle_after, table.write_date],
+            [7, datetime.datetime(2030, 1, 1)],
+            where=table.id == gateway.id
+        ))
+        Transaction().cache.clear()
+        assert Gateway.get_stripe_config(gateway)['settle_after'] == 7
+
+    def test_save_stripe_disputes(self, dataset, transaction):
+        """
+        Disputes received from stripe are created once, linked to the
+        disputed transaction and updated later
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Dispute = self.POOL.get('payment_gateway.stripe.dispute')
+        data = dataset()
+
+        transaction1, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': Decimal('10.10'),
+            'provider_reference': 'ch_disputed',
+        }])
+
+        def stripe_dispute(status):
+            return stripe.Dispute.construct_from({
+                'id': 'dp_1', 'charge': 'ch_disputed', 'amount': 1010,
+                'currency': 'usd', 'reason': 'fraudulent', 'status': status,
+                'created': 1500000000,
+                'evidence_details': {'due_by': 1500086400},
+            }, 'sk_test')
+
+        dispute, = Dispute.save_from_stripe(
+            data.stripe_gateway, [stripe_dispute('needs_response')]
+        )
+        assert dispute.transaction == transaction1
+        assert dispute.amount == Decimal('10.10')
+        assert dispute.evidence_due_by is not None
+
+        Dispute.save_from_stripe(
+            data.stripe_gateway, [stripe_dispute('won')]
+        )
+        dispute, = Dispute.search([])
+        assert dispute.status == 'won'
+
+    def test_stripe_fees_from_balance_transactions(self, dataset, transaction):
+        """
+        Balance transactions of a payout are linked to the transactions and
+        aggregated per transaction and per day
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Payout = self.POOL.get('payment_gateway.stripe.payout')
+        Fee = self.POOL.get('payment_gateway.stripe.fee')
+        FeeDaily = self.POOL.get('payment_gateway.stripe.fee.daily')
+        data = dataset()
+
+        transaction1, = PaymentTransaction.create([{
+            'party': data.customer.id,
+            'credit_account': data.customer.account_receivable.id,
+            'address': data.customer.addresses[0].id,
+            'gateway': data.stripe_gateway.id,
+            'amount': Decimal('10.10'),
+            'provider_reference': 'ch_paid',
+        }])
+        payout, = Payout.create([{
+            'stripe_id': 'po_1',
+            'gateway': data.stripe_gateway.id,
+        }])
+
+        def balance_transaction(id, source, amount, fee, created):
+            return stripe.BalanceTransaction.construct_from({
+                'id': id, 'source': source, 'type': 'charge',
+                'amount': amount, 'fee': fee, 'net': amount - fee,
+                'currency': 'usd', 'created': created,
+            }, 'sk_test')
+
+        Fee.create_from_stripe(data.stripe_gateway, [(payout, b) for b in [
+            balance_transaction('txn_1', 'ch_paid', 1010, 59, 1500000000),
+            balance_transaction('txn_2', 'ch_other', 2000, 88, 1500000000),
+            balance_transaction('txn_3', 'ch_later', 500, 45, 1500100000),
+        ]])
+
+        assert transaction1.stripe_fee == Decimal('0.59')
+        daily = FeeDaily.search([], order=[('date', 'ASC')])
+        assert [(d.count, d.fee) for d in daily] == [
+            (2, Decimal('1.47')), (1, Decimal('0.45')),
+        ]
+
+    def test_import_stripe_payouts(self, dataset, transaction, monkeypatch):
+        """
+        Import the paid payouts with their balance transactions, whose
+        sources are resolved a page at a time across the payouts
+        """
+        PaymentTransaction = self.POOL.get('payment_gateway.transaction')
+        Payout = self.POOL.get('payment_gateway.stripe.payout')
+        Fee = self.POOL.get('payment_gateway.stripe.fee')
+
+        def payout(id, status):
+            return {
+                'id': id, 'object': 'payout', 'status': status,
+                'amount': 10000, 'currency': 'usd', 'created': 1500000000,
+                'arrival_date': 1500100000,
+            }
+
+        def balance_transaction(id, fee):
+            return {
+                'id': id, 'object': 'balance_transaction', 'source': 'ch_1',
+                'type': 'charge', 'amount': 1000, 'fee': fee,
+                'net': 1000 - fee, 'currency': 'usd', 'created': 1500000000,
+            }
+
+        balance_transactions = {
+            'po_1': [
+                balance_transaction('txn_1', 59),
+                balance_transaction('txn_2', 30),
+            ],
+            'po_2': [
+                balance_transaction('txn_3', 20),
+                balance_transaction('txn_4', 10),
+            ],
+        }
+
+        def list_page(data):
+            return stripe.ListObject.construct_from({
+                'object': 'list', 'data': data, 'has_more': False,
+            }, 'sk_test')
+        monkeypatch.setattr(stripe.Payout, 'list', staticmethod(
+            lambda **params: list_page([
+                payout('po_1', 'paid'), payout('po_2', 'paid'),
+                payout('po_3', 'in_transit'),
+            ])
+        ))
+        monkeypatch.setattr(stripe.BalanceTransaction, 'list', staticmethod(
+            lambda **params: list_page(balance_transactions[params['payout']])
+        ))
+        lookups = []
+        get_ids = PaymentTransaction.get_ids_by_provider_reference
+
+        def counted_get_ids(cls, gateway, references):
+            lookups.append(references)
+            return get_ids(gateway, references)
+        monkeypatch.setattr(
+            PaymentTransaction, 'get_ids_by_provider_reference',
+            classmethod(counted_get_ids)
+        )
+
+        Payout.import_stripe_payouts(page_size=3)
+        Payout.import_stripe_payouts(page_size=3)
+
+        payouts = Payout.search([], order=[('stripe_id', 'ASC')])
+        assert [(p.stripe_id, p.fee) for p in payouts] == [
+            ('po_1', Decimal('0.89')), ('po_2', Decimal('0.30')),
+        ]
+        assert len(Fee.search([])) == 4
+        # One lookup per page of 3 balance transactions, not per payout
+        assert len(lookups) == 2
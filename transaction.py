@@ -5,21 +5,53 @@
     :copyright: (c) 2015 by Fulfil.IO Inc.
     :license: see LICENSE for more details.
 """
+import re
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+
+from trytond import backend
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, Not
-from trytond.model import fields
+from trytond.model import ModelView, fields
+from trytond.rpc import RPC
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.exceptions import UserError
 
+from .utils import stripe_map, stripe_object_cache, stripe_http_client, \
+    get_http_client, StripeProcessPool, StripeTemplate, \
+    ZERO_DECIMAL_CURRENCIES, classify_stripe_error, stripe_error_body, \
+    stripe_error_message, own_transaction
+from .profiling import stripe_profiled, profile_phase
+
 import stripe
 stripe.api_version = '2017-06-05'
 
+logger = logging.getLogger(__name__)
+
 __metaclass__ = PoolMeta
 __all__ = [
     'PaymentGatewayStripe', 'PaymentTransactionStripe',
-    'AddPaymentProfile'
+    'AddPaymentProfileView', 'TransactionUseCardView', 'AddPaymentProfile'
 ]
 
 
+# Stripe refuses these characters in the statement descriptors and keeps 22
+STATEMENT_DESCRIPTOR_FORBIDDEN = re.compile(r'[<>\\\'"*]')
+STATEMENT_DESCRIPTOR_LENGTH = 22
+
+# The failures of the charges retried on the schedule of their gateway
+STRIPE_RETRY_OUTCOMES = ('soft_decline', 'retryable')
+
+STRIPE_STATES = {
+    'required': Eval('provider') == 'stripe',
+    'invisible': Eval('provider') != 'stripe',
+}
+
+
 class PaymentGatewayStripe:
     "Stripe Gateway Implementation"
     __name__ = 'payment_gateway.gateway'
@@ -39,6 +71,201 @@ class PaymentGatewayStripe:
         }, depends=['provider', 'active']
     )
 
+    stripe_webhook_secret = fields.Char(
+        'Stripe Webhook Secret', states={
+            'invisible': Eval('provider') != 'stripe',
+            'readonly': Not(Bool(Eval('active'))),
+        }, depends=['provider', 'active'],
+        help='Signing secret of the webhook endpoint, the events without '
+        'its signature are refused'
+    )
+
+    stripe_import_cursor = fields.Char(
+        'Stripe Import Cursor', readonly=True, states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Last stripe customer imported, the next import resumes from it'
+    )
+
+    stripe_dispute_cursor = fields.Integer(
+        'Stripe Dispute Cursor', readonly=True, states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Time of the last dispute sync, as a unix timestamp'
+    )
+
+    stripe_payout_cursor = fields.Integer(
+        'Stripe Payout Cursor', readonly=True, states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Time of the last payout import, as a unix timestamp'
+    )
+
+    stripe_settle_after = fields.Integer(
+        'Settle Authorizations After', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Number of days after which the authorized transactions are '
+        'settled automatically, stripe releases them after 7 days. Leave '
+        'empty to settle them by hand.'
+    )
+
+    stripe_cache_ttl = fields.Integer(
+        'Stripe Cache Duration', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Number of seconds the cards fetched from stripe are kept in '
+        'memory, leave empty to always fetch them'
+    )
+
+    stripe_connect_timeout = fields.Integer(
+        'Connect Timeout', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Seconds to wait for a connection to stripe for the interactive '
+        'operations'
+    )
+    stripe_read_timeout = fields.Integer(
+        'Read Timeout', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Seconds to wait for an answer from stripe for the interactive '
+        'operations'
+    )
+    stripe_max_connections = fields.Integer(
+        'Maximum Connections', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Connections to stripe a process opens at most for the '
+        'interactive operations, the other requests wait for one'
+    )
+    stripe_batch_connect_timeout = fields.Integer(
+        'Batch Connect Timeout', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Seconds to wait for a connection to stripe for the crons, the '
+        'workers and the imports'
+    )
+    stripe_batch_read_timeout = fields.Integer(
+        'Batch Read Timeout', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Seconds to wait for an answer from stripe for the crons, the '
+        'workers and the imports'
+    )
+    stripe_batch_max_connections = fields.Integer(
+        'Batch Maximum Connections', states=STRIPE_STATES,
+        depends=['provider'],
+        help='Connections to stripe a process opens at most for the crons, '
+        'the workers and the imports'
+    )
+    stripe_batch_rate_limit = fields.Integer(
+        'Batch Rate Limit', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Requests per second a process sends to stripe at most for the '
+        'crons, the workers and the imports, leave empty for no limit'
+    )
+
+    stripe_queue = fields.Boolean(
+        'Queue Stripe Operations', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Run the authorizations, captures, settlements, cancellations '
+        'and refunds in the stripe worker processes instead of the request'
+    )
+
+    stripe_profile_threshold = fields.Float(
+        'Profile Operations Slower Than', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Number of seconds after which the profile of an operation on a '
+        'transaction is saved, leave empty to never profile them'
+    )
+
+    stripe_description_template = fields.Char(
+        'Charge Description', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Description of the charges, with the fields of the '
+        'transaction between braces like "Order {origin.reference}"'
+    )
+    stripe_statement_descriptor_template = fields.Char(
+        'Statement Descriptor', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Text of the charges on the statements of the customers, with '
+        'the fields of the transaction between braces like "{party.code}". '
+        'Stripe keeps 22 characters.'
+    )
+    stripe_metadata_template = fields.Text(
+        'Charge Metadata', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Metadata of the charges, one "key: value" per line with the '
+        'fields of the transaction between braces like '
+        '"party: {party.code}"'
+    )
+
+    stripe_retry_schedule = fields.Char(
+        'Retry Schedule', states={
+            'invisible': Eval('provider') != 'stripe',
+        }, depends=['provider'],
+        help='Comma separated numbers of hours after which the charges of '
+        'payment profiles soft declined are retried, one per retry like '
+        '"24, 72, 168". Leave empty to never retry them.'
+    )
+
+    _stripe_config_cache = Cache(
+        'payment_gateway.gateway.get_stripe_config', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayStripe, cls).__setup__()
+        cls._buttons.update({
+            'import_stripe_customers': {
+                'invisible': Eval('provider') != 'stripe',
+                'readonly': ~Bool(Eval('active')),
+            },
+        })
+        cls.__rpc__.update({
+            'get_stripe_cache_stats': RPC(),
+        })
+        cls._error_messages.update({
+            'invalid_stripe_template': (
+                'The template "%(template)s" of gateway "%(gateway)s" is '
+                'not valid: %(error)s'
+            ),
+            'invalid_stripe_metadata': (
+                'The metadata line "%(line)s" of gateway "%(gateway)s" is '
+                'not like "key: value".'
+            ),
+            'invalid_stripe_retry_schedule': (
+                'The retry schedule "%(schedule)s" of gateway "%(gateway)s" '
+                'is not a list of hours like "24, 72, 168".'
+            ),
+        })
+
+    @staticmethod
+    def default_stripe_connect_timeout():
+        return 5
+
+    @staticmethod
+    def default_stripe_read_timeout():
+        return 30
+
+    @staticmethod
+    def default_stripe_max_connections():
+        return 10
+
+    @staticmethod
+    def default_stripe_batch_connect_timeout():
+        return 10
+
+    @staticmethod
+    def default_stripe_batch_read_timeout():
+        return 60
+
+    @staticmethod
+    def default_stripe_batch_max_connections():
+        return 10
+
     @classmethod
     def get_providers(cls, values=None):
         """
@@ -65,6 +292,345 @@ class PaymentGatewayStripe:
             }
         )]
 
+    @classmethod
+    def get_stripe_config(cls, gateway):
+        """
+        Return the stripe configuration of the gateway as a dictionary.
+
+        The configuration is cached by the process with the write date of
+        the gateway, so the operations do not build it again and again and
+        a change committed by any process is seen at once. The dictionary
+        is shared and must not be modified.
+
+        :param gateway: A gateway or its id
+        """
+        gateway = cls(int(gateway))
+        key = (gateway.id, gateway.write_date or gateway.create_date)
+        config = cls._stripe_config_cache.get(key)
+        if config is None:
+            config = gateway._get_stripe_config()
+            cls._stripe_config_cache.set(key, config)
+        return config
+
+    def _get_stripe_config(self):
+        """
+        Downstream modules can add their settings
+        """
+        return {
+            'provider': self.provider,
+            'api_key': self.stripe_api_key,
+            'publishable_key': self.stripe_publishable_key,
+            'settle_after': self.stripe_settle_after,
+            'cache_ttl': self.stripe_cache_ttl,
+            'queue': self.stripe_queue,
+            'profile_threshold': self.stripe_profile_threshold,
+            'templates': self._get_stripe_templates(),
+            'retry_schedule': self._get_stripe_retry_schedule(),
+            'http': {
+                'interactive': (
+                    self.stripe_connect_timeout or
+                    self.default_stripe_connect_timeout(),
+                    self.stripe_read_timeout or
+                    self.default_stripe_read_timeout(),
+                    self.stripe_max_connections or
+                    self.default_stripe_max_connections(),
+                ),
+                'batch': (
+                    self.stripe_batch_connect_timeout or
+                    self.default_stripe_batch_connect_timeout(),
+                    self.stripe_batch_read_timeout or
+                    self.default_stripe_batch_read_timeout(),
+                    self.stripe_batch_max_connections or
+                    self.default_stripe_batch_max_connections(),
+                    self.stripe_batch_rate_limit,
+                ),
+            },
+        }
+
+    def _get_stripe_templates(self):
+        """
+        Return the compiled templates of the charge data as a dictionary
+        with the description, the statement descriptor and the list of
+        (key, template) of the metadata
+        """
+        templates = {'metadata': []}
+        for name in ('description', 'statement_descriptor'):
+            source = getattr(self, 'stripe_%s_template' % name)
+            templates[name] = StripeTemplate(source) if source else None
+        for line in (self.stripe_metadata_template or '').splitlines():
+            if not line.strip():
+                continue
+            key, source = line.split(':', 1)
+            templates['metadata'].append(
+                (key.strip(), StripeTemplate(source.strip()))
+            )
+        return templates
+
+    def _get_stripe_retry_schedule(self):
+        """
+        Return the delays of the retries of the soft declined charges as a
+        list of timedelta
+        """
+        return [
+            timedelta(hours=float(hours))
+            for hours in (self.stripe_retry_schedule or '').split(',')
+            if hours.strip()
+        ]
+
+    @classmethod
+    def validate(cls, gateways):
+        super(PaymentGatewayStripe, cls).validate(gateways)
+        for gateway in gateways:
+            gateway.check_stripe_templates()
+            gateway.check_stripe_retry_schedule()
+
+    def check_stripe_retry_schedule(self):
+        """
+        Check the retry schedule is a list of positive numbers of hours
+        """
+        try:
+            delays = self._get_stripe_retry_schedule()
+        except ValueError:
+            delays = None
+        if delays is None or any(d <= timedelta(0) for d in delays):
+            self.raise_user_error('invalid_stripe_retry_schedule', {
+                'schedule': self.stripe_retry_schedule,
+                'gateway': self.rec_name,
+            })
+
+    def check_stripe_templates(self):
+        """
+        Check the templates of the charge data compile
+        """
+        for line in (self.stripe_metadata_template or '').splitlines():
+            if line.strip() and (
+                    ':' not in line or not line.split(':', 1)[0].strip()):
+                self.raise_user_error('invalid_stripe_metadata', {
+                    'line': line,
+                    'gateway': self.rec_name,
+                })
+        for source in (
+                self.stripe_description_template,
+                self.stripe_statement_descriptor_template,
+                self.stripe_metadata_template):
+            try:
+                StripeTemplate(source or '').check(
+                    'payment_gateway.transaction'
+                )
+            except ValueError, exc:
+                self.raise_user_error('invalid_stripe_template', {
+                    'template': source,
+                    'gateway': self.rec_name,
+                    'error': exc,
+                })
+
+    @classmethod
+    def get_stripe_http_client(cls, gateway, operation_class=None):
+        """
+        Return the HTTP client to send the stripe requests of the gateway
+        with, to be used with `stripe_http_client.use`.
+
+        :param gateway: A gateway or its id
+        :param operation_class: 'interactive' or 'batch', by default the
+                                `stripe_operation_class` of the context
+                                or 'interactive'
+        """
+        if operation_class is None:
+            operation_class = cls.get_stripe_operation_class()
+        return get_http_client(
+            (int(gateway), operation_class),
+            *cls.get_stripe_config(gateway)['http'][operation_class]
+        )
+
+    @staticmethod
+    def get_stripe_operation_class():
+        """
+        Return the class of the stripe operations of the context
+        """
+        return Transaction().context.get(
+            'stripe_operation_class', 'interactive'
+        )
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentGatewayStripe, cls).write(*args)
+        # The write date is the start of the transaction on postgresql, so
+        # it does not change with the next writes of the same transaction
+        cls._stripe_config_cache.clear()
+
+    @classmethod
+    def get_stripe_cache_stats(cls):
+        """
+        Return the hits and misses of the cache of stripe cards of this
+        process
+        """
+        return stripe_object_cache.stats()
+
+    @classmethod
+    @ModelView.button
+    def import_stripe_customers(cls, gateways):
+        """
+        Import the customers and their cards from stripe as payment profiles
+        """
+        for gateway in gateways:
+            assert gateway.provider == 'stripe'
+            gateway._import_stripe_customers()
+
+    def _get_party_by_email(self):
+        """
+        Return a dictionary of parties by email, to match the stripe
+        customers which were not created by this module
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        rv = {}
+        for mechanism in ContactMechanism.search_read(
+                [('type', '=', 'email')], fields_names=['value', 'party']):
+            rv.setdefault(mechanism['value'].lower(), mechanism['party'])
+        return rv
+
+    def _match_stripe_customers(self, customers, party_by_email):
+        """
+        Return a list of (customer, party) for the stripe customers that
+        match a party. The party id saved in the metadata of the customers
+        created by this module takes precedence over the email.
+        """
+        Party = Pool().get('party.party')
+
+        party_ids = {}
+        for customer in customers:
+            party_id = customer.metadata.get('party_id')
+            if party_id and party_id.isdigit():
+                party_ids[customer.id] = int(party_id)
+            elif (customer.email or '').lower() in party_by_email:
+                party_ids[customer.id] = party_by_email[customer.email.lower()]
+
+        # Read all the matched parties with a single search
+        parties = dict(
+            (party.id, party) for party in Party.search([
+                ('id', 'in', list(set(party_ids.values()))),
+            ])
+        )
+        return [
+            (customer, parties[party_ids[customer.id]])
+            for customer in customers
+            if party_ids.get(customer.id) in parties
+        ]
+
+    def _get_profile_data_from_stripe_card(self, customer, card, party):
+        """
+        Return the values to create a payment profile from a stripe card
+        """
+        return {
+            'name': card.name,
+            'party': party.id,
+            'address': party.addresses[0].id,
+            'gateway': self.id,
+            'last_4_digits': card.last4,
+            'expiry_month': unicode('%02d' % card.exp_month),
+            'expiry_year': unicode(card.exp_year),
+            'provider_reference': card.id,
+            'stripe_customer_id': customer.id,
+        }
+
+    def _get_profiles_from_stripe_customers(self, matches, known_cards):
+        """
+        Return the values of the profiles to create for the cards of the
+        matched customers which are not in `known_cards` yet
+        """
+        rv = []
+        for customer, party in matches:
+            if not party.addresses:
+                continue
+            sources = customer.sources
+            if sources.has_more:
+                sources = sources.auto_paging_iter()
+            for source in sources:
+                if source.object != 'card' or source.id in known_cards:
+                    continue
+                rv.append(self._get_profile_data_from_stripe_card(
+                    customer, source, party
+                ))
+                known_cards.add(source.id)
+        return rv
+
+    def _import_stripe_customers(
+            self, page_size=100, chunk_size=500, time_budget=300):
+        """
+        Page through the customers of the stripe account and create the
+        missing payment profiles.
+
+        The profiles of each page are created `chunk_size` at a time and
+        committed with the cursor, so that an error on a page does not
+        lose the previous ones. The import stops after `time_budget`
+        seconds and the next call resumes from the cursor. The statistics
+        of the import are saved.
+        """
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        CustomerImport = pool.get('payment_gateway.stripe.customer_import')
+
+        start = time.time()
+        party_by_email = self._get_party_by_email()
+        with Transaction().set_context(active_test=False):
+            known_cards = set(
+                profile['provider_reference']
+                for profile in PaymentProfile.search_read(
+                    [('gateway', '=', self.id)],
+                    fields_names=['provider_reference']
+                )
+            )
+
+        customers = cards = 0
+        cursor = self.stripe_import_cursor
+        while True:
+            params = {
+                'limit': page_size,
+            }
+            if cursor:
+                params['starting_after'] = cursor
+            try:
+                with stripe_http_client.use(
+                        self.get_stripe_http_client(self, 'batch')):
+                    page = stripe.Customer.list(
+                        api_key=self.stripe_api_key, **params
+                    )
+            except stripe.error.StripeError, exc:
+                raise UserError(stripe_error_message(exc))
+
+            profiles = self._get_profiles_from_stripe_customers(
+                self._match_stripe_customers(page.data, party_by_email),
+                known_cards
+            )
+            customers += len(page.data)
+            # Once done, the next import starts over with the new customers
+            cursor = page.data[-1].id if page.has_more else None
+
+            with own_transaction():
+                for sub_profiles in grouped_slice(profiles, chunk_size):
+                    PaymentProfile.create(list(sub_profiles))
+                self.write([self], {'stripe_import_cursor': cursor})
+            cards += len(profiles)
+
+            if not page.has_more or time.time() - start > time_budget:
+                break
+
+        duration = max(time.time() - start, 0.001)
+        CustomerImport.create([{
+            'gateway': self.id,
+            'duration': duration,
+            'customers': customers,
+            'cards': cards,
+            'complete': not page.has_more,
+            'throughput': round(customers / duration, 2),
+        }])
+        logger.info(
+            'Imported %d cards from %d stripe customers on gateway %d in '
+            '%.1fs (%.1f customers/s)',
+            cards, customers, self.id, duration, customers / duration
+        )
+        return customers, cards
+
 
 class PaymentTransactionStripe:
     """
@@ -72,6 +638,286 @@ class PaymentTransactionStripe:
     """
     __name__ = 'payment_gateway.transaction'
 
+    stripe_error_outcome = fields.Selection([
+        (None, ''),
+        ('retryable', 'Retryable'),
+        ('soft_decline', 'Soft Decline'),
+        ('hard_decline', 'Hard Decline'),
+        ('configuration', 'Configuration'),
+    ], 'Stripe Error', readonly=True, select=True, states={
+        'invisible': ~Eval('stripe_error_outcome'),
+    }, help='How the last stripe request of the transaction failed')
+    stripe_decline_code = fields.Char(
+        'Stripe Decline Code', readonly=True, select=True, states={
+            'invisible': ~Eval('stripe_decline_code'),
+        }
+    )
+    stripe_retry_count = fields.Integer(
+        'Stripe Retries', readonly=True,
+        help='Number of times the charge was retried'
+    )
+    stripe_retry_date = fields.DateTime(
+        'Next Stripe Retry', readonly=True, states={
+            'invisible': ~Eval('stripe_retry_date'),
+        }, help='Time the failed charge is retried automatically'
+    )
+    stripe_charge_attempt = fields.Integer(
+        'Stripe Charge Attempt', readonly=True,
+        help='Number of the charges declined and sent again with a new '
+        'idempotency key'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransactionStripe, cls).__setup__()
+        # Retry the failed charges
+        cls._transitions |= set((
+            ('failed', 'in-progress'),
+        ))
+        cls._error_messages.update({
+            'invalid_stripe_refund_amount': (
+                'The amount %(amount)s to refund for "%(transaction)s" must '
+                'be positive and at most the %(charged)s charged.'
+            ),
+        })
+
+    @staticmethod
+    def default_stripe_retry_count():
+        return 0
+
+    @staticmethod
+    def default_stripe_charge_attempt():
+        return 0
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionStripe, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+
+        # Webhooks, disputes and payouts look transactions up by the ids
+        # of the charges and refunds on a gateway
+        table.index_action(['gateway', 'provider_reference'], 'add')
+        # The automatic settlement looks up old authorizations
+        table.index_action(['state', 'gateway', 'date'], 'add')
+        # The retries look up the failures by outcome
+        table.index_action(['state', 'stripe_error_outcome'], 'add')
+        table.index_action(['state', 'stripe_retry_date'], 'add')
+
+    @classmethod
+    def copy(cls, transactions, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('stripe_error_outcome', None)
+        default.setdefault('stripe_decline_code', None)
+        default.setdefault('stripe_retry_count', 0)
+        default.setdefault('stripe_charge_attempt', 0)
+        default.setdefault('stripe_retry_date', None)
+        return super(PaymentTransactionStripe, cls).copy(
+            transactions, default=default
+        )
+
+    def get_stripe_failure_values(self, exc, retry=False):
+        """
+        Return the values to write on the transaction failed with the stripe
+        error
+
+        :param retry: True if the failed request is a charge to retry on the
+                      schedule of the gateway
+        """
+        outcome, decline_code = classify_stripe_error(exc)
+        return {
+            'state': 'failed',
+            'stripe_error_outcome': outcome,
+            'stripe_decline_code': decline_code,
+            'stripe_retry_date': (
+                self.get_stripe_retry_date(outcome) if retry else None
+            ),
+        }
+
+    def get_stripe_retry_date(self, outcome):
+        """
+        Return the time to retry the charge failed with the outcome, or None
+        if it must not be retried: hard declines, charges without payment
+        profile or after the last retry of the schedule
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        if outcome not in STRIPE_RETRY_OUTCOMES or not self.payment_profile:
+            return None
+        schedule = Gateway.get_stripe_config(self.gateway)['retry_schedule']
+        if (self.stripe_retry_count or 0) >= len(schedule):
+            return None
+        # Rounded so the transactions failed together are written together
+        return datetime.now().replace(microsecond=0) + \
+            schedule[self.stripe_retry_count or 0]
+
+    def get_stripe_charge_key(self, prefix):
+        """
+        Return the idempotency key of a charge of the transaction. Each retry
+        of a declined charge has its own key as stripe answers the same key
+        with the same answer. The other retries keep the key, the charge may
+        have been made by stripe.
+
+        :param prefix: 'auth' or 'capture'
+        """
+        if self.stripe_charge_attempt:
+            return '%s_%s_retry%d' % (
+                prefix, self.uuid, self.stripe_charge_attempt
+            )
+        return '%s_%s' % (prefix, self.uuid)
+
+    @classmethod
+    def create(cls, vlist):
+        # The default values are computed once per call, but each
+        # transaction needs its own uuid as the idempotency keys of its
+        # stripe requests are derived from it. Copies share one too.
+        StripeRoute = Pool().get('payment_gateway.stripe.route')
+
+        vlist = [values.copy() for values in vlist]
+        uuids = set()
+        routes = None
+        for values in vlist:
+            if not values.get('uuid') or values['uuid'] in uuids:
+                values['uuid'] = cls.default_uuid()
+            uuids.add(values['uuid'])
+            if not values.get('gateway'):
+                if routes is None:
+                    # Read once for all the transactions created
+                    routes = StripeRoute.search([])
+                gateway = cls.route_stripe_gateway(values, routes)
+                if gateway:
+                    values['gateway'] = gateway.id
+        return super(PaymentTransactionStripe, cls).create(vlist)
+
+    @classmethod
+    def route_stripe_gateway(cls, values, routes=None):
+        """
+        Return the gateway of a new transaction created without one: the
+        gateway of its payment profile or the one selected by the stripe
+        routes, if any.
+
+        :param values: The values the transaction is created with
+        :param routes: The stripe routes to match, by default all of them
+        """
+        pool = Pool()
+        PaymentProfile = pool.get('party.payment_profile')
+        StripeRoute = pool.get('payment_gateway.stripe.route')
+
+        if values.get('payment_profile'):
+            # A saved card can only be charged on its stripe account
+            return PaymentProfile(values['payment_profile']).gateway
+        return StripeRoute.get_gateway(
+            cls.get_stripe_route_pattern(values), routes
+        )
+
+    @classmethod
+    def get_stripe_route_pattern(cls, values):
+        """
+        Return the pattern to match the stripe routes against, from the
+        values a transaction is created with.
+        Downstream modules can add their criteria.
+        """
+        Address = Pool().get('party.address')
+
+        country = None
+        if values.get('address'):
+            country = Address(values['address']).country
+        return {
+            'currency': values.get('currency') or cls.default_currency(),
+            'country': country and country.id,
+        }
+
+    @classmethod
+    def get_ids_by_provider_reference(cls, gateway, references):
+        """
+        Return a dictionary of transaction ids by the stripe charge or refund
+        ids saved as their provider reference.
+
+        :param gateway: The gateway the stripe objects belong to
+        :param references: A list of stripe charge or refund ids
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        rv = {}
+        for sub_references in grouped_slice(list(set(references))):
+            cursor.execute(*table.select(
+                table.provider_reference, table.id,
+                where=(table.gateway == int(gateway)) &
+                table.provider_reference.in_(list(sub_references)),
+                # The oldest transaction wins if a reference is repeated
+                order_by=table.id.desc
+            ))
+            rv.update(cursor.fetchall())
+        return rv
+
+    @classmethod
+    def _enqueue_stripe(cls, transactions, operation, state=None):
+        """
+        Queue the operation for the transactions of stripe gateways in queue
+        mode and return the other transactions.
+
+        :param operation: The name of the operation, as in <operation>_stripe
+        :param state: The state the workflow moves the transactions to, they
+                      are only queued if the transition is allowed
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        StripeJob = pool.get('payment_gateway.stripe.job')
+
+        queued, inline = [], []
+        for transaction in transactions:
+            config = Gateway.get_stripe_config(transaction.gateway)
+            if (
+                config['provider'] == 'stripe' and config['queue'] and (
+                    state is None or
+                    (transaction.state, state) in cls._transitions
+                )
+            ):
+                queued.append(transaction)
+            else:
+                inline.append(transaction)
+        if queued:
+            StripeJob.enqueue(queued, operation)
+        return inline
+
+    @classmethod
+    @ModelView.button
+    def authorize(cls, transactions):
+        inline = cls._enqueue_stripe(transactions, 'authorize', 'in-progress')
+        queued = [t for t in transactions if t not in inline]
+        if queued:
+            cls.write(queued, {'state': 'in-progress'})
+        super(PaymentTransactionStripe, cls).authorize(inline)
+
+    @classmethod
+    @ModelView.button
+    def capture(cls, transactions):
+        inline = cls._enqueue_stripe(transactions, 'capture', 'in-progress')
+        queued = [t for t in transactions if t not in inline]
+        if queued:
+            cls.write(queued, {'state': 'in-progress'})
+        super(PaymentTransactionStripe, cls).capture(inline)
+
+    @classmethod
+    @ModelView.button
+    def settle(cls, transactions):
+        # The settlement sets the state, it stays authorized until then
+        super(PaymentTransactionStripe, cls).settle(
+            cls._enqueue_stripe(transactions, 'settle', 'completed')
+        )
+
+    @classmethod
+    @ModelView.button
+    def cancel(cls, transactions):
+        super(PaymentTransactionStripe, cls).cancel(
+            cls._enqueue_stripe(transactions, 'cancel', 'cancel')
+        )
+
     @property
     def stripe_amount(self):
         """
@@ -80,36 +926,30 @@ class PaymentTransactionStripe:
 
         https://stripe.com/docs/currencies#zero-decimal
         """
-        if self.currency.code in (
-                'BIF', 'XAF', 'XPF', 'CLP',
-                'KMF', 'DJF', 'GNF', 'JPY',
-                'MGA', 'PYG', 'RWF', 'KRW',
-                'VUV', 'VND', 'XOF'):
+        if self.currency.code in ZERO_DECIMAL_CURRENCIES:
             return int(self.amount)
         return int(self.amount * 100)
 
+    @stripe_profiled
     def authorize_stripe(self, card_info=None):
         """
         Authorize using stripe.
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
-        stripe.api_key = self.gateway.stripe_api_key
-
-        charge_data = self.get_stripe_charge_data(card_info=card_info)
-        charge_data['idempotency_key'] = 'auth_%s' % self.uuid
+        with profile_phase('charge_data'):
+            charge_data = self.get_stripe_charge_data(card_info=card_info)
         charge_data['capture'] = False
 
         try:
-            charge = stripe.Charge.create(**charge_data)
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.json_body)
+            charge = StripeRequest.call(
+                self.gateway, 'charge', self.get_stripe_charge_key('auth'),
+                charge_data, self
+            )
+        except stripe.error.StripeError, exc:
+            self.write([self], self.get_stripe_failure_values(exc, True))
+            TransactionLog.serialize_and_create(self, stripe_error_body(exc))
         else:
             if charge.status == 'succeeded':
                 self.state = 'authorized'
@@ -122,27 +962,27 @@ class PaymentTransactionStripe:
                 'log': unicode(charge),
             }])
 
+    @stripe_profiled
     def settle_stripe(self):
         """
         Settle an authorized charge
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
 
-        assert self.state == 'authorized'
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
-        stripe.api_key = self.gateway.stripe_api_key
+        assert self.state == 'authorized'
 
         try:
-            charge = stripe.Charge.retrieve(self.provider_reference)
-            charge = charge.capture(amount=self.stripe_amount)
-        except (
-            stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.json_body)
+            charge = StripeRequest.call(
+                self.gateway, 'capture', 'settle_%s' % self.uuid, {
+                    'charge': self.provider_reference,
+                    'amount': self.stripe_amount,
+                }, self
+            )
+        except stripe.error.StripeError, exc:
+            self.write([self], self.get_stripe_failure_values(exc))
+            TransactionLog.serialize_and_create(self, stripe_error_body(exc))
         else:
             if charge.status == 'succeeded':
                 self.state = 'completed'
@@ -154,30 +994,29 @@ class PaymentTransactionStripe:
                 'transaction': self,
                 'log': unicode(charge),
             }])
-            self.safe_post()
+            with profile_phase('post'):
+                self.safe_post()
 
+    @stripe_profiled
     def capture_stripe(self, card_info=None):
         """
         Capture using stripe.
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
-        stripe.api_key = self.gateway.stripe_api_key
-
-        charge_data = self.get_stripe_charge_data(card_info=card_info)
-        charge_data['idempotency_key'] = 'capture_%s' % self.uuid
+        with profile_phase('charge_data'):
+            charge_data = self.get_stripe_charge_data(card_info=card_info)
         charge_data['capture'] = True
 
         try:
-            charge = stripe.Charge.create(**charge_data)
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.json_body)
+            charge = StripeRequest.call(
+                self.gateway, 'charge', self.get_stripe_charge_key('capture'),
+                charge_data, self
+            )
+        except stripe.error.StripeError, exc:
+            self.write([self], self.get_stripe_failure_values(exc, True))
+            TransactionLog.serialize_and_create(self, stripe_error_body(exc))
         else:
             if charge.status == 'succeeded':
                 self.state = 'completed'
@@ -189,7 +1028,8 @@ class PaymentTransactionStripe:
                 'transaction': self,
                 'log': unicode(charge),
             }])
-            self.safe_post()
+            with profile_phase('post'):
+                self.safe_post()
 
     def get_stripe_charge_data(self, card_info=None):
         """
@@ -201,7 +1041,14 @@ class PaymentTransactionStripe:
             'currency': self.currency.code.lower(),
         }
 
-        if card_info:
+        stripe_token = getattr(card_info, 'stripe_token', None)
+
+        if stripe_token:
+            # Card was tokenized on the client, so no card data ever
+            # passes through the server.
+            charge_data['source'] = stripe_token
+
+        elif card_info:
             charge_data['source'] = {
                 'object': 'card',
                 'number': card_info.number,
@@ -221,15 +1068,210 @@ class PaymentTransactionStripe:
         else:
             self.raise_user_error('no_card_or_profile')
 
+        charge_data.update(self.get_stripe_template_data())
         return charge_data
 
+    def get_stripe_template_data(self):
+        """
+        Return the description, the statement descriptor and the metadata
+        of the charge rendered from the templates of the gateway. The empty
+        ones are not sent.
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        templates = Gateway.get_stripe_config(self.gateway)['templates']
+        data = {}
+        if templates['description']:
+            description = templates['description'].render(self)
+            if description:
+                data['description'] = description
+        if templates['statement_descriptor']:
+            descriptor = STATEMENT_DESCRIPTOR_FORBIDDEN.sub(
+                '', templates['statement_descriptor'].render(self)
+            )[:STATEMENT_DESCRIPTOR_LENGTH].strip()
+            if descriptor:
+                data['statement_descriptor'] = descriptor
+        metadata = {}
+        for key, template in templates['metadata']:
+            value = template.render(self)
+            if value:
+                # The limits of stripe on the keys and the values
+                metadata[key[:40]] = value[:500]
+        if metadata:
+            data['metadata'] = metadata
+        return data
+
+    @classmethod
+    def get_stripe_charge_data_batch(cls, transactions, card_infos=None):
+        """
+        Return the stripe charge data of the transactions as a dictionary by
+        transaction id.
+
+        The related records (currencies, parties and payment profiles, or
+        addresses with their subdivisions and countries for the cards
+        entered by hand) are read once for the whole batch before the
+        charge data is built.
+
+        :param transactions: The transactions to charge
+        :param card_infos: Optional dictionary of the cards entered by hand
+                           by transaction id, the others are charged on
+                           their payment profile
+        """
+        card_infos = card_infos or {}
+        transactions = cls.browse(transactions)
+        cls._prefetch_stripe_charge_data(transactions, card_infos)
+        return dict(
+            (transaction.id, transaction.get_stripe_charge_data(
+                card_info=card_infos.get(transaction.id)
+            ))
+            for transaction in transactions
+        )
+
+    @classmethod
+    def _prefetch_stripe_charge_data(cls, transactions, card_infos):
+        """
+        Read once the records the charge data of the transactions is built
+        from. They are kept in the cache of the transaction, where the
+        records browsed later find them.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Party = pool.get('party.party')
+        PaymentProfile = pool.get('party.payment_profile')
+        Address = pool.get('party.address')
+        Subdivision = pool.get('country.subdivision')
+        Country = pool.get('country.country')
+
+        def fetch(Model, records, name):
+            # The first access reads the fields of all the records at once
+            records = Model.browse(list(set(r.id for r in records if r)))
+            for record in records:
+                getattr(record, name)
+            return records
+
+        with_card = [t for t in transactions if t.id in card_infos]
+        with_profile = [t for t in transactions if t.id not in card_infos]
+        fetch(Currency, [t.currency for t in transactions], 'code')
+        fetch(Party, [t.party for t in transactions], 'name')
+        fetch(
+            PaymentProfile, [t.payment_profile for t in with_profile],
+            'provider_reference'
+        )
+        addresses = fetch(Address, [t.address for t in with_card], 'street')
+        fetch(Subdivision, [a.subdivision for a in addresses], 'name')
+        fetch(Country, [a.country for a in addresses], 'name')
+
     def retry_stripe(self, credit_card=None):
         """
         Retry charge
 
-        :param credit_card: An instance of CreditCardView
+        The charge is made again like the one which failed, an authorization
+        or a capture, with a new idempotency key if it was declined.
+
+        :param credit_card: An instance of CreditCardView, by default the
+                            payment profile is charged
         """
-        raise self.raise_user_error('feature_not_available')
+        capture = self.get_stripe_retry_capture([self])[self.id]
+        self.write([self], self._get_stripe_retry_values())
+        if capture:
+            self.capture_stripe(card_info=credit_card)
+        else:
+            self.authorize_stripe(card_info=credit_card)
+
+    def _get_stripe_retry_values(self):
+        attempt = self.stripe_charge_attempt or 0
+        if self.stripe_error_outcome == 'soft_decline':
+            attempt += 1
+        return {
+            'stripe_retry_count': (self.stripe_retry_count or 0) + 1,
+            'stripe_charge_attempt': attempt,
+            'stripe_retry_date': None,
+            'stripe_error_outcome': None,
+            'stripe_decline_code': None,
+        }
+
+    @classmethod
+    def get_stripe_retry_capture(cls, transactions):
+        """
+        Return a dictionary telling by transaction id if its last charge was
+        a capture rather than an authorization, from the ledger
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        capture = dict((t.id, True) for t in transactions)
+        for sub_transactions in grouped_slice(transactions):
+            for record in StripeRequest.search([
+                    ('transaction', 'in', [t.id for t in sub_transactions]),
+                    ('operation', '=', 'charge'),
+                    ], order=[('id', 'ASC')]):
+                if record.request:
+                    capture[record.transaction.id] = json.loads(
+                        record.request
+                    ).get('capture', True)
+        return capture
+
+    @classmethod
+    def retry_stripe_transactions(cls, batch_size=100, workers=8):
+        """
+        Charge again the payment profiles of the transactions soft declined
+        whose retry time has come.
+
+        This method is meant to be called from the cron. The retries follow
+        the schedule of the gateways and stop with the hard declines. They
+        are sent in batches, with at most `workers` simultaneous stripe calls.
+        The charges whose outcome is unknown are left to the replay of the
+        ledger.
+        """
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
+
+        transactions = cls.search([
+            ('state', '=', 'failed'),
+            ('stripe_retry_date', '<=', datetime.now()),
+            ('stripe_error_outcome', 'in', STRIPE_RETRY_OUTCOMES),
+            ('payment_profile', '!=', None),
+        ], order=[('stripe_retry_date', 'ASC'), ('id', 'ASC')])
+        pending = set()
+        for sub_transactions in grouped_slice(transactions):
+            records = StripeRequest.search([
+                ('transaction', 'in', [t.id for t in sub_transactions]),
+                ('operation', '=', 'charge'),
+                ('status', '=', 'pending'),
+            ])
+            pending.update(record.transaction.id for record in records)
+        transactions = [t for t in transactions if t.id not in pending]
+
+        stats = {'captured': 0, 'authorized': 0, 'failed': 0}
+        with Transaction().set_context(stripe_operation_class='batch'):
+            for sub_transactions in grouped_slice(transactions, batch_size):
+                for key, value in cls._retry_stripe_batch(
+                        list(sub_transactions), workers).iteritems():
+                    stats[key] += value
+        logger.info(
+            'Retried %s stripe charges: %s captured, %s authorized, %s failed',
+            len(transactions), stats['captured'], stats['authorized'],
+            stats['failed']
+        )
+        return stats
+
+    @classmethod
+    def _retry_stripe_batch(cls, transactions, workers=8):
+        capture = cls.get_stripe_retry_capture(transactions)
+        to_write = []
+        for transaction in transactions:
+            to_write.extend([[transaction], dict(
+                transaction._get_stripe_retry_values(), state='in-progress'
+            )])
+        cls.write(*to_write)
+
+        stats = {'captured': 0, 'authorized': 0, 'failed': 0}
+        for flag, charged in ((True, 'captured'), (False, 'authorized')):
+            flag_stats = cls._charge_stripe_batch(
+                [t for t in transactions if capture[t.id] == flag], flag,
+                workers
+            )
+            stats[charged] += flag_stats['charged']
+            stats['failed'] += flag_stats['failed']
+        return stats
 
     def update_stripe(self):
         """
@@ -237,27 +1279,25 @@ class PaymentTransactionStripe:
         """
         raise self.raise_user_error('feature_not_available')
 
+    @stripe_profiled
     def cancel_stripe(self):
         """
         Cancel this authorization or request
         """
         TransactionLog = Pool().get('payment_gateway.transaction.log')
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
         if self.state != 'authorized':
             self.raise_user_error('cancel_only_authorized')
 
-        stripe.api_key = self.gateway.stripe_api_key
-
         try:
-            charge = stripe.Charge.retrieve(
-                self.provider_reference
-            ).refund(idempotency_key=('refund_%s' % self.uuid))
-        except (
-            stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            TransactionLog.serialize_and_create(self, exc.json_body)
+            charge = StripeRequest.call(
+                self.gateway, 'cancel', 'refund_%s' % self.uuid, {
+                    'charge': self.provider_reference,
+                }, self
+            )
+        except stripe.error.StripeError, exc:
+            TransactionLog.serialize_and_create(self, stripe_error_body(exc))
         else:
             self.state = 'cancel'
             self.save()
@@ -266,24 +1306,21 @@ class PaymentTransactionStripe:
                 'log': unicode(charge),
             }])
 
+    @stripe_profiled
     def refund_stripe(self):
         TransactionLog = Pool().get('payment_gateway.transaction.log')
-
-        stripe.api_key = self.gateway.stripe_api_key
+        StripeRequest = Pool().get('payment_gateway.stripe.request')
 
         try:
-            refund = stripe.Refund.create(
-                charge=self.origin.provider_reference,
-                amount=self.stripe_amount
+            refund = StripeRequest.call(
+                self.gateway, 'refund', 'refund_%s' % self.uuid, {
+                    'charge': self.origin.provider_reference,
+                    'amount': self.stripe_amount,
+                }, self
             )
-        except (
-            stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            self.state = 'failed'
-            self.save()
-            TransactionLog.serialize_and_create(self, exc.json_body)
+        except stripe.error.StripeError, exc:
+            self.write([self], self.get_stripe_failure_values(exc))
+            TransactionLog.serialize_and_create(self, stripe_error_body(exc))
         else:
             self.provider_reference = refund.id
             self.state = 'completed'
@@ -292,7 +1329,540 @@ class PaymentTransactionStripe:
                 'transaction': self,
                 'log': unicode(refund),
             }])
-            self.safe_post()
+            with profile_phase('post'):
+                self.safe_post()
+
+    @classmethod
+    @ModelView.button
+    def refund(cls, transactions):
+        # Each refund goes through refund_stripe, like the queued ones, so
+        # that its overrides apply
+        super(PaymentTransactionStripe, cls).refund(
+            cls._enqueue_stripe(transactions, 'refund')
+        )
+
+    @classmethod
+    def refund_stripe_batch(cls, transactions, amounts=None, workers=8):
+        """
+        Refund many stripe transactions at once and return the number of
+        transactions refunded and failed as a dictionary.
+
+        The charges being refunded are read in a single query, the refunds
+        are sent to stripe simultaneously and the results are written back
+        with a single write. Unlike the refund button and the queued
+        refunds, it does not go through refund_stripe, so the overrides of
+        refund_stripe do not apply to it.
+
+        :param transactions: Refund transactions to process
+        :param amounts: Optional dictionary of partial amounts to refund by
+                        transaction id, positive and at most the amount of
+                        the charge
+        :param workers: The maximum number of simultaneous stripe calls
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        for transaction in transactions:
+            assert transaction.type == 'refund', \
+                "Transaction type must be refund"
+
+        if amounts:
+            cls._check_refund_amounts(transactions, amounts)
+            cls._set_refund_amounts(transactions, amounts)
+
+        # Prefetch the charges being refunded
+        transactions = cls.browse(transactions)
+        charge_ids = dict(
+            (origin['id'], origin['provider_reference'])
+            for origin in cls.read(
+                [t.origin.id for t in transactions], ['provider_reference']
+            )
+        )
+
+        results = cls._send_stripe_requests([(
+            transaction.gateway, 'refund', 'refund_%s' % transaction.uuid, {
+                'charge': charge_ids[transaction.origin.id],
+                'amount': transaction.stripe_amount,
+            }, transaction
+        ) for transaction in transactions], workers)
+
+        stats = {'refunded': 0, 'failed': 0}
+        to_write, completed, failed, logs = [], [], [], []
+        for transaction, refund, exc in results:
+            if exc is not None:
+                stats['failed'] += 1
+                failed.append((transaction, exc))
+                TransactionLog.serialize_and_create(
+                    transaction, stripe_error_body(exc)
+                )
+                continue
+            stats['refunded'] += 1
+            to_write.extend([[transaction], {
+                'state': 'completed',
+                'provider_reference': refund.id,
+            }])
+            completed.append(transaction)
+            logs.append({
+                'transaction': transaction.id,
+                'log': unicode(refund),
+            })
+        to_write.extend(cls._get_stripe_failure_writes(failed))
+        if to_write:
+            cls.write(*to_write)
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction in cls.browse(completed):
+            transaction.safe_post()
+        return stats
+
+    @classmethod
+    def capture_stripe_batch(cls, transactions, workers=8):
+        """
+        Capture many stripe transactions paid with a saved payment profile
+        at once and return the number of transactions captured and failed
+        as a dictionary.
+
+        The transactions which could not reach stripe are left as they are,
+        the replay of the pending stripe requests updates them.
+
+        :param transactions: Transactions to capture
+        :param workers: The maximum number of simultaneous stripe calls
+        """
+        stats = cls._charge_stripe_batch(transactions, True, workers)
+        return {'captured': stats['charged'], 'failed': stats['failed']}
+
+    @classmethod
+    def _charge_stripe_batch(cls, transactions, capture, workers=8):
+        """
+        Charge the payment profiles of the transactions, capturing or only
+        authorizing the charges, and return the number of transactions
+        charged and failed as a dictionary.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        state = 'completed' if capture else 'authorized'
+        transactions = cls.browse(transactions)
+        charge_data = cls.get_stripe_charge_data_batch(transactions)
+        results = cls._send_stripe_requests([(
+            transaction.gateway, 'charge', transaction.get_stripe_charge_key(
+                'capture' if capture else 'auth'
+            ), dict(charge_data[transaction.id], capture=capture), transaction
+        ) for transaction in transactions], workers)
+
+        stats = {'charged': 0, 'failed': 0}
+        to_write, completed, failed, logs = [], [], [], []
+        for transaction, charge, exc in results:
+            if exc is not None:
+                # Like a single charge, the charges whose outcome is unknown
+                # fail until the replay of the ledger recovers them
+                stats['failed'] += 1
+                failed.append((transaction, exc))
+                TransactionLog.serialize_and_create(
+                    transaction, stripe_error_body(exc)
+                )
+                continue
+            if charge.status == 'succeeded':
+                stats['charged'] += 1
+                to_write.extend([[transaction], {
+                    'state': state,
+                    'provider_reference': charge.id,
+                }])
+                if capture:
+                    completed.append(transaction)
+            else:
+                stats['failed'] += 1
+                to_write.extend([[transaction], {
+                    'state': 'failed',
+                    'provider_reference': charge.id,
+                }])
+            logs.append({
+                'transaction': transaction.id,
+                'log': unicode(charge),
+            })
+        to_write.extend(cls._get_stripe_failure_writes(failed, True))
+        if to_write:
+            cls.write(*to_write)
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction in cls.browse(completed):
+            transaction.safe_post()
+        return stats
+
+    @classmethod
+    def _get_stripe_failure_writes(cls, failures, retry=False):
+        """
+        Return the arguments of write failing the transactions, those which
+        failed the same way are written together
+
+        :param failures: A list of tuples (transaction, exception)
+        :param retry: True if the failed requests are charges to retry
+        """
+        groups = {}
+        for transaction, exc in failures:
+            values = transaction.get_stripe_failure_values(exc, retry)
+            groups.setdefault(
+                tuple(sorted(values.iteritems())), []
+            ).append(transaction)
+        to_write = []
+        for values, transactions in groups.iteritems():
+            to_write.extend([transactions, dict(values)])
+        return to_write
+
+    @classmethod
+    def process_stripe_batch(
+            cls, method, transactions, processes=2, chunk_size=100,
+            **kwargs):
+        """
+        Run a batch method on the transactions split in chunks among
+        processes and return the sum of their statistics.
+
+        Each chunk is run and committed in its own transaction by one of the
+        processes, so the transactions must not be changed by the calling
+        transaction before nor after.
+
+        :param method: 'settle_stripe_batch', 'capture_stripe_batch' or
+                       'refund_stripe_batch'
+        :param processes: The number of processes, each making up to
+                          `workers` simultaneous stripe calls
+        :param chunk_size: The number of transactions of a chunk
+        """
+        shards = [
+            list(ids)
+            for ids in grouped_slice(map(int, transactions), chunk_size)
+        ]
+        with Transaction().set_context(stripe_operation_class='batch'), \
+                StripeProcessPool(processes) as pool:
+            results = pool.map(cls.__name__, method, shards, **kwargs)
+        stats = {}
+        for ids, result, exc in results:
+            if exc is not None:
+                logger.error(
+                    'Failed to run %s on stripe transactions %s: %s',
+                    method, ids, exc
+                )
+                stats['errors'] = stats.get('errors', 0) + 1
+                continue
+            for key, value in result.iteritems():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    @classmethod
+    def _send_stripe_requests(cls, requests, workers=8):
+        """
+        Record the requests in the ledger, send them to stripe simultaneously
+        and return a list of tuples (transaction, response, exception) in the
+        same order.
+
+        The requests are grouped by gateway, each group is sent by its own
+        threads, at most as many as the connections of its gateway.
+
+        :param requests: A list of tuples (gateway, operation, key, params,
+                         transaction)
+        :param workers: The maximum number of simultaneous stripe calls of
+                        a gateway
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        StripeRequest = pool.get('payment_gateway.stripe.request')
+
+        records = StripeRequest.prepare(requests, commit=True)
+
+        # The threads only get plain data, the records are not thread safe
+        operation_class = Gateway.get_stripe_operation_class()
+        groups = {}
+        for index, (gateway, operation, key, params, transaction) in \
+                enumerate(requests):
+            config = Gateway.get_stripe_config(gateway)
+            group = groups.setdefault(int(gateway), (
+                min(workers, config['http'][operation_class][2]), []
+            ))
+            group[1].append((index, (
+                config['api_key'], operation, key, params,
+                Gateway.get_stripe_http_client(gateway, operation_class)
+            )))
+
+        def send(group):
+            return stripe_map(
+                lambda item: StripeRequest.send(*item[1]), group[1], group[0]
+            )
+
+        results = [None] * len(requests)
+        for _, group_results, exc in stripe_map(
+                send, groups.values(), len(groups)):
+            if exc is not None:
+                raise exc
+            for (index, _), response, exc in group_results:
+                if exc is not None and \
+                        not isinstance(exc, stripe.error.StripeError):
+                    raise exc
+                results[index] = (requests[index][4], response, exc)
+
+        StripeRequest.record_results([
+            (record, response, exc)
+            for record, (_, response, exc) in zip(records, results)
+        ], commit=True)
+        return results
+
+    @classmethod
+    def _check_refund_amounts(cls, transactions, amounts):
+        for transaction in cls.browse(transactions):
+            if transaction.id not in amounts:
+                continue
+            amount = amounts[transaction.id]
+            if not 0 < amount <= transaction.origin.amount:
+                cls.raise_user_error('invalid_stripe_refund_amount', {
+                    'amount': amount,
+                    'transaction': transaction.rec_name,
+                    'charged': transaction.origin.amount,
+                })
+
+    @classmethod
+    def _set_refund_amounts(cls, transactions, amounts):
+        """
+        Write the partial amounts to refund, grouping the transactions
+        refunding the same amount
+        """
+        by_amount = {}
+        for transaction in transactions:
+            if transaction.id in amounts:
+                by_amount.setdefault(amounts[transaction.id], []).append(
+                    transaction
+                )
+        to_write = []
+        for amount, records in by_amount.iteritems():
+            to_write.extend([records, {'amount': amount}])
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def settle_stripe_batch(cls, transactions, workers=8):
+        """
+        Settle many authorized stripe transactions at once and return the
+        number of transactions settled, skipped and failed as a dictionary.
+
+        The charges already captured on stripe are only marked as completed,
+        the captures which did not succeed fail. The transactions which
+        could not reach stripe fail like a single settlement, until the
+        replay of the ledger recovers them.
+
+        :param transactions: Authorized transactions to settle
+        :param workers: The maximum number of simultaneous stripe calls
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        results = cls._send_stripe_requests([(
+            transaction.gateway, 'capture', 'settle_%s' % transaction.uuid, {
+                'charge': transaction.provider_reference,
+                'amount': transaction.stripe_amount,
+            }, transaction
+        ) for transaction in transactions], workers)
+
+        stats = {'settled': 0, 'skipped': 0, 'failed': 0}
+        completed, declined, failed, logs = [], [], [], []
+        for transaction, charge, exc in results:
+            if exc is None:
+                if charge.status == 'succeeded' and charge.captured:
+                    stats['settled'] += 1
+                    completed.append(transaction)
+                else:
+                    # Like a single settlement, the capture did not succeed
+                    stats['failed'] += 1
+                    declined.append(transaction)
+                logs.append({
+                    'transaction': transaction.id,
+                    'log': unicode(charge),
+                })
+            elif getattr(exc, 'code', None) == 'charge_already_captured':
+                stats['skipped'] += 1
+                completed.append(transaction)
+                TransactionLog.serialize_and_create(
+                    transaction, stripe_error_body(exc)
+                )
+            else:
+                stats['failed'] += 1
+                failed.append((transaction, exc))
+                TransactionLog.serialize_and_create(
+                    transaction, stripe_error_body(exc)
+                )
+
+        to_write = []
+        if completed:
+            to_write.extend([completed, {'state': 'completed'}])
+        if declined:
+            to_write.extend([declined, {'state': 'failed'}])
+        to_write.extend(cls._get_stripe_failure_writes(failed))
+        if to_write:
+            cls.write(*to_write)
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction in cls.browse(completed):
+            transaction.safe_post()
+        return stats
+
+    @classmethod
+    def settle_stripe_authorizations(
+            cls, chunk_size=100, workers=8, time_budget=300, processes=1):
+        """
+        Settle the stripe authorizations older than the number of days set
+        on their gateway.
+
+        This method is meant to be called from the cron. The transactions
+        are settled in chunks until the time budget (in seconds) is spent,
+        the others are left to the next run. With more than one process,
+        as many chunks are settled at once by the processes, each in its
+        own transaction. The statistics of the run are saved.
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        SettlementRun = pool.get('payment_gateway.stripe.settlement.run')
+        Date = pool.get('ir.date')
+
+        gateways = Gateway.search([
+            ('provider', '=', 'stripe'),
+            ('stripe_settle_after', '!=', None),
+        ])
+        if not gateways:
+            return
+
+        started = time.time()
+        today = Date.today()
+        transactions = cls.search([
+            ('state', '=', 'authorized'),
+            ('type', '=', 'charge'),
+            ['OR'] + [[
+                ('gateway', '=', gateway.id),
+                ('date', '<=', today - timedelta(
+                    days=gateway.stripe_settle_after
+                )),
+            ] for gateway in gateways],
+        ], order=[('date', 'ASC'), ('id', 'ASC')])
+
+        stats = {'settled': 0, 'skipped': 0, 'failed': 0}
+        with Transaction().set_context(stripe_operation_class='batch'), \
+                StripeProcessPool(processes) as process_pool:
+            for sub_ids in grouped_slice(
+                    map(int, transactions), chunk_size * processes):
+                if time.time() - started > time_budget:
+                    break
+                for ids, result, exc in process_pool.map(
+                        cls.__name__, 'settle_stripe_batch', [
+                            list(ids) for ids in grouped_slice(
+                                list(sub_ids), chunk_size)
+                        ], workers=workers):
+                    if exc is not None:
+                        # Left to the next run
+                        logger.error(
+                            'Failed to settle stripe transactions %s: %s',
+                            ids, exc
+                        )
+                        continue
+                    for key, value in result.iteritems():
+                        stats[key] += value
+
+        duration = time.time() - started
+        processed = sum(stats.values())
+        SettlementRun.create([{
+            'duration': duration,
+            'selected': len(transactions),
+            'remaining': len(transactions) - processed,
+            'throughput': round(processed / duration, 2) if duration else 0,
+            'settled': stats['settled'],
+            'skipped': stats['skipped'],
+            'failed': stats['failed'],
+        }])
+        logger.info(
+            'Settled %s stripe authorizations in %.1fs (%s skipped, %s '
+            'failed, %s left)', stats['settled'], duration, stats['skipped'],
+            stats['failed'], len(transactions) - processed
+        )
+
+    @classmethod
+    def stripe_requests_recovered(cls, results):
+        """
+        Update the transactions whose stripe request was replayed after its
+        outcome was lost.
+
+        :param results: A list of tuples (ledger record, stripe response)
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        to_write, completed, logs = [], [], []
+        for record, response in results:
+            transaction = record.transaction
+            if transaction.state in ('completed', 'cancel'):
+                continue
+            values = {}
+            if record.operation == 'charge':
+                values['state'] = (
+                    'completed' if response.captured else 'authorized'
+                )
+            elif record.operation == 'cancel':
+                values['state'] = 'cancel'
+            else:
+                values['state'] = 'completed'
+            if record.operation != 'cancel':
+                values['provider_reference'] = response.id
+            values.update({
+                'stripe_retry_date': None,
+                'stripe_error_outcome': None,
+                'stripe_decline_code': None,
+            })
+            to_write.extend([[transaction], values])
+            if values['state'] == 'completed':
+                completed.append(transaction)
+            logs.append({
+                'transaction': transaction.id,
+                'log': unicode(response),
+            })
+        if to_write:
+            cls.write(*to_write)
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction in cls.browse(completed):
+            transaction.safe_post()
+
+
+class StripeTokenViewMixin(object):
+    """
+    Allow the card views to carry a token created with Stripe.js instead of
+    the raw card data
+    """
+    stripe_token = fields.Char(
+        'Stripe Token',
+        help='Token or source id created on the client with Stripe.js'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(StripeTokenViewMixin, cls).__setup__()
+        # The card data is only known to stripe when a token is given
+        for name in ['owner', 'number', 'expiry_month', 'expiry_year', 'csc']:
+            field = getattr(cls, name)
+            field.states = field.states.copy()
+            field.states['required'] = (
+                field.states.get('required', False) &
+                ~Bool(Eval('stripe_token'))
+            )
+            if name != 'owner':
+                # The owner is kept as it may differ from the card name
+                field.states['invisible'] = (
+                    field.states.get('invisible', False) |
+                    Bool(Eval('stripe_token'))
+                )
+            field.depends = field.depends + ['stripe_token']
+
+
+class AddPaymentProfileView(StripeTokenViewMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'party.payment_profile.add_view'
+
+
+class TransactionUseCardView(StripeTokenViewMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'payment_gateway.transaction.use_card.view'
 
 
 class AddPaymentProfile:
@@ -306,8 +1876,63 @@ class AddPaymentProfile:
         Handle the case if the profile should be added for Stripe
         """
         card_info = self.card_info
+        stripe_token = getattr(card_info, 'stripe_token', None)
+
+        if stripe_token:
+            source = stripe_token
+        else:
+            source = self._get_stripe_card_data()['source']
+
+        try:
+            customer_id, card = card_info.party._add_stripe_source(
+                card_info.gateway, source
+            )
+        except stripe.error.StripeError, exc:
+            raise UserError(stripe_error_message(exc))
+
+        if stripe_token:
+            # The card details are only known to stripe
+            return self.create_stripe_token_profile(
+                card.id,
+                name=card_info.owner or card.name,
+                last_4_digits=card.last4,
+                expiry_month=unicode('%02d' % card.exp_month),
+                expiry_year=unicode(card.exp_year),
+                stripe_customer_id=customer_id,
+            )
+        return self.create_profile(
+            card.id,
+            stripe_customer_id=customer_id
+        )
+
+    def create_stripe_token_profile(self, provider_reference, **kwargs):
+        """
+        Create the profile of a card added with a stripe token, like
+        create_profile but from the card details given by stripe instead
+        of the card information of the wizard.
+
+        :param provider_reference: Value for the provider_reference field.
+        :return: Active record of the created profile
+        """
+        Profile = Pool().get('party.payment_profile')
+
+        profile = Profile(
+            party=self.card_info.party.id,
+            address=self.card_info.address.id,
+            gateway=self.card_info.gateway.id,
+            provider_reference=provider_reference,
+            **kwargs
+        )
+        profile.save()
+
+        self.card_info.stripe_token = None
+        return profile
 
-        stripe.api_key = card_info.gateway.stripe_api_key
+    def _get_stripe_card_data(self):
+        """
+        Return the raw card data entered in the wizard as a stripe source
+        """
+        card_info = self.card_info
 
         profile_data = {
             'source': {
@@ -323,30 +1948,4 @@ class AddPaymentProfile:
         }
         profile_data['source'].update(
             card_info.address.get_address_for_stripe())
-
-        customer_id = card_info.party._get_stripe_customer_id(
-            card_info.gateway
-        )
-
-        try:
-            if customer_id:
-                customer = stripe.Customer.retrieve(customer_id)
-                card = customer.sources.create(**profile_data)
-            else:
-                profile_data.update({
-                    'description': card_info.party.name,
-                    'email': card_info.party.email,
-                })
-                customer = stripe.Customer.create(**profile_data)
-                card = customer.sources.data[0]
-        except (
-            stripe.error.CardError, stripe.error.InvalidRequestError,
-            stripe.error.AuthenticationError, stripe.error.APIConnectionError,
-            stripe.error.StripeError
-        ), exc:
-            raise UserError(exc.json_body['error']['message'])
-
-        return self.create_profile(
-            card.id,
-            stripe_customer_id=customer.id
-        )
+        return profile_data
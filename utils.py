@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+"""
+    utils.py
+
+    :copyright: (c) 2015 by Fulfil.IO Inc.
+    :license: see LICENSE for more details.
+"""
+import time
+import pickle
+import datetime
+import traceback
+from string import Formatter
+from decimal import Decimal
+from collections import deque
+from threading import Event, Lock, local
+from contextlib import contextmanager
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.pool import ThreadPool
+
+import requests
+import stripe
+from stripe import http_client
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.model import Model
+from trytond.transaction import Transaction
+
+__all__ = [
+    'stripe_map', 'from_stripe_amount', 'ZERO_DECIMAL_CURRENCIES',
+    'StripeObjectCache', 'stripe_object_cache',
+    'StripeHTTPClient', 'stripe_http_client', 'get_http_client',
+    'StripeProcessPool', 'RateLimitedClient', 'StripeGatewayHealth',
+    'stripe_gateway_health', 'StripeTemplate', 'STRIPE_ERROR_OUTCOMES',
+    'STRIPE_DECLINE_OUTCOMES', 'classify_stripe_error', 'stripe_error_body',
+    'stripe_error_message', 'StripeCoalescer', 'stripe_coalescer',
+    'own_transaction',
+]
+
+# https://stripe.com/docs/currencies#zero-decimal
+ZERO_DECIMAL_CURRENCIES = (
+    'BIF', 'XAF', 'XPF', 'CLP',
+    'KMF', 'DJF', 'GNF', 'JPY',
+    'MGA', 'PYG', 'RWF', 'KRW',
+    'VUV', 'VND', 'XOF'
+)
+
+# The outcomes of the failed stripe requests:
+#   retryable: stripe or the network failed, the same request may pass
+#   soft_decline: the bank declines the card for now, a later charge may pass
+#   hard_decline: the bank will keep declining the card
+#   configuration: the request or the gateway is wrong, only a fix helps
+STRIPE_ERROR_OUTCOMES = {
+    stripe.error.APIConnectionError: 'retryable',
+    stripe.error.APIError: 'retryable',
+    stripe.error.RateLimitError: 'retryable',
+    stripe.error.CardError: 'hard_decline',
+    stripe.error.InvalidRequestError: 'configuration',
+    stripe.error.IdempotencyError: 'configuration',
+    stripe.error.AuthenticationError: 'configuration',
+    stripe.error.PermissionError: 'configuration',
+    stripe.error.StripeError: 'configuration',
+}
+
+# The outcomes of the card errors by decline code, or by error code for
+# those without one. The other codes are hard declines.
+# https://stripe.com/docs/declines/codes
+STRIPE_DECLINE_OUTCOMES = dict(
+    [(code, 'soft_decline') for code in (
+        'approve_with_id', 'call_issuer', 'card_velocity_exceeded',
+        'do_not_honor', 'generic_decline', 'insufficient_funds',
+        'issuer_not_available', 'no_action_taken', 'reenter_transaction',
+        'try_again_later', 'withdrawal_count_limit_exceeded',
+    )] +
+    [(code, 'retryable') for code in (
+        'processing_error', 'rate_limit',
+    )]
+)
+
+
+def stripe_map(func, items, workers=8):
+    """
+    Call `func` on each of the items using a pool of threads and return a
+    list of (item, result, exception) in the order of the items.
+
+    Only the calls to stripe must happen in `func`: the records are not
+    thread safe, so read everything needed before and write the results
+    once the calls are done.
+
+    :param func: A function taking one of the items
+    :param items: The items to call the function with
+    :param workers: The maximum number of simultaneous calls
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception, exc:
+            return item, None, exc
+
+    items = list(items)
+    if len(items) <= 1 or workers <= 1:
+        return map(call, items)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@contextmanager
+def own_transaction(commit=True):
+    """
+    Run in a transaction committed on its own if `commit`, so that what is
+    done in it stays recorded whatever happens to the calling transaction.
+
+    Other backends than postgresql would wait for the lock of the calling
+    transaction, so they use it.
+    """
+    if not commit or backend.name() != 'postgresql':
+        yield Transaction()
+        return
+    with Transaction().new_transaction() as transaction:
+        yield transaction
+
+
+class StripeCoalescer(object):
+    """
+    Share the outcome of the stripe calls made simultaneously with the same
+    idempotency key by the threads of the process, so only the first one
+    reaches stripe. Stripe refuses a key used by a request still in flight.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def call(self, key, func):
+        """
+        Return the result of `func`, or of the call in flight with the same
+        key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            first = call is None
+            if first:
+                call = self._calls[key] = {'done': Event()}
+        if not first:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+        except Exception, exc:
+            call['error'] = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+stripe_coalescer = StripeCoalescer()
+
+
+def from_stripe_amount(amount, currency_code):
+    """
+    Convert an amount received from stripe to a Decimal in the currency
+    """
+    if currency_code.upper() in ZERO_DECIMAL_CURRENCIES:
+        return Decimal(amount)
+    return Decimal(amount) / 100
+
+
+class StripeTemplate(object):
+    """
+    A template of the text sent to stripe with the charges, like
+    "Order {origin.reference} of {party.code}".
+
+    The placeholders are paths of fields from the transaction, with an
+    optional format specification. The template is parsed once, rendering it
+    only follows the fields of the records, so the records browsed together
+    read each related model once.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.parts = [
+            (literal, field_name.split('.') if field_name else None, spec)
+            for literal, field_name, spec, _ in Formatter().parse(source)
+        ]
+
+    def render(self, record):
+        """
+        Return the template rendered for the record, the missing and empty
+        fields are rendered as an empty string and the records as their name
+        """
+        result = []
+        for literal, path, spec in self.parts:
+            result.append(literal)
+            value = record
+            for name in path or []:
+                value = getattr(value, name, None)
+                if value is None:
+                    break
+            if path and value is not None:
+                if isinstance(value, Model):
+                    value = value.rec_name
+                result.append(format(value, spec or ''))
+        return u''.join(result).strip()
+
+    # Values of the types of fields to try the format specifications on,
+    # the records are rendered as their name
+    FORMAT_SAMPLES = {
+        'numeric': Decimal(0),
+        'integer': 0,
+        'biginteger': 0,
+        'float': 0.0,
+        'boolean': False,
+        'date': datetime.date(2000, 1, 1),
+        'datetime': datetime.datetime(2000, 1, 1),
+        'timestamp': datetime.datetime(2000, 1, 1),
+        'time': datetime.time(0, 0),
+    }
+
+    def check(self, model_name):
+        """
+        Raise ValueError if a placeholder is not a path of fields from the
+        model or if its format specification does not suit the field.
+
+        A reference field may be followed by the fields of any of the
+        models it can point to.
+        """
+        for _, path, spec in self.parts:
+            if not path:
+                continue
+            models = [Pool().get(model_name)]
+            for name in path:
+                field_type, models = self._follow(models, name)
+            sample = u'' if models else \
+                self.FORMAT_SAMPLES.get(field_type, u'')
+            format(sample, spec or '')
+
+    @staticmethod
+    def _follow(models, name):
+        """
+        Return the type of the field of the models and the models it points
+        to
+        """
+        pool = Pool()
+
+        if not models:
+            raise ValueError(
+                '"%s" follows a field which is not a record' % name
+            )
+        fields = [
+            (Model, Model._fields[name]) for Model in models
+            if name in Model._fields
+        ]
+        if not fields:
+            raise ValueError('"%s" is not a field of %s' % (
+                name, ', '.join(Model.__name__ for Model in models)
+            ))
+        targets = []
+        for Model, field in fields:
+            if field._type in ('one2many', 'many2many'):
+                raise ValueError('"%s" is not a single value' % name)
+            if field._type == 'many2one':
+                targets.append(pool.get(field.model_name))
+            elif field._type == 'reference':
+                selection = field.selection
+                if isinstance(selection, basestring):
+                    selection = getattr(Model, selection)()
+                targets.extend(
+                    pool.get(target) for target, _ in selection if target
+                )
+        return fields[0][1]._type, targets
+
+
+class StripeObjectCache(object):
+    """
+    A bounded LRU cache of stripe objects with a time to live, keyed by
+    gateway and object id. Only the cards of the payment profiles are
+    cached, the customers are always fetched from stripe.
+
+    The cache is opt-in: nothing is cached for the gateways without a time
+    to live. It lives in the memory of the process, so an invalidation only
+    applies to the process it happens in and the time to live bounds how
+    long the other processes may see a stale object. The objects returned
+    are shared and must not be modified.
+    """
+
+    def __init__(self, name, size_limit=1024):
+        self._cache = Cache(name, size_limit=size_limit, context=False)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, gateway, object_id):
+        """
+        Return the stripe object from the cache, or None if it is missing or
+        expired or if the gateway has no cache.
+
+        :param gateway: The gateway the object belongs to
+        :param object_id: The id of the object on stripe
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        if not Gateway.get_stripe_config(gateway)['cache_ttl']:
+            return None
+        cached = self._cache.get((int(gateway), object_id))
+        hit = cached is not None and cached[0] > time.time()
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return cached[1] if hit else None
+
+    def store(self, gateway, object_id, obj):
+        """
+        Keep the stripe object fetched from stripe, if the gateway has a
+        cache
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        ttl = Gateway.get_stripe_config(gateway)['cache_ttl']
+        if ttl:
+            self._cache.set(
+                (int(gateway), object_id), (time.time() + ttl, obj)
+            )
+
+    def invalidate(self, gateway_id, *object_ids):
+        """
+        Drop the objects of the gateway from the cache
+        """
+        for object_id in object_ids:
+            if object_id:
+                self._cache.set((int(gateway_id), object_id), None)
+
+    def invalidate_from_event(self, gateway_id, event):
+        """
+        Drop the card changed by a `customer.source.*` stripe event, the
+        other events are ignored
+        """
+        if not event.type.startswith('customer.source.'):
+            return
+        self.invalidate(gateway_id, event.data.object.id)
+
+    def stats(self):
+        """
+        Return the number of hits and misses since the process started
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+stripe_object_cache = StripeObjectCache('payment_gateway_stripe.object')
+
+
+class StripeHTTPClient(http_client.HTTPClient):
+    """
+    The HTTP client of stripe, which sends the requests with the client
+    selected for the current thread, so that each gateway and kind of
+    operation gets its own timeouts and connection pool.
+    """
+    name = 'payment_gateway_stripe'
+
+    def __init__(self, *args, **kwargs):
+        super(StripeHTTPClient, self).__init__(*args, **kwargs)
+        self._local = local()
+        self._default = http_client.RequestsClient(*args, **kwargs)
+
+    def request(self, method, url, headers, post_data=None):
+        client = getattr(self._local, 'client', None) or self._default
+        return client.request(method, url, headers, post_data)
+
+    @contextmanager
+    def use(self, client):
+        """
+        Send the requests of the current thread with the given client
+        """
+        previous = getattr(self._local, 'client', None)
+        self._local.client = client
+        try:
+            yield client
+        finally:
+            self._local.client = previous
+
+
+stripe_http_client = StripeHTTPClient()
+# Every stripe request of the process goes through it
+stripe.default_http_client = stripe_http_client
+
+_http_clients = {}
+_http_clients_lock = Lock()
+
+
+class RateLimitedClient(http_client.HTTPClient):
+    """
+    An HTTP client sending at most `rate` requests per second with another
+    client, the next requests wait for their turn
+    """
+    name = 'payment_gateway_stripe_rate_limited'
+
+    def __init__(self, client, rate):
+        super(RateLimitedClient, self).__init__()
+        self.client = client
+        self.interval = 1. / rate
+        self._next = 0
+        self._lock = Lock()
+
+    def request(self, method, url, headers, post_data=None):
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self.client.request(method, url, headers, post_data)
+
+
+def get_http_client(
+        key, connect_timeout, read_timeout, max_connections,
+        rate_limit=None):
+    """
+    Return the HTTP client for the key and the settings, creating it the
+    first time.
+
+    When `max_connections` requests are in flight, the next ones wait for a
+    connection instead of opening a new one. When `rate_limit` is set, at
+    most that many requests are sent per second.
+    """
+    key = (key, connect_timeout, read_timeout, max_connections, rate_limit)
+    with _http_clients_lock:
+        if key not in _http_clients:
+            session = requests.Session()
+            session.mount('https://', requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_connections,
+                pool_block=True
+            ))
+            client = http_client.RequestsClient(
+                timeout=(connect_timeout, read_timeout), session=session
+            )
+            if rate_limit:
+                client = RateLimitedClient(client, rate_limit)
+            _http_clients[key] = client
+        return _http_clients[key]
+
+
+def classify_stripe_error(exc):
+    """
+    Return the outcome of a stripe error, one of STRIPE_ERROR_OUTCOMES, and
+    its decline code for the card errors
+    """
+    decline_code = None
+    if isinstance(exc, stripe.error.CardError):
+        error = (exc.json_body or {}).get('error') or {}
+        decline_code = error.get('decline_code') or exc.code
+        outcome = STRIPE_DECLINE_OUTCOMES.get(decline_code)
+        if outcome is not None:
+            return outcome, decline_code
+    if (getattr(exc, 'http_status', None) or 0) >= 500:
+        return 'retryable', decline_code
+    for klass in type(exc).__mro__:
+        if klass in STRIPE_ERROR_OUTCOMES:
+            return STRIPE_ERROR_OUTCOMES[klass], decline_code
+    return 'configuration', decline_code
+
+
+def stripe_error_body(exc):
+    """
+    Return the body of the answer of stripe to a failed request, or a body
+    like it for the errors without one like the connection errors
+    """
+    if exc.json_body:
+        return exc.json_body
+    return {'error': {
+        'type': type(exc).__name__,
+        'message': exc.user_message,
+    }}
+
+
+def stripe_error_message(exc):
+    """
+    Return the message of a stripe error to show to the user
+    """
+    return stripe_error_body(exc)['error'].get('message') or unicode(exc)
+
+
+class StripeGatewayHealth(object):
+    """
+    The rate of the stripe requests of each gateway which failed because
+    of stripe or the network over the last `window` seconds.
+
+    The card declines and invalid requests do not count as errors. The
+    rates live in the memory of the process, each process judges the
+    health of the gateways from its own requests.
+    """
+
+    def __init__(self, window=300, min_requests=10):
+        self.window = window
+        self.min_requests = min_requests
+        self._results = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def is_gateway_error(exc):
+        """
+        Tell if the exception shows the gateway is unhealthy
+        """
+        if isinstance(exc, (
+                stripe.error.APIConnectionError, stripe.error.APIError,
+                stripe.error.RateLimitError)):
+            return True
+        return (getattr(exc, 'http_status', None) or 0) >= 500
+
+    def record(self, gateway_id, exc=None):
+        """
+        Record the outcome of a request sent to the gateway
+        """
+        now = time.time()
+        with self._lock:
+            results = self._results.setdefault(int(gateway_id), deque())
+            results.append(
+                (now, exc is not None and self.is_gateway_error(exc))
+            )
+            while results and results[0][0] < now - self.window:
+                results.popleft()
+
+    def error_rate(self, gateway_id):
+        """
+        Return the recent error rate of the gateway, or None if too few
+        requests were sent to tell
+        """
+        limit = time.time() - self.window
+        with self._lock:
+            errors = [
+                error for sent, error in
+                self._results.get(int(gateway_id), ())
+                if sent >= limit
+            ]
+        if len(errors) < self.min_requests:
+            return None
+        return float(sum(errors)) / len(errors)
+
+    def is_healthy(self, gateway_id, max_error_rate):
+        rate = self.error_rate(gateway_id)
+        return rate is None or rate <= max_error_rate
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+stripe_gateway_health = StripeGatewayHealth()
+
+
+# The objects inherited from the parent process, kept so that their
+# connections are never closed by a child
+_inherited = []
+
+
+def _init_process():
+    """
+    Forget the transactions, caches, database and HTTP connections of the
+    parent process, a forked process must open its own
+    """
+    Database = backend.get('Database')
+    _inherited.append((dict(Database._databases), dict(_http_clients)))
+    Database._databases.clear()
+    _http_clients.clear()
+    stripe_http_client.__init__()
+
+    # The process is forked from the calling transaction
+    Transaction._local.transactions = []
+    # The locks may have been held by another thread of the parent, and
+    # the caches may hold what the calling transaction did not commit
+    Cache._resets.clear()
+    Cache._resets_lock = Lock()
+    for cache in Cache._cache_instance:
+        cache._cache.clear()
+        cache._timestamp = None
+        cache._lock = Lock()
+
+
+def _run_shard(args):
+    """
+    Run a shard and return a tuple (result, exception) so that the failure
+    of a shard does not hide the results of the others
+    """
+    database_name, user, context, model, method, ids, kwargs = args
+    try:
+        with Transaction().start(database_name, user, context=context):
+            Model = Pool(database_name).get(model)
+            return getattr(Model, method)(Model.browse(ids), **kwargs), None
+    except Exception, exc:
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            exc = Exception(traceback.format_exc())
+        return None, exc
+
+
+class StripeProcessPool(object):
+    """
+    A pool of processes running a batch method of a model on shards of
+    record ids, each shard in its own transaction committed by the process.
+
+    The processes only see what is committed and the calling transaction
+    must not write the records of the shards afterwards. Without
+    postgresql or with a single process the shards are run one after the
+    other in the calling transaction.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self._pool = None
+
+    def __enter__(self):
+        if self.processes > 1 and backend.name() == 'postgresql':
+            self._pool = ProcessPool(self.processes, _init_process)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def map(self, model, method, shards, **kwargs):
+        """
+        Call the batch method on the records of each shard and return a list
+        of (shard, result, exception) in the order of the shards.
+
+        A shard run in the calling transaction raises its exception as is,
+        nothing is committed anyway.
+
+        :param model: The name of the model
+        :param method: The name of a class method taking a list of records
+                       and the keyword arguments
+        :param shards: A list of lists of record ids
+        """
+        if self._pool is None:
+            Model = Pool().get(model)
+            return [
+                (ids, getattr(Model, method)(Model.browse(ids), **kwargs),
+                    None)
+                for ids in shards
+            ]
+        transaction = Transaction()
+        results = self._pool.map(_run_shard, [(
+            transaction.database.name, transaction.user,
+            transaction.context, model, method, list(ids), kwargs
+        ) for ids in shards], chunksize=1)
+        return [
+            (ids, result, exc)
+            for ids, (result, exc) in zip(shards, results)
+        ]